@@ -45,18 +45,24 @@ class PostAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('title',)}
     search_fields = ('title', 'slug', 'html')
 
+    # Save each post rather than updating the queryset, so the post's signal
+    # handlers expire its cached pages and feeds and recount its archives.
+
     @desc(short_description='Privatize selected posts')
     def make_private(self, request, queryset):
-        queryset.update(private=True)
+        for obj in queryset:
+            obj.private = True
+            obj.save()
 
     @desc(short_description='Entrust selected posts')
     def make_trusted(self, request, queryset):
-        queryset.update(private=True)
         trustgroup = None
         for obj in queryset:
             if trustgroup is None:
                 trustgroup, created = TrustGroup.objects.get_or_create(user=obj.author, tag='trusted',
                     defaults={'display_name': 'Trusted'})
+            obj.private = True
+            obj.save()
             obj.private_to = [trustgroup]
 
     actions = [make_private, make_trusted]
@@ -79,12 +85,48 @@ class AuthorSiteAdmin(admin.ModelAdmin):
 admin.site.register(AuthorSite, AuthorSiteAdmin)
 
 
-class Link404ResultAdmin(admin.ModelAdmin):
-    list_display = ('url', 'post', 'status', 'error')
+class LinkCheckResultInline(admin.TabularInline):
+    model = LinkCheckResult
+    extra = 0
+
+
+class LinkCheckAdmin(admin.ModelAdmin):
+    list_display = ('url', 'status', 'error', 'checked', 'failures', 'next_check')
     list_filter = ('status',)
     search_fields = ('url', 'error')
+    raw_id_fields = ('posts',)
+    inlines = [LinkCheckResultInline]
+
+admin.site.register(LinkCheck, LinkCheckAdmin)
+
+
+class LinkHostAdmin(admin.ModelAdmin):
+    list_display = ('host', 'failures', 'retry_after')
+    search_fields = ('host',)
+
+admin.site.register(LinkHost, LinkHostAdmin)
+
+
+class BulkJobAdmin(admin.ModelAdmin):
+    list_display = ('callback', 'author', 'state', 'done', 'total', 'created', 'finished')
+    list_filter = ('state',)
+
+    @desc(short_description='Cancel selected jobs')
+    def cancel_jobs(self, request, queryset):
+        for job in queryset.filter(state='running'):
+            job.cancel()
+
+    actions = [cancel_jobs]
+
+admin.site.register(BulkJob, BulkJobAdmin)
+
+
+class SyndicationOutboxAdmin(admin.ModelAdmin):
+    list_display = ('post', 'target', 'state', 'due', 'attempts', 'sent')
+    list_filter = ('target', 'state')
+    raw_id_fields = ('post',)
 
-admin.site.register(Link404Result, Link404ResultAdmin)
+admin.site.register(SyndicationOutbox, SyndicationOutboxAdmin)
 
 
 class TemplateAdmin(admin.ModelAdmin):
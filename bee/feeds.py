@@ -0,0 +1,324 @@
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from hashlib import md5
+import time
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.utils import feedgenerator
+from django.utils.text import compress_string
+from django.utils.xmlutils import SimplerXMLGenerator
+
+from bee.models import FeedArchivePage, Post, author_sites
+from bee.paging import cursor_for_post, decode_cursor, encode_cursor, posts_after, posts_before
+
+
+FEED_LENGTH = 20
+FEED_TIMEOUT = 60 * 60 * 24 * 30
+
+PUBLIC = 'public'
+AUTHOR = 'author'
+
+FEED_HISTORY_NS = u'http://purl.org/syndication/history/1.0'
+ARCHIVE_PAGE_LENGTH = 20
+ARCHIVE_OPEN_PAGE_LIFETIME = timedelta(minutes=5)
+
+
+class RealAtomFeed(feedgenerator.Atom1Feed):
+
+    def write(self, outfile, encoding):
+        # Write the feed header and footer ourselves, so entries can be
+        # copied in as already serialized fragments.
+        header = StringIO()
+        handler = SimplerXMLGenerator(header, encoding)
+        handler.startDocument()
+        handler.startElement(u'feed', self.root_attributes())
+        self.add_root_elements(handler)
+        handler.endDocument()
+        outfile.write(header.getvalue())
+
+        self.write_entries(outfile, encoding)
+        outfile.write('</feed>')
+
+    def serialize_entry(self, item, encoding):
+        entry = StringIO()
+        handler = SimplerXMLGenerator(entry, encoding)
+        handler.startElement(u'entry', self.item_attributes(item))
+        self.add_item_elements(handler, item)
+        handler.endElement(u'entry')
+        handler.endDocument()
+        return entry.getvalue()
+
+    def write_entries(self, outfile, encoding):
+        """
+        Write the feed's entries, using each item's already serialized
+        `fragment` if it has one, and caching the serializations of items
+        with a `fragment_key` that don't.
+        """
+        new_fragments = dict()
+        for item in self.items:
+            fragment = item.get('fragment')
+            if fragment is None:
+                fragment = self.serialize_entry(item, encoding)
+                if item.get('fragment_key'):
+                    new_fragments[item['fragment_key']] = fragment
+            outfile.write(fragment)
+
+        if new_fragments:
+            cache.set_many(new_fragments, FEED_TIMEOUT)
+
+    def add_item_elements(self, handler, item):
+        super(RealAtomFeed, self).add_item_elements(handler, item)
+
+        for datefield in (u'published', u'updated'):
+            datevalue = item.get(datefield)
+            if datevalue is not None:
+                handler.addQuickElement(datefield, feedgenerator.rfc3339_date(datevalue).decode('utf-8'))
+
+        content_html = item.get('content_html')
+        if content_html is not None:
+            handler.addQuickElement(u'content', content_html, {u'type': u'html'})
+
+    def add_root_elements(self, handler):
+        super(RealAtomFeed, self).add_root_elements(handler)
+
+        next_url = self.feed.get('next_url')
+        if next_url is not None:
+            handler.addQuickElement(u'link', u'', {u'rel': u'next', u'href': next_url})
+
+        for rel, href in self.feed.get('links') or ():
+            handler.addQuickElement(u'link', u'', {u'rel': rel, u'href': href})
+
+        if self.feed.get('archive'):
+            handler.addQuickElement(u'fh:archive', u'')
+
+    def root_attributes(self):
+        attrs = super(RealAtomFeed, self).root_attributes()
+        if self.feed.get('archive'):
+            attrs[u'xmlns:fh'] = FEED_HISTORY_NS
+        return attrs
+
+
+def visibility_for_groups(group_pks):
+    """Return the visibility class of a viewer who is in the trust groups with the given PKs."""
+    if not group_pks:
+        return PUBLIC
+    return 'groups:%s' % ','.join(str(group_pk) for group_pk in sorted(group_pks))
+
+
+def posts_for_visibility(author, visibility):
+    """Return the given author's posts that viewers of the given visibility class can see."""
+    if visibility == AUTHOR:
+        return author.posts_authored.all()
+    if visibility == PUBLIC:
+        return author.posts_authored.filter(private=False)
+
+    group_pks = [int(group_pk) for group_pk in visibility.split(':', 1)[1].split(',')]
+    return author.posts_authored.filter(Q(private=False) | Q(private_to__in=group_pks)).distinct()
+
+
+def entry_fragment_key(post):
+    return 'bee:entry:%d:%s' % (post.pk, post.modified.strftime('%Y%m%d%H%M%S%f'))
+
+
+def feed_for_posts(author, posts, feed_url, cache_entries=True, **kwargs):
+    """
+    Return a `RealAtomFeed` of the given posts by the given author.
+
+    Unless `cache_entries` is false, each post's entry is serialized once per
+    `Post.modified` and cached. The posts can be loaded with their `html`
+    deferred; only posts without cached entries will have it loaded.
+
+    """
+    author_name = ' '.join(filter(None, (author.first_name, author.last_name)))
+    index_url = 'http://%s/' % author_sites.domain_for_author(author.pk)
+    # TODO: use the author's site instead of hardcoding for me?
+    feed_id = 'tag:bestendtimesever.com,2009:%s' % author.username
+
+    feed = RealAtomFeed(title=author.username, link=index_url, description=None,
+        author_email=author.email, author_name=author_name, author_link=index_url,
+        feed_url=feed_url, feed_guid=feed_id, **kwargs)
+
+    posts = list(posts)
+    fragment_keys = [entry_fragment_key(post) if cache_entries else None for post in posts]
+    fragments = cache.get_many(filter(None, fragment_keys)) if cache_entries else {}
+    unloaded = [post.pk for post, key in zip(posts, fragment_keys) if key not in fragments and 'html' not in post.__dict__]
+    html_by_pk = dict(Post.objects.filter(pk__in=unloaded).values_list('pk', 'html')) if unloaded else {}
+
+    for post, fragment_key in zip(posts, fragment_keys):
+        fragment = fragments.get(fragment_key)
+        if fragment is not None:
+            content_html = None
+        else:
+            content_html = html_by_pk[post.pk] if post.pk in html_by_pk else post.html
+        feed.add_item(title=post.title, link=post.permalink, description=None,
+            unique_id=post.atom_id, updated=post.modified, published=post.published,
+            content_html=content_html, fragment_key=fragment_key, fragment=fragment)
+
+    return feed
+
+
+def feed_cache_key(author_pk, visibility):
+    return 'bee:feed:%d:%s' % (author_pk, visibility)
+
+
+def feed_visibilities_key(author_pk):
+    return 'bee:feed:%d:visibilities' % author_pk
+
+
+def feed_visibilities(author_pk):
+    """Return the visibility classes of the given author's feeds that should be kept rendered."""
+    visibilities = set((PUBLIC, AUTHOR))
+    visibilities.update(cache.get(feed_visibilities_key(author_pk)) or ())
+    return sorted(visibilities)
+
+
+def render_feed(author, visibility):
+    """
+    Render the given author's current feed for viewers of the given
+    visibility class, storing it (and a gzipped copy) in the cache.
+    """
+    posts = posts_for_visibility(author, visibility)
+    posts = posts.filter(published__lt=datetime.utcnow()).order_by('-published', '-id').defer('html')[:FEED_LENGTH]
+    domain = author_sites.domain_for_author(author.pk)
+    feed_url = 'http://%s/feed/' % domain
+
+    links = list()
+    if visibility in (PUBLIC, AUTHOR):
+        newest_archive = newest_archive_cursor(author, visibility)
+        if newest_archive is not False:
+            links.append((u'prev-archive', 'http://%s%s' % (domain, archive_page_path(newest_archive))))
+
+    feed = feed_for_posts(author, posts, feed_url, links=links)
+
+    body = feed.writeString('utf-8')
+    etag = md5(body).hexdigest()
+    # Keep the time of the last rendering that changed the feed, for Last-Modified.
+    previous = cached_feed(author.pk, visibility)
+    if previous is not None and previous['etag'] == etag and 'modified' in previous:
+        modified = previous['modified']
+    else:
+        modified = int(time.time())
+    rendered = {
+        'body': body,
+        'gzipped': compress_string(body),
+        'etag': etag,
+        'modified': modified,
+        'content_type': feed.mime_type,
+    }
+    cache.set(feed_cache_key(author.pk, visibility), rendered, FEED_TIMEOUT)
+    keep_feed_visibility(author.pk, visibility)
+    return rendered
+
+
+def keep_feed_visibility(author_pk, visibility):
+    """Keep the given visibility class of the author's feed rendered from now on."""
+    if visibility in (PUBLIC, AUTHOR):
+        return
+    visibilities = set(cache.get(feed_visibilities_key(author_pk)) or ())
+    if visibility not in visibilities:
+        visibilities.add(visibility)
+        cache.set(feed_visibilities_key(author_pk), visibilities, FEED_TIMEOUT)
+
+
+def cached_feed(author_pk, visibility):
+    """Return the stored rendering of the given author's feed for the given visibility class, if any."""
+    return cache.get(feed_cache_key(author_pk, visibility))
+
+
+def archive_posts(author, visibility):
+    """Return the given author's posts that belong in the archive feed pages for the given visibility class."""
+    return posts_for_visibility(author, visibility).filter(published__lt=datetime.utcnow())
+
+
+def archive_page_path(after):
+    if after is None:
+        return reverse('feed_archive_start')
+    return reverse('feed_archive', kwargs={'after': after})
+
+
+def newest_archive_cursor(author, visibility):
+    """
+    Return the cursor after which the given author's newest full archive page
+    starts (None if that's the first page), or False if there are no full
+    pages yet.
+    """
+    posts = archive_posts(author, visibility)
+    count = posts.count()
+    full_pages = count // ARCHIVE_PAGE_LENGTH
+    if not full_pages:
+        return False
+    if full_pages == 1:
+        return None
+    # Count back from the newest post, past the open page and the newest full
+    # page, so only those rows of the (author, published) index are read
+    # however many posts there are.
+    newest_first = posts.order_by('-published', '-id').values_list('published', 'id')
+    published, post_pk = newest_first[count % ARCHIVE_PAGE_LENGTH + ARCHIVE_PAGE_LENGTH]
+    return encode_cursor(author.pk, published, post_pk)
+
+
+def archive_page(author, visibility, after):
+    """
+    Return the `FeedArchivePage` of the given author's posts for the given
+    visibility class that starts after the given cursor, generating it if
+    there's no stored copy, or None if there's no such page.
+
+    Pages start every `ARCHIVE_PAGE_LENGTH` posts from the author's first
+    post. Full pages never change once generated, unless an older post is
+    edited, deleted or redated; the open newest page is regenerated when it's
+    older than `ARCHIVE_OPEN_PAGE_LIFETIME`.
+
+    """
+    posts = archive_posts(author, visibility)
+    if after is None:
+        after_published = after_pk = None
+    else:
+        after_published, after_pk = decode_cursor(after, author.pk)
+
+    stored = FeedArchivePage.objects.filter(author=author, visibility=visibility,
+        after_published=after_published, after_id=after_pk)
+    try:
+        page = stored.get()
+    except FeedArchivePage.DoesNotExist:
+        page = None
+    else:
+        if page.full or datetime.utcnow() - page.generated < ARCHIVE_OPEN_PAGE_LIFETIME:
+            return page
+
+    if after is None:
+        page_posts = posts
+    else:
+        # Only cursors on page boundaries start archive pages.
+        if posts_before(posts, after_published, after_pk).count() % ARCHIVE_PAGE_LENGTH != ARCHIVE_PAGE_LENGTH - 1:
+            return None
+        page_posts = posts_after(posts, after_published, after_pk)
+    page_posts = list(page_posts.order_by('published', 'id').defer('html')[:ARCHIVE_PAGE_LENGTH])
+    if not page_posts:
+        return None
+    last_post = page_posts[-1]
+
+    domain = author_sites.domain_for_author(author.pk)
+    links = [(u'current', 'http://%s/feed/' % domain)]
+    if after is not None:
+        earlier = posts_before(posts, after_published, after_pk).order_by('-published', '-id')
+        earlier = list(earlier[ARCHIVE_PAGE_LENGTH - 1:ARCHIVE_PAGE_LENGTH])
+        prev_after = cursor_for_post(earlier[0]) if earlier else None
+        links.append((u'prev-archive', 'http://%s%s' % (domain, archive_page_path(prev_after))))
+    full = len(page_posts) == ARCHIVE_PAGE_LENGTH
+    if full:
+        links.append((u'next-archive', 'http://%s%s' % (domain, archive_page_path(cursor_for_post(last_post)))))
+
+    feed_url = 'http://%s%s' % (domain, archive_page_path(after))
+    feed = feed_for_posts(author, reversed(page_posts), feed_url, links=links, archive=True)
+
+    if page is None:
+        page = FeedArchivePage(author=author, visibility=visibility,
+            after_published=after_published, after_id=after_pk)
+    page.last_published = last_post.published
+    page.full = full
+    page.body = feed.writeString('utf-8')
+    page.generated = datetime.utcnow()
+    page.save()
+    return page
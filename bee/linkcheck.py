@@ -0,0 +1,265 @@
+"""
+Checking the links in authors' posts for ones that no longer work.
+
+Each unique URL is only probed once per check, however many posts link to
+it, and URLs are probed several at a time with at most a few requests to
+any one host at once. URLs are only probed again once their last result
+is stale, and hosts that keep failing are left alone for longer and
+longer.
+
+"""
+
+from datetime import datetime, timedelta
+from itertools import izip_longest
+import logging
+from Queue import Queue
+import threading
+from urlparse import urljoin, urlsplit, urlunsplit
+
+from django.db.models import Q
+import httplib2
+
+import bee.models
+
+
+LINK_CHECK_WORKERS = 8
+LINK_CHECK_PER_HOST = 2
+LINK_CHECK_TIMEOUT = 10
+USER_AGENT = 'bee/1.0'
+
+# Working links are checked again monthly. Broken ones are checked again the
+# next day, then less and less often in case they come back.
+LINK_RECHECK_WORKING = timedelta(days=30)
+LINK_RECHECK_BROKEN = timedelta(days=1)
+LINK_RECHECK_MAX = timedelta(days=90)
+LINK_RECHECK_BATCH = 2000
+LINK_CHECK_HISTORY = 10
+
+HOST_BACKOFF = timedelta(minutes=30)
+HOST_BACKOFF_MAX = timedelta(days=7)
+
+
+log = logging.getLogger(__name__)
+
+
+def probe(http, url):
+    """Return the status of a request for `url` (0 if it couldn't be made) and any error."""
+    try:
+        resp, content = http.request(url, method='HEAD', headers={'User-Agent': USER_AGENT})
+        if resp.status in (405, 501):
+            # Some servers don't do HEAD requests, so ask for the whole thing.
+            resp, content = http.request(url, method='GET', headers={'User-Agent': USER_AGENT})
+    except Exception, exc:
+        log.info('Error fetching %s: %s', url, exc)
+        return 0, str(exc) or exc.__class__.__name__
+    return resp.status, None
+
+
+class LinkChecker(object):
+
+    """
+    Probes URLs with a pool of `workers` threads, making no more than
+    `per_host` requests to any one host at a time.
+    """
+
+    def __init__(self, workers=LINK_CHECK_WORKERS, per_host=LINK_CHECK_PER_HOST, timeout=LINK_CHECK_TIMEOUT):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.host_slots = dict()
+        self.host_slots_lock = threading.Lock()
+
+    def host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self.host_slots_lock:
+            try:
+                return self.host_slots[host]
+            except KeyError:
+                slot = self.host_slots[host] = threading.Semaphore(self.per_host)
+                return slot
+
+    def work(self, urls, results):
+        http = httplib2.Http(timeout=self.timeout)
+        while True:
+            url = urls.get()
+            try:
+                if url is None:
+                    return
+                with self.host_slot(url):
+                    results[url] = probe(http, url)
+            finally:
+                urls.task_done()
+
+    def check(self, urls):
+        """Return a dict of the `(status, error)` results of probing each of the given URLs."""
+        by_host = dict()
+        for url in set(urls):
+            by_host.setdefault(urlsplit(url).netloc.lower(), list()).append(url)
+
+        # Take turns between hosts, so workers aren't all stuck waiting on one busy host.
+        queue = Queue()
+        for turn in izip_longest(*[sorted(host_urls) for host, host_urls in sorted(by_host.iteritems())]):
+            for url in turn:
+                if url is not None:
+                    queue.put(url)
+
+        results = dict()
+        threads = [threading.Thread(target=self.work, args=(queue, results)) for i in range(min(self.workers, queue.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def links_in_posts(posts, base_url):
+    """
+    Return a dict of the PKs of the given posts that link to each absolute
+    URL away from the site at `base_url`.
+    """
+    # Relative links are to the author's own site, so only look at links with other hosts.
+    links = bee.models.PostLink.objects.filter(post__in=posts).exclude(host__in=('', bee.models.normalized_host(base_url)))
+    posts_by_url = dict()
+    for post_pk, url in links.values_list('post', 'url').iterator():
+        url = urljoin(base_url, url)
+        if urlsplit(url).scheme not in ('http', 'https'):
+            continue
+        posts_by_url.setdefault(url, set()).add(post_pk)
+    return posts_by_url
+
+
+def link_working(status):
+    return 200 <= status < 400
+
+
+def host_failing(status):
+    """Return whether a check's status means the host itself isn't answering properly."""
+    return status == 0 or status >= 500
+
+
+def attach_links(posts, posts_by_url):
+    """
+    Record which of the given posts link to each URL, making `LinkCheck`s
+    for new URLs. Returns the `LinkCheck`s by URL.
+    """
+    checks = dict()
+    for url in posts_by_url:
+        checks[url], created = bee.models.LinkCheck.objects.get_or_create(url_hash=bee.models.url_hash(url), defaults={'url': url})
+
+    # Other posts may link to the same URLs, so only change the links from these posts.
+    through = bee.models.LinkCheck.posts.through
+    wanted = set((checks[url].pk, post_pk) for url, post_pks in posts_by_url.iteritems() for post_pk in post_pks)
+    existing = dict(((check_pk, post_pk), pk) for pk, check_pk, post_pk
+        in through.objects.filter(post__in=posts).values_list('pk', 'linkcheck', 'post'))
+    stale = [pk for link, pk in existing.iteritems() if link not in wanted]
+    for start in range(0, len(stale), 500):
+        through.objects.filter(pk__in=stale[start:start + 500]).delete()
+    for check_pk, post_pk in wanted.difference(existing):
+        through.objects.create(linkcheck_id=check_pk, post_id=post_pk)
+
+    return checks
+
+
+def backoff(base, failures, most):
+    """Return `base` doubled for each failure after the first, up to `most`."""
+    return min(base * 2 ** min(max(failures - 1, 0), 20), most)
+
+
+def record_result(check, status, error, now):
+    """Update the given `LinkCheck` with a new result, keeping a bounded history of results."""
+    check.status = status
+    check.error = error
+    check.checked = now
+    if link_working(status):
+        check.failures = 0
+        check.next_check = now + LINK_RECHECK_WORKING
+    else:
+        check.failures += 1
+        check.next_check = now + backoff(LINK_RECHECK_BROKEN, check.failures, LINK_RECHECK_MAX)
+    check.save()
+
+    check.results.create(status=status, error=error, checked=now)
+    old = list(check.results.order_by('-checked', '-id').values_list('pk', flat=True)[LINK_CHECK_HISTORY:])
+    if old:
+        bee.models.LinkCheckResult.objects.filter(pk__in=old).delete()
+
+
+def record_host_results(results, now):
+    """Back off from hosts where every link failed, and forgive hosts where any worked."""
+    host_failed = dict()
+    for url, (status, error) in results.iteritems():
+        host = urlsplit(url).netloc.lower()
+        host_failed[host] = host_failed.get(host, True) and host_failing(status)
+
+    for host, failed in host_failed.iteritems():
+        link_host, created = bee.models.LinkHost.objects.get_or_create(host=host)
+        if failed:
+            link_host.failures += 1
+            link_host.retry_after = now + backoff(HOST_BACKOFF, link_host.failures, HOST_BACKOFF_MAX)
+            link_host.save()
+        elif link_host.failures:
+            link_host.failures = 0
+            link_host.retry_after = None
+            link_host.save()
+
+
+def probe_checks(checks, checker=None):
+    """
+    Check the URLs of the given `LinkCheck`s, except those on hosts we're
+    backing off from, returning the `(status, error)` results by URL.
+    """
+    now = datetime.utcnow()
+    hosts = set(urlsplit(check.url).netloc.lower() for check in checks)
+    backing_off = dict(bee.models.LinkHost.objects.filter(host__in=hosts, retry_after__gt=now).values_list('host', 'retry_after'))
+
+    to_probe = dict()
+    for check in checks:
+        retry_after = backing_off.get(urlsplit(check.url).netloc.lower())
+        if retry_after is None:
+            to_probe[check.url] = check
+        else:
+            # Don't pick it again until the host might be back.
+            bee.models.LinkCheck.objects.filter(pk=check.pk).update(next_check=retry_after)
+
+    if checker is None:
+        checker = LinkChecker()
+    results = checker.check(to_probe.keys())
+
+    now = datetime.utcnow()
+    for url, (status, error) in results.iteritems():
+        record_result(to_probe[url], status, error, now)
+    record_host_results(results, now)
+    return results
+
+
+def check_links(posts, author_domain, checker=None, force=False):
+    """
+    Check the external links in the given posts on the author's site at
+    `author_domain` that are due to be checked (or all of them, if `force`),
+    returning the `(status, error)` results by URL.
+    """
+    posts_by_url = links_in_posts(posts, urlunsplit(('http', author_domain, '/', '', '')))
+    checks = attach_links(posts, posts_by_url)
+    now = datetime.utcnow()
+    due = [check for check in checks.itervalues() if force or check.next_check is None or check.next_check <= now]
+    return probe_checks(due, checker)
+
+
+def check_author_links(author_pk, checker=None, force=False):
+    author_domain = bee.models.author_sites.domain_for_author(author_pk)
+    return check_links(bee.models.Post.objects.filter(author=author_pk), author_domain, checker, force)
+
+
+def recheck_stale_links(limit=LINK_RECHECK_BATCH, checker=None):
+    """
+    Check up to `limit` of the linked URLs that are most overdue for a check,
+    first forgetting any URLs no posts link to anymore. Returns the results.
+    """
+    bee.models.LinkCheck.objects.filter(posts__isnull=True).delete()
+
+    now = datetime.utcnow()
+    due = bee.models.LinkCheck.objects.filter(Q(next_check__isnull=True) | Q(next_check__lte=now))
+    return probe_checks(list(due.order_by('next_check')[:limit]), checker)
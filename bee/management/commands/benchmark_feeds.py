@@ -0,0 +1,66 @@
+from datetime import datetime
+from optparse import make_option
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+import bee.feeds
+import bee.models
+
+
+class Command(BaseCommand):
+
+    help = ("Time rendering an author's public feed with and without the cached entry fragments. This measures "
+        "the fragment cache alone: the feed view serves stored renderings either way, so it isn't timed.")
+    option_list = BaseCommand.option_list + (
+        make_option('--author',
+            metavar='USERNAME',
+            help='The author whose feed to render (default: the first author with a site)',
+        ),
+        make_option('--iterations',
+            type='int',
+            default=50,
+            help='How many times to render the feed each way (default: 50)',
+        ),
+    )
+
+    def time_renders(self, iterations, render):
+        start = time.time()
+        for i in range(iterations):
+            render()
+        return (time.time() - start) / iterations
+
+    def handle(self, **options):
+        if options.get('author'):
+            author = User.objects.get(username=options['author'])
+        else:
+            try:
+                author = bee.models.AuthorSite.objects.select_related('author').order_by('id')[0].author
+            except IndexError:
+                raise CommandError("There are no authors with sites to render feeds for")
+        iterations = options['iterations']
+
+        posts = bee.feeds.posts_for_visibility(author, bee.feeds.PUBLIC)
+        posts = posts.filter(published__lt=datetime.utcnow()).order_by('-published', '-id')
+        feed_url = 'http://%s/feed/' % bee.models.author_sites.domain_for_author(author.pk)
+
+        def render_whole():
+            feed = bee.feeds.feed_for_posts(author, posts[:bee.feeds.FEED_LENGTH], feed_url, cache_entries=False)
+            feed.writeString('utf-8')
+
+        def render_fragments():
+            feed = bee.feeds.feed_for_posts(author, posts.defer('html')[:bee.feeds.FEED_LENGTH], feed_url)
+            feed.writeString('utf-8')
+
+        # Warm the fragment cache so the timed renders measure the steady state.
+        render_fragments()
+
+        whole = self.time_renders(iterations, render_whole)
+        fragments = self.time_renders(iterations, render_fragments)
+
+        self.stdout.write('rendering only, not the feed view\n')
+        self.stdout.write('serializing every entry: %.2f ms per feed\n' % (whole * 1000))
+        self.stdout.write('cached entry fragments:  %.2f ms per feed\n' % (fragments * 1000))
+        if fragments:
+            self.stdout.write('speedup: %.1fx\n' % (whole / fragments))
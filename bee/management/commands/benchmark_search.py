@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from bisect import bisect
+from optparse import make_option
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from haystack.constants import ID, DJANGO_CT, DJANGO_ID
+from haystack.query import SQ, SearchQuerySet
+
+from bee.sqlite_fts_backend import SearchBackend, SearchQuery
+
+
+SYLLABLES = 'ba be bi bo bu da de di do du ka ke ki ko ku la le li lo lu ma me mi mo mu na ne ni no nu ra re ri ro ru sa se si so su ta te ti to tu'.split()
+VOCABULARY = 20000
+# Searches are for words people use, but not the ones everybody uses.
+QUERY_WORD_RANKS = (50, 5000)
+
+AUTHORS = 10
+GROUPS_PER_AUTHOR = 3
+
+
+class Command(BaseCommand):
+
+    help = "Time building and querying an SQLite full text search index of generated posts."
+    option_list = BaseCommand.option_list + (
+        make_option('--count',
+            type='int',
+            default=100000,
+            help='How many posts to generate (default: 100000)',
+        ),
+        make_option('--queries',
+            type='int',
+            default=500,
+            help='How many searches to time (default: 500)',
+        ),
+        make_option('--seed',
+            type='int',
+            default=0,
+            help='Seed for generating the posts and searches (default: 0)',
+        ),
+    )
+
+    def make_vocabulary(self, rand):
+        """Make up the words for the posts, with Zipf distributed frequencies like real text."""
+        words = set()
+        while len(words) < VOCABULARY:
+            words.add(''.join(rand.choice(SYLLABLES) for i in range(rand.randint(1, 4))))
+        self.words = sorted(words, key=lambda word: (len(word), word))
+
+        self.cumulative_weights = list()
+        total = 0.0
+        for rank in range(1, VOCABULARY + 1):
+            total += 1.0 / rank
+            self.cumulative_weights.append(total)
+
+    def random_word(self, rand):
+        return self.words[bisect(self.cumulative_weights, rand.random() * self.cumulative_weights[-1])]
+
+    def generate_docs(self, rand, count):
+        start = datetime(2005, 1, 1)
+        for i in range(1, count + 1):
+            words = [self.random_word(rand) for j in range(rand.randint(20, 300))]
+            private = rand.random() < 0.2
+            author_pk = rand.randint(1, AUTHORS)
+            title = ' '.join(words[:4]).capitalize()
+            yield {
+                ID: 'bee.post.%d' % i,
+                DJANGO_CT: 'bee.post',
+                DJANGO_ID: str(i),
+                'text': u'%s\n%s' % (title, ' '.join(words)),
+                'title': title,
+                'author_pk': author_pk,
+                'published': start + timedelta(minutes=i * 30),
+                'private': int(private),
+                'trust_groups': [author_pk * GROUPS_PER_AUTHOR + rand.randrange(GROUPS_PER_AUTHOR)] if private else [],
+                'result': u'<div class="entry"><h2>%s</h2></div>' % title,
+            }
+
+    def search(self, backend, rand):
+        """Run one search shaped like `PostSearch`'s, returning the first page of results."""
+        author_pk = rand.randint(1, AUTHORS)
+        sqs = SearchQuerySet(query=SearchQuery(backend=backend)).filter(author_pk=author_pk)
+        viewer = rand.choice(('anonymous', 'author', 'group'))
+        if viewer == 'anonymous':
+            sqs = sqs.filter(private=0)
+        elif viewer == 'group':
+            sqs = sqs.filter(SQ(private=0) | SQ(trust_groups__in=[author_pk * GROUPS_PER_AUTHOR]))
+        terms = [self.words[rand.randrange(*QUERY_WORD_RANKS)] for i in range(rand.randint(1, 2))]
+        sqs = sqs.auto_query(' '.join(terms))
+        # Like the search page's paginator, count the results and load a page of them.
+        sqs.count()
+        return list(sqs[:20])
+
+    def handle(self, **options):
+        rand = random.Random(options['seed'])
+        count = options['count']
+        self.make_vocabulary(rand)
+        tempdir = tempfile.mkdtemp(prefix='bee-search-')
+        backend = SearchBackend(path=os.path.join(tempdir, 'index.sqlite'))
+        try:
+            start = time.time()
+            backend.index_documents('text', self.generate_docs(rand, count), ('result',))
+            built = time.time() - start
+            self.stdout.write('indexed %d posts in %.1f s (%.0f posts/s)\n' % (count, built, count / built))
+
+            # Warm up the page cache so the timings measure steady state searches.
+            for i in range(10):
+                self.search(backend, rand)
+
+            latencies = list()
+            for i in range(options['queries']):
+                start = time.time()
+                self.search(backend, rand)
+                latencies.append(time.time() - start)
+            latencies.sort()
+
+            def percentile(p):
+                return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+            self.stdout.write('%d searches: median %.2f ms, p95 %.2f ms, max %.2f ms\n'
+                % (len(latencies), percentile(0.5), percentile(0.95), latencies[-1] * 1000))
+        finally:
+            backend.connection.close()
+            shutil.rmtree(tempdir)
@@ -0,0 +1,55 @@
+from optparse import make_option
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+import bee.linkcheck
+import bee.models
+
+
+class Command(BaseCommand):
+
+    help = "Check the external links in an author's posts, listing the ones that don't work."
+    option_list = BaseCommand.option_list + (
+        make_option('--author',
+            metavar='USERNAME',
+            help='The author whose posts to check (default: the first author with a site)',
+        ),
+        make_option('--workers',
+            type='int',
+            default=bee.linkcheck.LINK_CHECK_WORKERS,
+            help='How many links to check at once (default: %d)' % bee.linkcheck.LINK_CHECK_WORKERS,
+        ),
+        make_option('--per-host',
+            type='int',
+            default=bee.linkcheck.LINK_CHECK_PER_HOST,
+            help='How many links on the same host to check at once (default: %d)' % bee.linkcheck.LINK_CHECK_PER_HOST,
+        ),
+        make_option('--force',
+            action='store_true',
+            default=False,
+            help='Check every link, even ones checked recently',
+        ),
+    )
+
+    def handle(self, **options):
+        if options.get('author'):
+            author = User.objects.get(username=options['author'])
+        else:
+            try:
+                author = bee.models.AuthorSite.objects.select_related('author').order_by('id')[0].author
+            except IndexError:
+                raise CommandError("There are no authors with sites to check links for")
+
+        checker = bee.linkcheck.LinkChecker(workers=options['workers'], per_host=options['per_host'])
+        start = time.time()
+        results = bee.linkcheck.check_author_links(author.pk, checker, force=options['force'])
+        elapsed = time.time() - start
+
+        # List the broken links as of their last checks, including the ones that weren't due this time.
+        checks = bee.models.LinkCheck.objects.filter(posts__author=author).exclude(status=None).distinct()
+        for url, status, error in checks.order_by('url').values_list('url', 'status', 'error'):
+            if not bee.linkcheck.link_working(status):
+                self.stdout.write('%s %s%s\n' % (status, url, ' (%s)' % error if error else ''))
+        self.stdout.write('checked %d links in %.1f s\n' % (len(results), elapsed))
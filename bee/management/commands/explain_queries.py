@@ -0,0 +1,97 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import RequestFactory
+
+import bee.models
+from bee.models import Post
+from bee.paging import posts_before
+import bee.views
+
+
+class Command(BaseCommand):
+
+    help = "Show the database's query plans for bee's hot queries, failing if any of them scan a whole table."
+    option_list = BaseCommand.option_list + (
+        make_option('--author',
+            metavar='USERNAME',
+            help='The author whose posts to query (default: the first author with a site)',
+        ),
+    )
+
+    def hot_queries(self, author):
+        """Yield a name and queryset for each of the query shapes the views and tasks use most."""
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        now = datetime.utcnow()
+
+        posts = bee.views.posts_for_request(request, author).filter(published__lt=now)
+        yield 'anonymous index', posts.order_by('-published', '-id')[:21]
+        yield 'anonymous index page', posts_before(posts, now, 1).order_by('-published', '-id')[:21]
+        yield 'anonymous day', posts.filter(published__gte=datetime(now.year, now.month, 1)).order_by('-published', '-id')[:21]
+        month = posts.filter(published__gte=datetime(now.year, 1, 1), published__lt=datetime(now.year, 2, 1))
+        yield 'anonymous month page', posts_before(month, datetime(now.year, 1, 15), 1).order_by('-published', '-id')[:21]
+
+        request.user = author
+        posts = bee.views.posts_for_request(request, author).filter(published__lt=now)
+        yield 'author index', posts.order_by('-published', '-id')[:21]
+        yield 'author index page', posts_before(posts, now, 1).order_by('-published', '-id')[:21]
+
+        yield 'legacy url', bee.models.PostLegacyUrl.objects.filter(netloc='example.com', path='/2011/01/example.html')
+        yield 'backlinks', bee.models.posts_linking_to('http://%s/post-1' % bee.models.author_sites.domain_for_author(author.pk))
+        yield 'external links', bee.models.PostLink.objects.filter(post__author=author).exclude(host__in=('', 'example.com'))
+        yield 'due syndications', bee.models.SyndicationOutbox.objects.filter(state='pending', due__lte=now).order_by('due')[:50]
+        yield 'link check', bee.models.LinkCheck.objects.filter(url_hash='0' * 40)
+        yield 'stale links', bee.models.LinkCheck.objects.filter(next_check__lte=now).order_by('next_check')[:100]
+        yield 'link results', bee.models.LinkCheckResult.objects.filter(link_check=1).order_by('-checked', '-id')
+        yield 'search suggestions', bee.models.SearchSuggestion.objects.filter(author=author, visibility__in=['public'],
+            key__gte=u'ho', key__lt=u'ho\uffff', published__lte=now).order_by('key')[:100]
+
+        comments = bee.views.comment_count_queryset(Post.objects.filter(author=author).order_by('-published')[:20])
+        if comments is not None:
+            yield 'comment counts', comments
+
+    def explain(self, queryset):
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        engine = connection.settings_dict['ENGINE']
+        cursor = connection.cursor()
+
+        if engine.endswith('sqlite3'):
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+        elif engine.endswith('postgresql_psycopg2') or engine.endswith('postgresql'):
+            # Small seeded tables are cheaper to scan, so make the planner show what it would do for big ones.
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SET enable_seqscan = on')
+            full_scans = [step for step in plan if 'Seq Scan' in step]
+        else:
+            raise CommandError("Don't know how to explain queries for database engine %r" % engine)
+
+        return plan, full_scans
+
+    def handle(self, **options):
+        if options.get('author'):
+            author = User.objects.get(username=options['author'])
+        else:
+            try:
+                author = bee.models.AuthorSite.objects.select_related('author').order_by('id')[0].author
+            except IndexError:
+                raise CommandError("There are no authors with sites to query for")
+
+        failures = list()
+        for name, queryset in self.hot_queries(author):
+            plan, full_scans = self.explain(queryset)
+            self.stdout.write('%s:\n' % name)
+            for step in plan:
+                self.stdout.write('    %s\n' % step)
+            if full_scans:
+                failures.append(name)
+
+        if failures:
+            raise CommandError("Queries did full table scans: %s" % ', '.join(failures))
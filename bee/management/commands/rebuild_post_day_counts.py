@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+import bee.models
+
+
+class Command(BaseCommand):
+
+    help = 'Recount the posts per day behind the archive calendar.'
+    option_list = BaseCommand.option_list + (
+        make_option('--author',
+            metavar='USERNAME',
+            help='Only recount the posts of this author (default: all authors)',
+        ),
+    )
+
+    def handle(self, **options):
+        posts = bee.models.Post.objects.all()
+        counts = bee.models.PostDayCount.objects.all()
+        if options.get('author'):
+            author = User.objects.get(username=options['author'])
+            posts = posts.filter(author=author)
+            counts = counts.filter(author=author)
+
+        # Forget counts for days that no longer have any posts, then recount every day that does.
+        days_by_author = dict()
+        for author_pk, published in posts.values_list('author', 'published').order_by().iterator():
+            days_by_author.setdefault(author_pk, set()).add(published.date())
+        for author_pk, day in list(counts.values_list('author', 'day').distinct()):
+            if day not in days_by_author.get(author_pk, ()):
+                counts.filter(author=author_pk, day=day).delete()
+
+        for author_pk, days in days_by_author.iteritems():
+            bee.models.recount_post_days(author_pk, days)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+import bee.models
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute which viewers can see which private posts through their trust groups.'
+
+    def handle(self, **options):
+        bee.models.PostVisibility.objects.filter(post__private=False).delete()
+
+        batch = list()
+        private_post_pks = bee.models.Post.objects.filter(private=True).values_list('pk', flat=True).order_by('pk')
+        for post_pk in private_post_pks.iterator():
+            batch.append(post_pk)
+            if len(batch) >= 500:
+                bee.models.update_post_visibility(batch)
+                batch = list()
+        bee.models.update_post_visibility(batch)
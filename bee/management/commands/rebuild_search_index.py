@@ -0,0 +1,228 @@
+from datetime import datetime
+import json
+import multiprocessing
+from optparse import make_option
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+import haystack
+from haystack.query import SearchQuerySet
+
+import bee.models
+from bee.paging import CURSOR_TIME_FORMAT, posts_after
+
+
+class PreparedIndex(object):
+    """
+    Stands in for a search index whose documents were already prepared, so
+    the backend can be given the documents themselves instead of the posts.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def full_prepare(self, doc):
+        return doc
+
+
+def indexed_posts(author_pk, now):
+    index = haystack.site.get_index(bee.models.Post)
+    posts = index.index_queryset().filter(published__lte=now)
+    if author_pk is not None:
+        posts = posts.filter(author=author_pk)
+    return posts
+
+
+def encode_position(published, post_pk):
+    return [published.strftime(CURSOR_TIME_FORMAT), post_pk]
+
+
+def decode_position(position):
+    published, post_pk = position
+    return datetime.strptime(published, CURSOR_TIME_FORMAT), post_pk
+
+
+def prepare_batch(args):
+    """
+    Render the search documents for the posts in one batch's range of
+    `(published, id)` positions, after `start` (if any) through `end`.
+    """
+    number, author_pk, now, start, end = args
+    began = time.time()
+    index = haystack.site.get_index(bee.models.Post)
+
+    posts = indexed_posts(author_pk, datetime.strptime(now, CURSOR_TIME_FORMAT))
+    if start is not None:
+        posts = posts_after(posts, *decode_position(start))
+    end_published, end_pk = decode_position(end)
+    posts = posts.filter(Q(published__lt=end_published) | Q(published=end_published, id__lte=end_pk),
+        published__lte=end_published)
+    posts = posts.select_related('author').order_by('published', 'id')
+
+    docs = [index.full_prepare(post) for post in posts.iterator()]
+    return number, docs, time.time() - began
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the search index of posts, rendering their documents in parallel. Rerun to resume after an interruption."
+    option_list = BaseCommand.option_list + (
+        make_option('--author',
+            metavar='USERNAME',
+            help='Only reindex the posts of this author (default: all authors)',
+        ),
+        make_option('--batch-size',
+            type='int',
+            default=500,
+            help='How many posts to render and send to the search backend at a time (default: 500)',
+        ),
+        make_option('--workers',
+            type='int',
+            default=multiprocessing.cpu_count(),
+            help='How many processes to render documents in (default: one per CPU)',
+        ),
+        make_option('--state-file',
+            default='rebuild_search_index.json',
+            help='Where to keep track of the finished batches, for resuming (default: rebuild_search_index.json)',
+        ),
+        make_option('--restart',
+            action='store_true',
+            default=False,
+            help='Start over, ignoring the progress kept in the state file',
+        ),
+    )
+
+    def plan_batches(self, author_pk, batch_size):
+        """
+        Split the posts to index into batches of `(published, id)` ranges,
+        returning the state of a rebuild that has finished none of them.
+        """
+        now = datetime.utcnow()
+        positions = indexed_posts(author_pk, now).order_by('published', 'id').values_list('published', 'id')
+
+        batches = list()
+        start = last = None
+        count = 0
+        for published, post_pk in positions.iterator():
+            last = encode_position(published, post_pk)
+            count += 1
+            if count == batch_size:
+                batches.append([start, last])
+                start, count = last, 0
+        if count:
+            batches.append([start, last])
+
+        return {
+            'author': author_pk,
+            'batch_size': batch_size,
+            'now': now.strftime(CURSOR_TIME_FORMAT),
+            'batches': batches,
+            'done': [],
+        }
+
+    def clear_index(self, index, author_pk):
+        """
+        Remove the posts' documents from the index, or only the given
+        author's, so posts deleted or hidden since they were indexed don't
+        linger after the rebuild.
+        """
+        if author_pk is None:
+            index.backend.clear(models=[bee.models.Post])
+            return
+        # Find them all before removing any, so removing doesn't shift the search's pages.
+        results = SearchQuerySet().models(bee.models.Post).filter(author_pk=author_pk)
+        identifiers = ['%s.%s.%s' % (result.app_label, result.model_name, result.pk) for result in results]
+        for identifier in identifiers:
+            index.backend.remove(identifier)
+
+    def save_state(self, path, state):
+        # Write a new file and move it into place, so an interruption never leaves a partial one.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, path)
+
+    def load_state(self, path, author_pk, batch_size):
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except IOError:
+            return None
+
+        if state['author'] != author_pk or state['batch_size'] != batch_size:
+            raise CommandError("State file %s is for a different rebuild; use --restart to start over" % path)
+        return state
+
+    def handle(self, **options):
+        author_pk = None
+        if options.get('author'):
+            author_pk = User.objects.get(username=options['author']).pk
+        batch_size = options['batch_size']
+        state_path = options['state_file']
+
+        index = haystack.site.get_index(bee.models.Post)
+        prepared_index = PreparedIndex(index)
+
+        state = None if options['restart'] else self.load_state(state_path, author_pk, batch_size)
+        if state is None:
+            state = self.plan_batches(author_pk, batch_size)
+            # Clear before saving the state, so a resumed rebuild never clears the batches it already did.
+            self.clear_index(index, author_pk)
+            self.save_state(state_path, state)
+        elif state['done']:
+            self.stdout.write('resuming with %d of %d batches done\n' % (len(state['done']), len(state['batches'])))
+
+        done = set(state['done'])
+        todo = [(number, author_pk, state['now'], start, end)
+            for number, (start, end) in enumerate(state['batches']) if number not in done]
+
+        pool = None
+        if options['workers'] > 1 and len(todo) > 1:
+            # Don't share our database connection with the workers; they each open their own.
+            connection.close()
+            pool = multiprocessing.Pool(options['workers'])
+            prepared_batches = pool.imap_unordered(prepare_batch, todo)
+        else:
+            prepared_batches = (prepare_batch(args) for args in todo)
+
+        began = time.time()
+        indexed = 0
+        finished = False
+        try:
+            for number, docs, render_time in prepared_batches:
+                batch_began = time.time()
+                if docs:
+                    index.backend.update(prepared_index, docs)
+                commit_time = time.time() - batch_began
+
+                state['done'].append(number)
+                self.save_state(state_path, state)
+
+                indexed += len(docs)
+                self.stdout.write('batch %d (%d/%d): %d posts, rendered in %.1f s (%.0f posts/s), indexed in %.1f s (%.0f posts/s)\n'
+                    % (number + 1, len(state['done']), len(state['batches']), len(docs),
+                       render_time, len(docs) / render_time if render_time else 0,
+                       commit_time, len(docs) / commit_time if commit_time else 0))
+            finished = True
+        except KeyboardInterrupt:
+            raise CommandError("Interrupted with %d of %d batches done; run again to resume"
+                % (len(state['done']), len(state['batches'])))
+        finally:
+            if pool is not None:
+                # However the rebuild stopped early, don't leave the workers rendering batches no one will index.
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
+        elapsed = time.time() - began
+        self.stdout.write('indexed %d posts in %.1f s (%.0f posts/s)\n' % (indexed, elapsed, indexed / elapsed if elapsed else 0))
+        os.remove(state_path)
@@ -1,13 +1,27 @@
 from datetime import datetime, timedelta
+from hashlib import sha1
 import logging
+import threading
 import time
+from urlparse import urlsplit, urlunsplit
 
+from BeautifulSoup import BeautifulSoup
+from django.contrib.auth.models import User
 from django.contrib.comments.moderation import CommentModerator, moderator
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Q
+import django.db.models.signals
 import djcelery
 import south
 from south.modelsinspector import add_introspection_rules
+from social_auth.models import UserSocialAuth
 from taggit.managers import TaggableManager
+from taggit.models import Tag, TaggedItem
+
+from bee.comments.models import PostComment
 
 
 add_introspection_rules([], [r'^social_auth\.fields\.JSONField'])
@@ -15,6 +29,38 @@ add_introspection_rules([], [r'^social_auth\.fields\.JSONField'])
 djcelery.setup_loader()
 
 
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def new_generation():
+    # Start counters at the time in microseconds rather than at 1, so a
+    # counter that was evicted and started again can't repeat the numbers
+    # it had before, and things kept at an old number can't match it again.
+    return int(time.time() * 1000000)
+
+
+def bump_generation(key):
+    """Increment the shared cache counter `key`, starting it if it's missing."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = new_generation()
+        cache.set(key, generation, GENERATION_TIMEOUT)
+        return generation
+
+
+def current_generation(key):
+    """
+    Return the shared cache counter `key`, starting it if it's missing, or
+    None if the cache won't keep it.
+    """
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, new_generation(), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
 class Avatar(models.Model):
 
     user = models.ForeignKey('auth.User', related_name='avatars')
@@ -64,9 +110,17 @@ class Post(models.Model):
 
     @property
     def permalink(self):
-        return 'http://%s/%s' % (self.author.authorsite_set.get().site.domain, self.slug)
+        return permalink_for(self.author_id, self.slug)
+
+    def visible_to(self, viewer, trust_group_pks=None):
+        """
+        Return whether the given user can see this post.
 
-    def visible_to(self, viewer):
+        If the PKs of the author's trust groups the viewer is a member of are
+        already known, pass them as `trust_group_pks` to check them against
+        this post's groups instead of asking the database about the viewer.
+
+        """
         logging.debug("Is post %r visible to user %r?", self, viewer)
         if not self.private:
             logging.debug("    Post is not private, so it's visible")
@@ -74,27 +128,173 @@ class Post(models.Model):
         if not viewer.is_authenticated():
             logging.debug("    Post is private but viewer is anonymous, so it's NOT visible")
             return False
-        if self.author.pk == viewer.pk:
+        if self.author_id == viewer.pk:
             logging.debug("    Post is private but viewer is the author, so it's visible")
             return True
-        if self.private_to.filter(members__user=viewer).exists():
+        if trust_group_pks is not None:
+            shared = bool(trust_group_pks) and bool(trust_group_pks & set(self.private_to.values_list('pk', flat=True)))
+        else:
+            shared = self.visibilities.filter(viewer=viewer).exists()
+        if shared:
             logging.debug("    Post is private but it's shared to a group that contains the viewer, so it's visible")
             return True
         logging.debug("    Post is private and not shared to the viewer, so it's NOT visible")
         return False
 
+    def __init__(self, *args, **kwargs):
+        super(Post, self).__init__(*args, **kwargs)
+        self.remember_saved_state()
+
+    def remember_saved_state(self):
+        # Keep what was last loaded or saved, so signal handlers can tell
+        # what a save changed. Read the instance dict directly so deferred
+        # fields aren't loaded just for this.
+        self.saved_private = self.__dict__.get('private')
+        self.saved_published = self.__dict__.get('published')
+        self.saved_title = self.__dict__.get('title')
+        self.saved_html = self.__dict__.get('html')
+
     def __unicode__(self):
         return self.title or self.slug
 
     def save(self, *args, **kwargs):
         if len(self.slug) > 80:
             self.slug = self.slug[:80]
+        # Validators and cached feed entries are keyed on this, so keep it current however the post is saved.
+        self.modified = datetime.utcnow()
         super(Post, self).save(*args, **kwargs)
+        self.remember_saved_state()
 
     class Meta:
         unique_together = (('author', 'slug'),)
 
 
+def touch_post_for_tagged_item(sender, instance, **kwargs):
+    # Tags are saved apart from their post, so mark the post modified too.
+    if instance.content_type_id != ContentType.objects.get_for_model(Post).pk:
+        return
+    Post.objects.filter(pk=instance.object_id).update(modified=datetime.utcnow())
+
+
+django.db.models.signals.post_save.connect(touch_post_for_tagged_item, sender=TaggedItem)
+django.db.models.signals.post_delete.connect(touch_post_for_tagged_item, sender=TaggedItem)
+
+
+class PostVisibility(models.Model):
+
+    """
+    A viewer who can see a private post because it's shared to a trust group
+    they're a member of.
+
+    These rows are kept up to date from `Post.private`, `Post.private_to` and
+    `TrustGroup.members` by the signal handlers below, so finding the private
+    posts someone can see is one indexed lookup instead of a join through
+    trust groups and social auths (and can't yield the same post twice).
+
+    """
+
+    post = models.ForeignKey(Post, related_name='visibilities')
+    viewer = models.ForeignKey('auth.User', related_name='post_visibilities')
+
+    class Meta:
+        unique_together = (('viewer', 'post'),)
+
+
+TRUST_GROUP_GENERATION_KEY = 'bee:trustgroups:generation'
+
+
+def update_post_visibility(post_pks):
+    """Bring the `PostVisibility` rows for the posts with the given PKs up to date."""
+    post_pks = list(post_pks)
+    if not post_pks:
+        return
+
+    memberships = TrustGroup.members.through.objects.filter(trustgroup__post__in=post_pks,
+        trustgroup__post__private=True)
+    wanted = set(memberships.values_list('trustgroup__post', 'usersocialauth__user'))
+    existing = set(PostVisibility.objects.filter(post__in=post_pks).values_list('post', 'viewer'))
+
+    for post_pk, viewer_pk in existing - wanted:
+        PostVisibility.objects.filter(post=post_pk, viewer=viewer_pk).delete()
+    for post_pk, viewer_pk in wanted - existing:
+        PostVisibility.objects.create(post_id=post_pk, viewer_id=viewer_pk)
+
+
+def post_pks_for_trust_groups(group_pks):
+    return Post.objects.filter(private_to__in=group_pks).values_list('pk', flat=True).distinct()
+
+
+def post_pks_for_social_auth(social_auth_pk):
+    return Post.objects.filter(private_to__members=social_auth_pk).values_list('pk', flat=True).distinct()
+
+
+def update_visibility_for_saved_post(sender, instance, created, **kwargs):
+    if created or instance.private != instance.saved_private:
+        update_post_visibility([instance.pk])
+
+
+def update_visibility_for_post_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # Once they're cleared we can't tell which posts were involved.
+        if reverse:
+            instance.cleared_post_pks = list(instance.post_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        update_post_visibility([instance.pk])
+    elif action == 'post_clear':
+        update_post_visibility(getattr(instance, 'cleared_post_pks', ()))
+    else:
+        update_post_visibility(pk_set)
+
+
+def update_visibility_for_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance.cleared_post_pks = list(post_pks_for_social_auth(instance.pk))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    bump_generation(TRUST_GROUP_GENERATION_KEY)
+    if not reverse:
+        update_post_visibility(post_pks_for_trust_groups([instance.pk]))
+    elif action == 'post_clear':
+        update_post_visibility(getattr(instance, 'cleared_post_pks', ()))
+    else:
+        update_post_visibility(post_pks_for_trust_groups(pk_set))
+
+
+def remember_posts_for_deleted_group(sender, instance, **kwargs):
+    instance.deleted_post_pks = list(post_pks_for_trust_groups([instance.pk]))
+
+
+def remember_posts_for_deleted_social_auth(sender, instance, **kwargs):
+    instance.deleted_post_pks = list(post_pks_for_social_auth(instance.pk))
+
+
+def update_visibility_for_deleted(sender, instance, **kwargs):
+    bump_generation(TRUST_GROUP_GENERATION_KEY)
+    update_post_visibility(getattr(instance, 'deleted_post_pks', ()))
+
+
+def update_visibility_for_saved_social_auth(sender, instance, **kwargs):
+    bump_generation(TRUST_GROUP_GENERATION_KEY)
+    update_post_visibility(post_pks_for_social_auth(instance.pk))
+
+
+django.db.models.signals.post_save.connect(update_visibility_for_saved_post, sender=Post)
+django.db.models.signals.m2m_changed.connect(update_visibility_for_post_groups, sender=Post.private_to.through)
+django.db.models.signals.m2m_changed.connect(update_visibility_for_group_members, sender=TrustGroup.members.through)
+django.db.models.signals.pre_delete.connect(remember_posts_for_deleted_group, sender=TrustGroup)
+django.db.models.signals.post_delete.connect(update_visibility_for_deleted, sender=TrustGroup)
+django.db.models.signals.pre_delete.connect(remember_posts_for_deleted_social_auth, sender=UserSocialAuth)
+django.db.models.signals.post_delete.connect(update_visibility_for_deleted, sender=UserSocialAuth)
+django.db.models.signals.post_save.connect(update_visibility_for_saved_social_auth, sender=UserSocialAuth)
+
+
 class PostCommentModerator(CommentModerator):
 
     email_notification = True
@@ -135,6 +335,10 @@ class Asset(models.Model):
     posts = models.ManyToManyField(Post, blank=True)
     original_url = models.CharField(max_length=255, unique=True, blank=True, null=True)
 
+    def referencing_posts(self):
+        """Return the posts that link to or show this asset's file."""
+        return Post.objects.filter(links__url_hash=url_hash(self.sourcefile.url)).distinct()
+
 
 class PostLegacyUrl(models.Model):
 
@@ -153,13 +357,244 @@ class AuthorSite(models.Model):
     site = models.ForeignKey('sites.Site', unique=True)
 
 
-class Link404Result(models.Model):
+class AuthorSiteCache(object):
+
+    """
+    Process-wide map between site domains and their authors.
+
+    The map is loaded from the database the first time it's needed and thrown
+    away whenever an `AuthorSite` or `Site` is saved or deleted, or a `User`
+    with a site is deleted or saved with changes. The shared cache holds a
+    generation number too, so the other processes serving the same sites
+    notice the change on their next lookup.
+
+    """
+
+    generation_key = 'bee:authorsites:generation'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = None
+        self.generation = None
+
+    def shared_generation(self):
+        return cache.get(self.generation_key, 0)
+
+    def load(self):
+        generation = self.shared_generation()
+        maps = self.maps
+        if maps is not None and self.generation == generation:
+            return maps
 
-    post = models.ForeignKey(Post)
-    url = models.CharField(max_length=255)
-    status = models.IntegerField(blank=True)
+        with self.lock:
+            if self.maps is not None and self.generation == generation:
+                return self.maps
+
+            authors_by_domain = dict()
+            domains_by_author = dict()
+            for author_site in AuthorSite.objects.select_related('author', 'site'):
+                authors_by_domain[author_site.site.domain] = author_site.author
+                domains_by_author[author_site.author_id] = author_site.site.domain
+
+            maps = authors_by_domain, domains_by_author
+            self.maps, self.generation = maps, generation
+        return maps
+
+    def clear(self, **kwargs):
+        with self.lock:
+            self.maps = None
+        bump_generation(self.generation_key)
+
+    def clear_for_user(self, instance, **kwargs):
+        # Users are saved on every sign in to update last_login, so only
+        # clear when a user we hold has really changed.
+        if kwargs.get('created'):
+            return
+        maps = self.maps
+        if maps is None:
+            # Nothing to compare against, so only clear for authors with sites.
+            if not AuthorSite.objects.filter(author=instance.pk).exists():
+                return
+        else:
+            authors_by_domain, domains_by_author = maps
+            author = authors_by_domain.get(domains_by_author.get(instance.pk))
+            if author is None:
+                return
+            if all(getattr(author, field.attname) == getattr(instance, field.attname)
+                   for field in User._meta.fields if field.attname != 'last_login'):
+                return
+        self.clear()
+
+    def author_for_domain(self, domain):
+        authors_by_domain, domains_by_author = self.load()
+        return authors_by_domain.get(domain)
+
+    def domain_for_author(self, author_pk):
+        authors_by_domain, domains_by_author = self.load()
+        return domains_by_author.get(author_pk)
+
+
+author_sites = AuthorSiteCache()
+
+
+def permalink_for(author_pk, slug):
+    """
+    Return the permalink for the post with the given slug by the given author,
+    without loading the post or its author, or None if the author has no site.
+    """
+    domain = author_sites.domain_for_author(author_pk)
+    if domain is None:
+        return None
+    return 'http://%s/%s' % (domain, slug)
+
+for model in (AuthorSite, Site):
+    django.db.models.signals.post_save.connect(author_sites.clear, sender=model, dispatch_uid='bee.author_sites')
+    django.db.models.signals.post_delete.connect(author_sites.clear, sender=model, dispatch_uid='bee.author_sites')
+django.db.models.signals.post_save.connect(author_sites.clear_for_user, sender=User, dispatch_uid='bee.author_sites')
+django.db.models.signals.post_delete.connect(author_sites.clear, sender=User, dispatch_uid='bee.author_sites')
+
+
+def url_hash(url):
+    return sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+
+
+def normalized_host(url):
+    """Return the lowercased host of `url` with any default port removed, or '' for a relative URL."""
+    parts = urlsplit(url)
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and (parts.scheme, port) not in (('http', 80), ('https', 443)):
+        host = '%s:%d' % (host, port)
+    return host
+
+
+def links_in_html(html):
+    """
+    Return the set of `(url, kind)` pairs of the `<a href>` and `<img src>`
+    links in the given HTML, with the URLs as written but without fragments.
+    """
+    links = set()
+    for el in BeautifulSoup(html).findAll(['a', 'img']):
+        url = el.get('href' if el.name == 'a' else 'src')
+        if not url or not url.strip():
+            continue
+        parts = urlsplit(url.strip())
+        # The fragment is never sent, so links to different parts of a page are one URL.
+        links.add((urlunsplit((parts.scheme, parts.netloc, parts.path, parts.query, '')), el.name))
+    return links
+
+
+class PostLink(models.Model):
+
+    """
+    A link in a post, kept up to date whenever the post is saved, so links
+    can be found without parsing every post's HTML.
+
+    `url` is the URL as written in the post, which may be relative, and `host`
+    is its normalized host ('' for relative URLs).
+
+    """
+
+    LINK_KINDS = (
+        ('a', 'link'),
+        ('img', 'image'),
+    )
+
+    post = models.ForeignKey(Post, related_name='links')
+    url = models.TextField()
+    url_hash = models.CharField(max_length=40, db_index=True)
+    kind = models.CharField(max_length=3, choices=LINK_KINDS)
+    host = models.CharField(max_length=255, blank=True, db_index=True)
+
+    class Meta:
+        unique_together = (('post', 'url_hash', 'kind'),)
+
+
+def update_post_links(post_pk, html):
+    """Make the post's `PostLink`s match the links in its HTML, changing only the ones that differ."""
+    wanted = dict(((url_hash(url), kind), url) for url, kind in links_in_html(html))
+    existing = dict(((link_hash, kind), pk) for pk, link_hash, kind
+        in PostLink.objects.filter(post=post_pk).values_list('pk', 'url_hash', 'kind'))
+
+    stale = [pk for key, pk in existing.iteritems() if key not in wanted]
+    if stale:
+        PostLink.objects.filter(pk__in=stale).delete()
+    for key in set(wanted).difference(existing):
+        link_hash, kind = key
+        url = wanted[key]
+        PostLink.objects.create(post_id=post_pk, url=url, url_hash=link_hash, kind=kind, host=normalized_host(url)[:255])
+
+
+def posts_linking_to(url):
+    """
+    Return the posts that link to the given absolute URL, including through
+    root-relative links in posts on the site the URL is on.
+    """
+    parts = urlsplit(url)
+    host = normalized_host(url)
+    links = Q(host=host, url_hash=url_hash(urlunsplit((parts.scheme, parts.netloc, parts.path, parts.query, ''))))
+    author = author_sites.author_for_domain(host)
+    if author is not None:
+        path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        links |= Q(host='', url_hash=url_hash(path), post__author=author.pk)
+    return Post.objects.filter(pk__in=PostLink.objects.filter(links).values('post'))
+
+
+def update_links_for_saved_post(sender, instance, created, **kwargs):
+    if created or instance.html != instance.saved_html:
+        update_post_links(instance.pk, instance.html)
+
+
+django.db.models.signals.post_save.connect(update_links_for_saved_post, sender=Post)
+
+
+class LinkCheck(models.Model):
+
+    """
+    The state of checking a URL that posts link to.
+
+    There's one per URL however many posts link to it, found by `url_hash`,
+    the SHA-1 of the URL, since URLs can be too long to index. `status` and
+    `error` are from the last check; `failures` is how many checks in a row
+    have found the link not working, and `next_check` is when it's stale
+    enough to check again. Older results are kept as `LinkCheckResult`s.
+
+    """
+
+    url = models.TextField()
+    url_hash = models.CharField(max_length=40, unique=True)
+    status = models.IntegerField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    checked = models.DateTimeField(blank=True, null=True)
+    failures = models.PositiveIntegerField(default=0)
+    next_check = models.DateTimeField(blank=True, null=True, db_index=True)
+    posts = models.ManyToManyField(Post, related_name='link_checks')
+
+
+class LinkCheckResult(models.Model):
+
+    """One of the last few results of checking a `LinkCheck`'s URL."""
+
+    link_check = models.ForeignKey(LinkCheck, related_name='results')
+    status = models.IntegerField()
     error = models.TextField(blank=True, null=True)
-    requested = models.DateTimeField(default=datetime.utcnow)
+    checked = models.DateTimeField()
+
+
+class LinkHost(models.Model):
+
+    """
+    A host that links point to, for backing off from checking links on hosts
+    that keep failing. `failures` is how many checks in a row the host
+    didn't answer properly, and its links aren't checked until `retry_after`.
+    """
+
+    host = models.CharField(max_length=255, unique=True)
+    failures = models.PositiveIntegerField(default=0)
+    retry_after = models.DateTimeField(blank=True, null=True)
 
 
 class Template(models.Model):
@@ -175,3 +610,478 @@ class Template(models.Model):
 
     class Meta:
         unique_together = (('author', 'purpose'),)
+
+
+def page_generation_key(author_pk):
+    return 'bee:pages:%d:generation' % author_pk
+
+
+def range_page_generation_key(author_pk, year, month=None):
+    if month is None:
+        return 'bee:pages:%d:%04d:generation' % (author_pk, year)
+    return 'bee:pages:%d:%04d-%02d:generation' % (author_pk, year, month)
+
+
+def expire_range_pages(author_pk, published):
+    """Expire the author's year and month pages that show posts published at `published`."""
+    bump_generation(range_page_generation_key(author_pk, published.year))
+    bump_generation(range_page_generation_key(author_pk, published.year, published.month))
+
+
+def expire_pages_for_post(sender, instance, **kwargs):
+    bump_generation(page_generation_key(instance.author_id))
+    expire_range_pages(instance.author_id, instance.published)
+    saved_published = getattr(instance, 'saved_published', None)
+    if saved_published is not None and (saved_published.year, saved_published.month) != (instance.published.year, instance.published.month):
+        expire_range_pages(instance.author_id, saved_published)
+
+
+def expire_pages_for_post_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    bump_generation(page_generation_key(instance.user_id if reverse else instance.author_id))
+
+
+def expire_pages_for_comment(sender, instance, **kwargs):
+    if instance.content_type_id != ContentType.objects.get_for_model(Post).pk:
+        return
+    try:
+        author_pk, published = Post.objects.filter(pk=instance.object_pk).values_list('author', 'published').get()
+    except (Post.DoesNotExist, ValueError):
+        return
+    bump_generation(page_generation_key(author_pk))
+    expire_range_pages(author_pk, published)
+
+
+django.db.models.signals.post_save.connect(expire_pages_for_post, sender=Post)
+django.db.models.signals.post_delete.connect(expire_pages_for_post, sender=Post)
+django.db.models.signals.m2m_changed.connect(expire_pages_for_post_groups, sender=Post.private_to.through)
+django.db.models.signals.post_save.connect(expire_pages_for_comment, sender=PostComment)
+django.db.models.signals.post_delete.connect(expire_pages_for_comment, sender=PostComment)
+
+
+class FeedArchivePage(models.Model):
+
+    """
+    A stored RFC 5005 archive page of an author's feed for a visibility class,
+    holding the posts after the `(after_published, after_id)` position.
+    """
+
+    author = models.ForeignKey('auth.User', related_name='feed_archive_pages')
+    visibility = models.CharField(max_length=20)
+    after_published = models.DateTimeField(blank=True, null=True)
+    after_id = models.IntegerField(blank=True, null=True)
+    last_published = models.DateTimeField()
+    full = models.BooleanField(blank=True, default=False)
+    body = models.TextField()
+    generated = models.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        unique_together = (('author', 'visibility', 'after_published', 'after_id'),)
+
+
+def expire_feed_archive_pages_from(author_pk, published):
+    """Forget the author's stored archive pages holding any posts published at or after `published`."""
+    FeedArchivePage.objects.filter(author=author_pk, last_published__gte=published).delete()
+
+
+def expire_feed_archive_pages_for_saved_post(sender, instance, created, **kwargs):
+    # The saved date isn't known if the post was loaded without it.
+    saved_published = getattr(instance, 'saved_published', None) or instance.published
+    if created:
+        expire_feed_archive_pages_from(instance.author_id, instance.published)
+    elif instance.private != getattr(instance, 'saved_private', None) or instance.published != saved_published:
+        # The post moved in or out of place, so every page after its old or new place is different.
+        expire_feed_archive_pages_from(instance.author_id, min(instance.published, saved_published))
+    else:
+        # Only the page holding the post has changed.
+        pages = FeedArchivePage.objects.filter(author=instance.author_id, last_published__gte=instance.published)
+        pages.filter(models.Q(after_published__lte=instance.published) | models.Q(after_published=None)).delete()
+
+
+def expire_feed_archive_pages_for_deleted_post(sender, instance, **kwargs):
+    expire_feed_archive_pages_from(instance.author_id, instance.published)
+
+
+django.db.models.signals.post_save.connect(expire_feed_archive_pages_for_saved_post, sender=Post)
+django.db.models.signals.post_delete.connect(expire_feed_archive_pages_for_deleted_post, sender=Post)
+
+
+class PostDayCount(models.Model):
+
+    """
+    How many of an author's posts of one visibility class were published on
+    one day, for drawing the archive calendar without grouping the posts.
+
+    A post's visibility class is `public`, or `private:` followed by the PKs
+    of the trust groups it's shared to. Each post counts toward exactly one
+    class, so a viewer's count for a day is the sum of the classes they can
+    see.
+
+    """
+
+    author = models.ForeignKey('auth.User', related_name='post_day_counts')
+    day = models.DateField()
+    visibility = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('author', 'day', 'visibility'),)
+
+
+def day_count_visibility(private, group_pks):
+    """Return the `PostDayCount` visibility class of a post with the given privacy and trust groups."""
+    if not private:
+        return 'public'
+    return 'private:%s' % ','.join(str(group_pk) for group_pk in sorted(group_pks))
+
+
+def day_count_visible_to(visibility, trust_group_pks):
+    """Return whether a viewer in the trust groups with the given PKs can see posts of the given visibility class."""
+    if visibility == 'public':
+        return True
+    group_pks = visibility.split(':', 1)[1]
+    return bool(group_pks) and bool(trust_group_pks & set(int(group_pk) for group_pk in group_pks.split(',')))
+
+
+def visibilities_visible_to(rows, trust_group_pks):
+    """
+    Return the visibility classes among the given queryset of rows with a
+    `visibility` field, such as an author's `PostDayCount` or
+    `SearchSuggestion` rows, that a viewer in the trust groups with the given
+    PKs can see.
+    """
+    if not trust_group_pks:
+        return ['public']
+    visibilities = rows.values_list('visibility', flat=True).distinct()
+    return [visibility for visibility in visibilities if day_count_visible_to(visibility, trust_group_pks)]
+
+
+def visibility_classes(posts):
+    """Return a dict of the visibility classes of the given posts by their PKs."""
+    privacy = dict(posts.values_list('pk', 'private'))
+
+    group_pks = dict((post_pk, set()) for post_pk in privacy)
+    if privacy:
+        memberships = Post.private_to.through.objects.filter(post__in=privacy.keys())
+        for post_pk, group_pk in memberships.values_list('post', 'trustgroup'):
+            group_pks[post_pk].add(group_pk)
+
+    return dict((post_pk, day_count_visibility(private, group_pks[post_pk])) for post_pk, private in privacy.iteritems())
+
+
+def recount_post_days(author_pk, days):
+    """Bring the author's `PostDayCount` rows for the given days up to date."""
+    for day in set(days):
+        start = datetime(day.year, day.month, day.day)
+        posts = Post.objects.filter(author=author_pk, published__gte=start, published__lt=start + timedelta(days=1))
+
+        wanted = dict()
+        for visibility in visibility_classes(posts).itervalues():
+            wanted[visibility] = wanted.get(visibility, 0) + 1
+
+        existing = PostDayCount.objects.filter(author=author_pk, day=day)
+        existing.exclude(visibility__in=wanted.keys()).delete()
+        for visibility, count in wanted.iteritems():
+            updated = existing.filter(visibility=visibility).update(count=count)
+            if not updated:
+                PostDayCount.objects.create(author_id=author_pk, day=day, visibility=visibility, count=count)
+
+
+def recount_days_for_post_pks(post_pks):
+    post_pks = list(post_pks)
+    if not post_pks:
+        return
+    days_by_author = dict()
+    for author_pk, published in Post.objects.filter(pk__in=post_pks).values_list('author', 'published'):
+        days_by_author.setdefault(author_pk, set()).add(published.date())
+    for author_pk, days in days_by_author.iteritems():
+        recount_post_days(author_pk, days)
+
+
+def recount_days_for_saved_post(sender, instance, created, **kwargs):
+    if created:
+        recount_post_days(instance.author_id, [instance.published.date()])
+    elif instance.private != instance.saved_private or instance.published != instance.saved_published:
+        days = [instance.published.date()]
+        if instance.saved_published is not None:
+            days.append(instance.saved_published.date())
+        recount_post_days(instance.author_id, days)
+
+
+def recount_days_for_deleted_post(sender, instance, **kwargs):
+    recount_post_days(instance.author_id, [instance.published.date()])
+
+
+def recount_days_for_post_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance.cleared_day_post_pks = list(instance.post_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        recount_post_days(instance.author_id, [instance.published.date()])
+    elif action == 'post_clear':
+        recount_days_for_post_pks(getattr(instance, 'cleared_day_post_pks', ()))
+    else:
+        recount_days_for_post_pks(pk_set)
+
+
+def recount_days_for_deleted_group(sender, instance, **kwargs):
+    recount_days_for_post_pks(getattr(instance, 'deleted_post_pks', ()))
+
+
+django.db.models.signals.post_save.connect(recount_days_for_saved_post, sender=Post)
+django.db.models.signals.post_delete.connect(recount_days_for_deleted_post, sender=Post)
+django.db.models.signals.m2m_changed.connect(recount_days_for_post_groups, sender=Post.private_to.through)
+django.db.models.signals.post_delete.connect(recount_days_for_deleted_group, sender=TrustGroup)
+
+
+class PendingIndexUpdate(models.Model):
+
+    """
+    A post whose search index entry needs updating once it's `due`.
+
+    There's at most one per post, so a post changed several times before the
+    queue is drained is only indexed once. The post is referenced by PK alone
+    so the update outlives the post being deleted.
+
+    """
+
+    post_pk = models.IntegerField(unique=True)
+    due = models.DateTimeField(default=datetime.utcnow, db_index=True)
+
+
+class SyndicationOutbox(models.Model):
+
+    """
+    A post to send to another site, the `target`, once it's `due`.
+
+    There's one per post and target, so saving a post again doesn't send it
+    twice. A failed send is tried again later, counting its `attempts`, until
+    it's `sent`, given up on as `failed`, or `skipped` because the post is no
+    longer wanted there.
+
+    """
+
+    OUTBOX_STATES = (
+        ('pending', 'pending'),
+        ('sent', 'sent'),
+        ('skipped', 'skipped'),
+        ('failed', 'failed'),
+    )
+
+    post = models.ForeignKey(Post, related_name='syndications')
+    target = models.CharField(max_length=30)
+    state = models.CharField(max_length=20, choices=OUTBOX_STATES, default='pending')
+    due = models.DateTimeField(default=datetime.utcnow, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    remote_id = models.CharField(max_length=255, blank=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (('post', 'target'),)
+
+
+class BulkJob(models.Model):
+
+    """
+    A task mapped over all of an author's posts, a chunk of post PKs at a time.
+
+    The `callback` task is called with each chunk's list of post PKs followed
+    by the JSON encoded `args`. Chunks are taken in PK order, so `last_post_pk`
+    is where the next chunk starts. A job that's no longer `running` isn't
+    given any more chunks.
+
+    """
+
+    JOB_STATES = (
+        ('running', 'running'),
+        ('done', 'done'),
+        ('cancelled', 'cancelled'),
+        ('failed', 'failed'),
+    )
+
+    author = models.ForeignKey('auth.User', related_name='bulk_jobs')
+    callback = models.CharField(max_length=255)
+    args = models.TextField(default='[]')
+    chunk_size = models.PositiveIntegerField(default=100)
+    state = models.CharField(max_length=20, choices=JOB_STATES, default='running')
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    last_post_pk = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(default=datetime.utcnow)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u'%s for %s' % (self.callback, self.author)
+
+    def cancel(self):
+        """Stop giving the job chunks of posts, if it's still running."""
+        now = datetime.utcnow()
+        if BulkJob.objects.filter(pk=self.pk, state='running').update(state='cancelled', finished=now):
+            self.state, self.finished = 'cancelled', now
+
+
+class SearchSuggestion(models.Model):
+
+    """
+    A post title or tag the search box can suggest to viewers of an author's
+    posts of one visibility class (as for `PostDayCount`).
+
+    `key` is the lowercased text, so the suggestions for what the viewer has
+    typed so far are a range of the index on `(author, visibility, key)`.
+    Titles get a suggestion for each word they have, so they can be found by
+    any word in them. `published` is when the suggestion's first post was, so
+    scheduled posts aren't suggested early.
+
+    """
+
+    author = models.ForeignKey('auth.User', related_name='search_suggestions')
+    visibility = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)
+    text = models.CharField(max_length=255)
+    post = models.ForeignKey(Post, null=True, related_name='search_suggestions')
+    tag = models.ForeignKey(Tag, null=True, related_name='search_suggestions')
+    count = models.PositiveIntegerField(default=1)
+    published = models.DateTimeField()
+
+
+SUGGESTION_TITLE_WORDS = 8
+
+
+def suggestion_key(text):
+    return u' '.join(text.lower().split())[:255]
+
+
+def title_suggestion_keys(title):
+    """Return the keys for suggesting the given title: the rest of it from each of its first few words."""
+    words = title.lower().split()
+    return [suggestion_key(u' '.join(words[i:])) for i in range(min(len(words), SUGGESTION_TITLE_WORDS))]
+
+
+def update_title_suggestions(post_pks):
+    """Bring the title `SearchSuggestion` rows for the posts with the given PKs up to date."""
+    post_pks = list(post_pks)
+    if not post_pks:
+        return
+    posts = Post.objects.filter(pk__in=post_pks)
+    visibilities = visibility_classes(posts)
+
+    SearchSuggestion.objects.filter(post__in=post_pks).delete()
+    for post_pk, author_pk, title, published in posts.values_list('pk', 'author', 'title', 'published'):
+        for key in title_suggestion_keys(title):
+            SearchSuggestion.objects.create(author_id=author_pk, visibility=visibilities[post_pk], key=key,
+                text=title[:255], post_id=post_pk, published=published)
+
+
+def recount_tag_suggestions(author_pk, tag_pks):
+    """Bring the author's tag `SearchSuggestion` rows for the tags with the given PKs up to date."""
+    tag_pks = set(tag_pks)
+    if not tag_pks:
+        return
+    tagged = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Post), tag__in=tag_pks,
+        object_id__in=Post.objects.filter(author=author_pk).values('pk'))
+    tags_by_post = dict()
+    for post_pk, tag_pk in tagged.values_list('object_id', 'tag'):
+        tags_by_post.setdefault(post_pk, set()).add(tag_pk)
+
+    posts = Post.objects.filter(pk__in=tags_by_post.keys())
+    visibilities = visibility_classes(posts)
+    wanted = dict()
+    for post_pk, published in posts.values_list('pk', 'published'):
+        for tag_pk in tags_by_post[post_pk]:
+            count, first_published = wanted.get((tag_pk, visibilities[post_pk]), (0, published))
+            wanted[tag_pk, visibilities[post_pk]] = (count + 1, min(first_published, published))
+
+    names = dict(Tag.objects.filter(pk__in=tag_pks).values_list('pk', 'name'))
+    existing = SearchSuggestion.objects.filter(author=author_pk, tag__in=tag_pks)
+    for tag_pk in tag_pks:
+        visibilities = [visibility for wanted_tag_pk, visibility in wanted if wanted_tag_pk == tag_pk]
+        existing.filter(tag=tag_pk).exclude(visibility__in=visibilities).delete()
+        for visibility in visibilities:
+            count, published = wanted[tag_pk, visibility]
+            updated = existing.filter(tag=tag_pk, visibility=visibility).update(count=count, published=published)
+            if not updated:
+                SearchSuggestion.objects.create(author_id=author_pk, visibility=visibility, key=suggestion_key(names[tag_pk]),
+                    text=names[tag_pk][:255], tag_id=tag_pk, count=count, published=published)
+
+
+def update_suggestions_for_post_pks(post_pks):
+    """Bring the title and tag `SearchSuggestion` rows for the posts with the given PKs up to date."""
+    post_pks = list(post_pks)
+    if not post_pks:
+        return
+    update_title_suggestions(post_pks)
+
+    authors = dict(Post.objects.filter(pk__in=post_pks).values_list('pk', 'author'))
+    tagged = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Post), object_id__in=authors.keys())
+    tags_by_author = dict()
+    for post_pk, tag_pk in tagged.values_list('object_id', 'tag'):
+        tags_by_author.setdefault(authors[post_pk], set()).add(tag_pk)
+    for author_pk, tag_pks in tags_by_author.iteritems():
+        recount_tag_suggestions(author_pk, tag_pks)
+
+
+def update_suggestions_for_saved_post(sender, instance, created, **kwargs):
+    if not created and (instance.private != instance.saved_private or instance.published != instance.saved_published):
+        update_suggestions_for_post_pks([instance.pk])
+    elif created or instance.title != instance.saved_title:
+        update_title_suggestions([instance.pk])
+
+
+def remember_tags_for_deleted_post(sender, instance, **kwargs):
+    instance.deleted_tag_pks = list(instance.tags.values_list('pk', flat=True))
+
+
+def recount_tag_suggestions_for_deleted_post(sender, instance, **kwargs):
+    recount_tag_suggestions(instance.author_id, getattr(instance, 'deleted_tag_pks', ()))
+
+
+def update_suggestions_for_post_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance.cleared_suggestion_post_pks = list(instance.post_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        update_suggestions_for_post_pks([instance.pk])
+    elif action == 'post_clear':
+        update_suggestions_for_post_pks(getattr(instance, 'cleared_suggestion_post_pks', ()))
+    else:
+        update_suggestions_for_post_pks(pk_set)
+
+
+def update_suggestions_for_deleted_group(sender, instance, **kwargs):
+    update_suggestions_for_post_pks(getattr(instance, 'deleted_post_pks', ()))
+
+
+def recount_tag_suggestions_for_tagged_item(sender, instance, **kwargs):
+    if instance.content_type_id != ContentType.objects.get_for_model(Post).pk:
+        return
+    try:
+        author_pk = Post.objects.filter(pk=instance.object_id).values_list('author', flat=True).get()
+    except Post.DoesNotExist:
+        return
+    recount_tag_suggestions(author_pk, [instance.tag_id])
+
+
+def rename_tag_suggestions(sender, instance, created, **kwargs):
+    if not created:
+        SearchSuggestion.objects.filter(tag=instance).update(key=suggestion_key(instance.name), text=instance.name[:255])
+
+
+django.db.models.signals.post_save.connect(update_suggestions_for_saved_post, sender=Post)
+django.db.models.signals.pre_delete.connect(remember_tags_for_deleted_post, sender=Post)
+django.db.models.signals.post_delete.connect(recount_tag_suggestions_for_deleted_post, sender=Post)
+django.db.models.signals.m2m_changed.connect(update_suggestions_for_post_groups, sender=Post.private_to.through)
+django.db.models.signals.post_delete.connect(update_suggestions_for_deleted_group, sender=TrustGroup)
+django.db.models.signals.post_save.connect(recount_tag_suggestions_for_tagged_item, sender=TaggedItem)
+django.db.models.signals.post_delete.connect(recount_tag_suggestions_for_tagged_item, sender=TaggedItem)
+django.db.models.signals.post_save.connect(rename_tag_suggestions, sender=Tag)
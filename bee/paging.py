@@ -0,0 +1,75 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from django.db.models import Q
+
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def encode_cursor(author_pk, published, post_pk):
+    """
+    Return an opaque URL-safe token marking the `(published, id)` position
+    of a post in the given author's stream.
+    """
+    raw = '%d.%s.%d' % (author_pk, published.strftime(CURSOR_TIME_FORMAT), post_pk)
+    return urlsafe_b64encode(raw).rstrip('=')
+
+
+def cursor_for_post(post):
+    return encode_cursor(post.author_id, post.published, post.pk)
+
+
+def decode_cursor(token, author_pk):
+    """
+    Return the `(published, id)` position marked by the given cursor token.
+
+    Raises `BadCursor` if the token is malformed or was made for a different
+    author's stream.
+    """
+    try:
+        token = str(token)
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor_author, published, post_pk = raw.split('.')
+        cursor_author, post_pk = int(cursor_author), int(post_pk)
+        published = datetime.strptime(published, CURSOR_TIME_FORMAT)
+    except (TypeError, ValueError, UnicodeError):
+        raise BadCursor("Malformed cursor %r" % token)
+
+    if cursor_author != author_pk:
+        raise BadCursor("Cursor %r is not for author #%d" % (token, author_pk))
+    return published, post_pk
+
+
+def posts_before(posts, published, post_pk):
+    """
+    Filter the given posts to those before the given `(published, id)`
+    position, for paging through them in `('-published', '-id')` order.
+    """
+    return posts.filter(Q(published__lt=published) | Q(published=published, id__lt=post_pk),
+        published__lte=published)
+
+
+def posts_after(posts, published, post_pk):
+    """
+    Filter the given posts to those after the given `(published, id)`
+    position, for paging through them in `('published', 'id')` order.
+    """
+    return posts.filter(Q(published__gt=published) | Q(published=published, id__gt=post_pk),
+        published__gte=published)
+
+
+def page_of_posts(posts, count):
+    """
+    Load the first `count` of the given ordered posts, returning them with the
+    cursor for the position after the last one, or None if there are no more.
+    """
+    posts = list(posts[:count + 1])
+    if len(posts) <= count:
+        return posts, None
+    posts = posts[:count]
+    return posts, cursor_for_post(posts[-1])
@@ -13,10 +13,16 @@ class PostIndex(indexes.SearchIndex):
     author_pk = indexes.IntegerField(model_attr='author__id')
     published = indexes.DateTimeField(model_attr='published')
     private = indexes.IntegerField(model_attr='private')
+    trust_groups = indexes.MultiValueField()
     result = indexes.CharField(indexed=False, use_template=True)
 
+    def prepare_trust_groups(self, obj):
+        if not obj.private:
+            return []
+        return list(obj.private_to.values_list('pk', flat=True))
+
     def index_queryset(self):
-        return Post.objects.filter(published__lte=datetime.now())
+        return Post.objects.filter(published__lte=datetime.utcnow())
 
 
 site.register(Post, PostIndex)
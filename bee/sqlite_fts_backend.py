@@ -0,0 +1,416 @@
+"""
+A Haystack search backend that keeps the search index in an SQLite database
+using the FTS5 full text extension, so search needs no separate service.
+
+Use it by setting `HAYSTACK_SEARCH_ENGINE = 'bee.sqlite_fts'` and
+`HAYSTACK_SQLITE_PATH` to the file to keep the index in. A path of
+`':memory:'` keeps a separate index in memory for each thread, which is only
+useful for tests.
+
+Documents are ranked by BM25 over their document field. The other indexed
+fields can be filtered on with the `exact`, `gt`, `gte`, `lt`, `lte`, `in`,
+`range` and `startswith` lookups; multi-valued fields match if any of their
+values do. Stored fields are returned with each result.
+
+"""
+
+from datetime import date, datetime
+import json
+import logging
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.loading import get_model
+from django.utils.encoding import force_unicode
+from haystack.backends import BaseSearchBackend, BaseSearchQuery, log_query
+from haystack.constants import ID, DJANGO_CT, DJANGO_ID
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+
+BACKEND_NAME = 'sqlite_fts'
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS haystack_document (
+        id INTEGER PRIMARY KEY,
+        identifier TEXT NOT NULL UNIQUE,
+        django_ct TEXT NOT NULL,
+        django_id TEXT NOT NULL,
+        stored TEXT NOT NULL
+    )""",
+    # No declared type for value, so each value keeps the type it was indexed with.
+    """CREATE TABLE IF NOT EXISTS haystack_field (
+        document INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        value
+    )""",
+    "CREATE INDEX IF NOT EXISTS haystack_field_document ON haystack_field (document, name, value)",
+    "CREATE INDEX IF NOT EXISTS haystack_document_ct ON haystack_document (django_ct)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS haystack_text USING fts5(text, tokenize='porter unicode61')",
+)
+
+FIELD_NAME_RE = re.compile(r'^\w+$')
+
+SPECIAL_COLUMNS = {
+    ID: 'd.identifier',
+    DJANGO_CT: 'd.django_ct',
+    DJANGO_ID: 'd.django_id',
+}
+
+
+log = logging.getLogger(__name__)
+
+connections = threading.local()
+
+
+def get_connection(path):
+    """Return this thread's connection to the index database at `path`, setting up the database if needed."""
+    by_path = connections.__dict__.setdefault('by_path', {})
+    try:
+        return by_path[path]
+    except KeyError:
+        pass
+
+    conn = sqlite3.connect(path)
+    if path != ':memory:':
+        # Let searches read while the indexer writes.
+        conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+    by_path[path] = conn
+    return conn
+
+
+def to_sql(value):
+    """Return the given prepared field value as it's stored in the index."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, datetime):
+        return u'%04d-%02d-%02dT%02d:%02d:%02d' % (value.year, value.month, value.day,
+            value.hour, value.minute, value.second)
+    if isinstance(value, date):
+        return u'%04d-%02d-%02dT00:00:00' % (value.year, value.month, value.day)
+    return force_unicode(value)
+
+
+def sql_literal(value):
+    """Return the given field value as an SQL literal."""
+    value = to_sql(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    return u"'%s'" % value.replace(u"'", u"''")
+
+
+def fts_phrase(value, prefix=False):
+    """Return an FTS5 query matching the given text as a phrase (or phrase prefix)."""
+    phrase = u'"%s"' % force_unicode(value).replace(u'"', u'""')
+    if prefix:
+        phrase += u' *'
+    return phrase
+
+
+class SearchBackend(BaseSearchBackend):
+
+    def __init__(self, site=None, path=None):
+        super(SearchBackend, self).__init__(site)
+        if path is None:
+            try:
+                path = settings.HAYSTACK_SQLITE_PATH
+            except AttributeError:
+                raise ImproperlyConfigured("You must specify a HAYSTACK_SQLITE_PATH in your settings.")
+        self.path = path
+
+    @property
+    def connection(self):
+        return get_connection(self.path)
+
+    def index_documents(self, content_field_name, docs, unindexed=()):
+        """
+        Add or replace the given prepared documents in the index, in one
+        transaction. Fields named in `unindexed` are only stored, not made
+        filterable.
+        """
+        conn = self.connection
+        with conn:
+            for doc in docs:
+                doc = dict(doc)
+                identifier = doc.pop(ID)
+                django_ct, django_id = doc.pop(DJANGO_CT), doc.pop(DJANGO_ID)
+                text = doc.pop(content_field_name, None) or u''
+                self.delete_document(conn, identifier)
+
+                stored = json.dumps(doc, default=to_sql)
+                cursor = conn.execute('INSERT INTO haystack_document (identifier, django_ct, django_id, stored) VALUES (?, ?, ?, ?)',
+                    (identifier, django_ct, django_id, stored))
+                document = cursor.lastrowid
+                conn.execute('INSERT INTO haystack_text (rowid, text) VALUES (?, ?)', (document, text))
+
+                field_rows = list()
+                for name, value in doc.iteritems():
+                    if name in unindexed:
+                        continue
+                    values = value if isinstance(value, (list, tuple, set)) else [value]
+                    field_rows.extend((document, name, to_sql(v)) for v in values if v is not None)
+                conn.executemany('INSERT INTO haystack_field (document, name, value) VALUES (?, ?, ?)', field_rows)
+
+    def delete_document(self, conn, identifier):
+        row = conn.execute('SELECT id FROM haystack_document WHERE identifier = ?', (identifier,)).fetchone()
+        if row is None:
+            return
+        conn.execute('DELETE FROM haystack_field WHERE document = ?', row)
+        conn.execute('DELETE FROM haystack_text WHERE rowid = ?', row)
+        conn.execute('DELETE FROM haystack_document WHERE id = ?', row)
+
+    def update(self, index, iterable, commit=True):
+        content_field_name = index.get_content_field()
+        unindexed = set(field.index_fieldname for field in index.fields.itervalues() if not field.indexed)
+        try:
+            self.index_documents(content_field_name, (index.full_prepare(obj) for obj in iterable), unindexed)
+        except sqlite3.Error, exc:
+            if not self.silently_fail:
+                raise
+            log.error("Failed to add documents to the SQLite index: %s", exc)
+
+    def remove(self, obj_or_string, commit=True):
+        identifier = get_identifier(obj_or_string)
+        try:
+            conn = self.connection
+            with conn:
+                self.delete_document(conn, identifier)
+        except sqlite3.Error, exc:
+            if not self.silently_fail:
+                raise
+            log.error("Failed to remove document '%s' from the SQLite index: %s", identifier, exc)
+
+    def clear(self, models=[], commit=True):
+        conn = self.connection
+        with conn:
+            if not models:
+                conn.execute('DELETE FROM haystack_field')
+                conn.execute('DELETE FROM haystack_text')
+                conn.execute('DELETE FROM haystack_document')
+                return
+
+            for model in models:
+                django_ct = u'%s.%s' % (model._meta.app_label, model._meta.module_name)
+                documents = 'SELECT id FROM haystack_document WHERE django_ct = ?'
+                conn.execute('DELETE FROM haystack_field WHERE document IN (%s)' % documents, (django_ct,))
+                conn.execute('DELETE FROM haystack_text WHERE rowid IN (%s)' % documents, (django_ct,))
+                conn.execute('DELETE FROM haystack_document WHERE django_ct = ?', (django_ct,))
+
+    def order_by_sql(self, sort_by):
+        order = list()
+        for field in sort_by:
+            descending = field.startswith('-')
+            field = field.lstrip('-')
+            if not FIELD_NAME_RE.match(field):
+                raise ValueError("Can't sort by field %r" % field)
+            if field in SPECIAL_COLUMNS:
+                column = SPECIAL_COLUMNS[field]
+            else:
+                column = "(SELECT MIN(f.value) FROM haystack_field f WHERE f.document = d.id AND f.name = '%s')" % field
+            order.append('%s %s' % (column, 'DESC' if descending else 'ASC'))
+        return ', '.join(order)
+
+    @log_query
+    def search(self, query_string, sort_by=None, start_offset=0, end_offset=None,
+               fields='', highlight=False, facets=None, date_facets=None, query_facets=None,
+               narrow_queries=None, spelling_query=None,
+               limit_to_registered_models=None, result_class=None, match=None, **kwargs):
+        """
+        Search for documents matching `query_string`, an SQL condition on the
+        documents as `d` that `SearchQuery` builds.
+
+        When every result has to match some text, `match` is that FTS5 query,
+        so the search can be driven by (and ranked from) the full text index.
+
+        """
+        where = [query_string or '1']
+        for narrow_query in narrow_queries or ():
+            where.append(narrow_query)
+        if limit_to_registered_models is None:
+            limit_to_registered_models = getattr(settings, 'HAYSTACK_LIMIT_TO_REGISTERED_MODELS', True)
+        if limit_to_registered_models:
+            registered = self.build_registered_models_list()
+            where.append('d.django_ct IN (%s)' % ', '.join(sql_literal(ct) for ct in registered) if registered else '0')
+        where = ' AND '.join('(%s)' % condition for condition in where)
+
+        if match:
+            # CROSS JOIN keeps SQLite from scanning every document and probing the full text index for each.
+            tables = 'haystack_text CROSS JOIN haystack_document d ON d.id = haystack_text.rowid'
+            where = 'haystack_text MATCH ? AND %s' % where
+            params = [match]
+            score = '-bm25(haystack_text)'
+            order = 'bm25(haystack_text)'
+        else:
+            tables = 'haystack_document d'
+            params = []
+            score = '0'
+            order = 'd.id DESC'
+        if sort_by:
+            order = self.order_by_sql(sort_by)
+
+        limit = -1 if end_offset is None else max(end_offset - start_offset, 0)
+        try:
+            conn = self.connection
+            hits = conn.execute('SELECT COUNT(*) FROM %s WHERE %s' % (tables, where), params).fetchone()[0]
+            rows = conn.execute('SELECT d.django_ct, d.django_id, d.stored, %s FROM %s WHERE %s ORDER BY %s LIMIT ? OFFSET ?'
+                % (score, tables, where, order), params + [limit, start_offset]).fetchall()
+        except sqlite3.Error, exc:
+            if not self.silently_fail:
+                raise
+            log.error("Failed to query the SQLite index with %r: %s", query_string, exc)
+            hits, rows = 0, []
+
+        return self.process_results(hits, rows, result_class)
+
+    def process_results(self, hits, rows, result_class=None):
+        if result_class is None:
+            result_class = SearchResult
+        indexed_models = self.site.get_indexed_models()
+
+        results = list()
+        for django_ct, django_id, stored, score in rows:
+            app_label, model_name = django_ct.split('.')
+            model = get_model(app_label, model_name)
+            if model is None or model not in indexed_models:
+                hits -= 1
+                continue
+
+            index = self.site.get_index(model)
+            additional_fields = dict()
+            for key, value in json.loads(stored).iteritems():
+                key = str(key)
+                if key in index.fields:
+                    value = index.fields[key].convert(value)
+                additional_fields[key] = value
+            results.append(result_class(app_label, model_name, django_id, score, searchsite=self.site, **additional_fields))
+
+        return {
+            'results': results,
+            'hits': hits,
+            'facets': {},
+            'spelling_suggestion': None,
+        }
+
+
+class SearchQuery(BaseSearchQuery):
+
+    def __init__(self, site=None, backend=None):
+        super(SearchQuery, self).__init__(site, backend)
+
+        if backend is not None:
+            self.backend = backend
+        else:
+            self.backend = SearchBackend(site=site)
+        self.match_phrases = []
+
+    def matching_all_fragment(self):
+        return '1'
+
+    def build_query(self):
+        """
+        Build the SQL condition on documents for the query's filters.
+
+        Content filters every result has to match are collected as
+        `match_phrases` instead, for the backend to search the full text
+        index for.
+
+        """
+        self.match_phrases = []
+        query = self.build_node(self.query_filter, True) or self.matching_all_fragment()
+
+        if self.models:
+            models = sorted(u'%s.%s' % (model._meta.app_label, model._meta.module_name) for model in self.models)
+            query = '(%s) AND d.django_ct IN (%s)' % (query, ', '.join(sql_literal(ct) for ct in models))
+        return query
+
+    def build_node(self, node, required):
+        # Content filters under only unnegated ANDs are required of every result.
+        required = required and not node.negated and (node.connector == node.AND or len(node.children) == 1)
+
+        parts = list()
+        for child in node.children:
+            if hasattr(child, 'as_query_string'):
+                part = self.build_node(child, required)
+            else:
+                expression, value = child
+                field, filter_type = node.split_expression(expression)
+                if required and field == 'content':
+                    self.match_phrases.append(self.content_match(filter_type, value))
+                    continue
+                part = self.build_query_fragment(field, filter_type, value)
+            if part:
+                parts.append(part)
+
+        query = (' %s ' % node.connector).join(parts)
+        if not query:
+            return query
+        if node.negated:
+            return 'NOT (%s)' % query
+        if len(parts) != 1:
+            return '(%s)' % query
+        return query
+
+    def build_params(self, spelling_query=None):
+        kwargs = super(SearchQuery, self).build_params(spelling_query)
+        if self.match_phrases:
+            kwargs['match'] = u' AND '.join(self.match_phrases)
+        return kwargs
+
+    def content_match(self, filter_type, value):
+        """Return the FTS5 query for a filter on the document field."""
+        if hasattr(value, 'values_list'):
+            value = list(value)
+        if filter_type == 'in':
+            return u'(%s)' % u' OR '.join(fts_phrase(v) for v in value)
+        return fts_phrase(value, prefix=filter_type == 'startswith')
+
+    def build_query_fragment(self, field, filter_type, value):
+        if hasattr(value, 'values_list'):
+            value = list(value)
+
+        if field == 'content':
+            match = sql_literal(self.content_match(filter_type, value))
+            return 'd.id IN (SELECT rowid FROM haystack_text WHERE haystack_text MATCH %s)' % match
+
+        index_fieldname = self.backend.site.get_index_fieldname(field)
+        if not FIELD_NAME_RE.match(index_fieldname):
+            raise ValueError("Can't filter on field %r" % index_fieldname)
+
+        if index_fieldname in SPECIAL_COLUMNS:
+            column = SPECIAL_COLUMNS[index_fieldname]
+        else:
+            column = 'f.value'
+
+        if filter_type == 'in':
+            value = list(value)
+            if not value:
+                return '0'
+            condition = '%s IN (%s)' % (column, ', '.join(sql_literal(v) for v in value))
+        elif filter_type == 'range':
+            condition = '%s BETWEEN %s AND %s' % (column, sql_literal(value[0]), sql_literal(value[1]))
+        elif filter_type == 'startswith':
+            prefix = to_sql(value)
+            condition = 'substr(%s, 1, %d) = %s' % (column, len(unicode(prefix)), sql_literal(prefix))
+        else:
+            operators = {
+                'exact': '=',
+                'gt': '>',
+                'gte': '>=',
+                'lt': '<',
+                'lte': '<=',
+            }
+            condition = '%s %s %s' % (column, operators[filter_type], sql_literal(value))
+
+        if index_fieldname in SPECIAL_COLUMNS:
+            return condition
+        return "EXISTS (SELECT 1 FROM haystack_field f WHERE f.document = d.id AND f.name = '%s' AND %s)" % (index_fieldname, condition)
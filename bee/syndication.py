@@ -0,0 +1,225 @@
+"""
+Sending authors' new posts to other sites.
+
+Saving a new public post queues a `SyndicationOutbox` entry for each
+configured target that wants it, due a few minutes later so there's a
+chance to delete the post or make it private first. Due entries are sent
+in batches through one long lived connection per target, and failed sends
+are retried less and less often until they give up.
+
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+
+from django.conf import settings
+import httplib2
+import oauth2
+
+import bee.models
+
+
+SYNDICATION_DELAY = 300
+SYNDICATION_BATCH = 50
+# How long a worker has to send an entry before another may try it.
+SYNDICATION_LEASE = timedelta(minutes=10)
+SYNDICATION_RETRY = timedelta(minutes=1)
+SYNDICATION_RETRY_MAX = timedelta(hours=6)
+SYNDICATION_MAX_ATTEMPTS = 10
+SYNDICATION_TIMEOUT = 30
+
+TYPEPAD_API_URL = 'https://api.typepad.com'
+
+
+log = logging.getLogger(__name__)
+
+
+class SyndicationError(Exception):
+
+    """A send that didn't work. Unless it's `permanent`, it may work if tried again later."""
+
+    def __init__(self, message, permanent=False):
+        super(SyndicationError, self).__init__(message)
+        self.permanent = permanent
+
+
+class TypePadTarget(object):
+
+    """
+    Sends the posts of the author `author_id` to the TypePad blog
+    `blog_url_id` at `blog_domain`, through the API at `api_url`.
+    """
+
+    def __init__(self, config):
+        self.author_id = config['author_id']
+        self.blog_url_id = config['blog_url_id']
+        self.blog_domain = config['blog_domain']
+        self.blog_dirname = config.get('blog_dirname', '')
+        self.api_url = config.get('api_url', TYPEPAD_API_URL).rstrip('/')
+        self.consumer = oauth2.Consumer(config['consumer_key'], config['consumer_secret'])
+        self.token = oauth2.Token(config['access_key'], config['access_secret'])
+
+        self.http = httplib2.Http(timeout=SYNDICATION_TIMEOUT, disable_ssl_certificate_validation=True)
+        self.http.follow_redirects = False
+
+    def wants(self, post):
+        return post.author_id == self.author_id and not post.private
+
+    def request(self, path, body):
+        url = self.api_url + path
+        req = oauth2.Request.from_consumer_and_token(self.consumer, self.token, http_method='POST', http_url=url,
+            is_form_encoded=True)
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), self.consumer, self.token)
+        headers = {'Content-Type': 'application/json'}
+        headers.update(req.to_header())
+        return self.http.request(url, method='POST', body=json.dumps(body), headers=headers)
+
+    def post_path(self, post):
+        # TODO: ugh, using UTC timestamp when the URL will use the blog local date
+        return '/{0}{1}/{2}/{3}.html'.format(self.blog_dirname, post.published.strftime('%Y'),
+            post.published.strftime('%m'), post.slug)
+
+    def existing(self, post):
+        """Return the ID of the blog's asset for the post if it was already sent, or None."""
+        resp, cont = self.request('/domains/{0}/resolve-path.json'.format(self.blog_domain), {'path': self.post_path(post)})
+        if resp.status != 200:
+            raise SyndicationError("Got a %d asking if %s%s exists: %s" % (resp.status, self.blog_domain, self.post_path(post), cont))
+        path_info = json.loads(cont)
+        if path_info.get('isFullMatch') and 'asset' in path_info:
+            return path_info['asset']['urlId']
+        return None
+
+    def send(self, post):
+        """Send the post to the blog, unless it's there already, returning the ID of the blog's asset for it."""
+        url_id = self.existing(post)
+        if url_id is not None:
+            log.debug("Not sending post %r since it's already sent as %r", post.slug, url_id)
+            return url_id
+
+        resp, cont = self.request('/blogs/{0}/post-assets.json'.format(self.blog_url_id), {
+            'title': post.title,
+            'filename': post.slug,
+            'content': post.html,
+            'published': post.published.replace(microsecond=0).isoformat() + 'Z',
+        })
+        if resp.status != 201:
+            # Client errors won't go any better next time, except for timeouts and rate limits.
+            permanent = 400 <= resp.status < 500 and resp.status not in (408, 429)
+            raise SyndicationError("Got a %d sending post: %s" % (resp.status, cont), permanent=permanent)
+        return json.loads(cont).get('urlId', '')
+
+
+# The kinds of target, by name, with the settings that configure them.
+TARGET_CLASSES = {
+    'typepad': ('TYPEPAD_BLURB_KEY', TypePadTarget),
+}
+
+targets_by_name = dict()
+targets_lock = threading.Lock()
+
+
+def syndication_targets():
+    """
+    Return the configured targets by name. Each is made once per process, so
+    its HTTP connection is reused for all its sends.
+    """
+    targets = dict()
+    for name, (setting, target_class) in TARGET_CLASSES.iteritems():
+        config = getattr(settings, setting, None)
+        if not config:
+            continue
+        with targets_lock:
+            made = targets_by_name.get(name)
+            if made is None or made[0] != config:
+                try:
+                    target = target_class(config)
+                except KeyError, exc:
+                    log.debug("Not sending posts to %s since it isn't configured (missing %s)", name, str(exc))
+                    continue
+                made = targets_by_name[name] = (dict(config), target)
+        targets[name] = made[1]
+    return targets
+
+
+def syndication_delay():
+    return timedelta(seconds=getattr(settings, 'SYNDICATION_DELAY', SYNDICATION_DELAY))
+
+
+def queue_post(post):
+    """
+    Queue the post to be sent to each target that wants it after the delay,
+    returning how many entries were queued. Posts already queued for a
+    target aren't queued again, unless they were skipped because the post
+    was private then.
+    """
+    due = max(datetime.utcnow(), post.published) + syndication_delay()
+    queued = 0
+    for name, target in syndication_targets().iteritems():
+        if not target.wants(post):
+            continue
+        entry, created = bee.models.SyndicationOutbox.objects.get_or_create(post=post, target=name, defaults={'due': due})
+        if created:
+            queued += 1
+        elif entry.state == 'skipped':
+            queued += bee.models.SyndicationOutbox.objects.filter(pk=entry.pk, state='skipped').update(state='pending',
+                due=due, error=None)
+    return queued
+
+
+def retry_delay(attempts):
+    return min(SYNDICATION_RETRY * 2 ** min(attempts - 1, 20), SYNDICATION_RETRY_MAX)
+
+
+def save_entry(entry):
+    # Update rather than save, so an entry whose post was deleted meanwhile isn't made again.
+    bee.models.SyndicationOutbox.objects.filter(pk=entry.pk).update(state=entry.state, due=entry.due,
+        attempts=entry.attempts, error=entry.error, remote_id=entry.remote_id, sent=entry.sent)
+
+
+def send_entry(entry, target, now):
+    """Send one claimed outbox entry with the given target, recording how it went."""
+    post = entry.post
+    if target is None or not target.wants(post):
+        # It's private now, or the target went away.
+        log.debug("Not sending post %r to %s since it's no longer wanted there", post.slug, entry.target)
+        entry.state = 'skipped'
+        save_entry(entry)
+        return
+
+    entry.attempts += 1
+    try:
+        entry.remote_id = target.send(post)[:255]
+    except Exception, exc:
+        # However the send went wrong, record it, so the entry is retried and the rest of the batch still goes.
+        permanent = getattr(exc, 'permanent', False)
+        log.info("Couldn't send post %r to %s (attempt %d): %s", post.slug, entry.target, entry.attempts, exc,
+            exc_info=not isinstance(exc, SyndicationError))
+        entry.error = str(exc) or exc.__class__.__name__
+        if permanent or entry.attempts >= SYNDICATION_MAX_ATTEMPTS:
+            entry.state = 'failed'
+        else:
+            entry.due = now + retry_delay(entry.attempts)
+    else:
+        entry.state = 'sent'
+        entry.sent = now
+        entry.error = None
+    save_entry(entry)
+
+
+def send_due(limit=SYNDICATION_BATCH, now=None):
+    """Try sending up to `limit` of the outbox entries that are due, returning how many were tried."""
+    if now is None:
+        now = datetime.utcnow()
+    targets = syndication_targets()
+    due = bee.models.SyndicationOutbox.objects.filter(state='pending', due__lte=now).select_related('post')
+
+    tried = 0
+    for entry in list(due.order_by('due')[:limit]):
+        # Claim the entry, so no other worker sends it at the same time.
+        if not bee.models.SyndicationOutbox.objects.filter(pk=entry.pk, state='pending', due=entry.due).update(due=now + SYNDICATION_LEASE):
+            continue
+        send_entry(entry, targets.get(entry.target), now)
+        tried += 1
+    return tried
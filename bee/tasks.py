@@ -1,18 +1,27 @@
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 import json
 import logging
 from urlparse import urlsplit, urlunsplit, urljoin
 
 from BeautifulSoup import BeautifulSoup
-from celery.decorators import task
-from django.conf import settings
+from celery import registry
+from celery.decorators import periodic_task, task
+from celery.task.sets import maybe_subtask
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
 import django.db.models.signals
 from django.template.defaultfilters import striptags
 from django.utils.text import truncate_words
-import httplib2
-import oauth2
+import haystack
+from taggit.models import Tag, TaggedItem
 
+import bee.feeds
+import bee.linkcheck
 import bee.models
+import bee.syndication
 
 
 log = logging.getLogger(__name__)
@@ -23,89 +32,123 @@ def add(x, y):
     return x + y
 
 
+BULK_JOB_CHUNK_SIZE = 100
+
+
+def start_bulk_job(author_pk, callback, args=(), chunk_size=BULK_JOB_CHUNK_SIZE):
+    """
+    Start a `BulkJob` calling the `callback` task with each chunk of up to
+    `chunk_size` of the author's post PKs followed by `args`, which must be
+    JSON encodable. Returns the job.
+    """
+    job = bee.models.BulkJob.objects.create(author_id=author_pk, callback=callback.name, args=json.dumps(list(args)),
+        chunk_size=chunk_size, total=bee.models.Post.objects.filter(author=author_pk).count())
+    run_bulk_job_chunk.delay(job.pk)
+    return job
+
+
 @task()
-def perform_for_author_posts_in_month(author_pk, year, month, callback):
+def run_bulk_job_chunk(job_pk):
     """
-    Dispatch the callback with the PK of each post by the given author in the
-    given month.
+    Call the given `BulkJob`'s callback with its next chunk of post PKs, and
+    queue the chunk after that, unless the job was cancelled.
     """
-    start_date = datetime(year, month, 1, 0, 0, 0)
-    end_date = (start_date + timedelta(days=31)).replace(day=1)
+    try:
+        job = bee.models.BulkJob.objects.get(pk=job_pk)
+    except bee.models.BulkJob.DoesNotExist:
+        return
+    if job.state != 'running':
+        log.info("Not continuing %s bulk job #%d", job.state, job.pk)
+        return
 
-    posts = bee.models.Post.objects.filter(author=author_pk, published__gte=start_date, published__lt=end_date)
-    for post_pk in posts.values_list('pk', flat=True):
-        callback.delay(post_pk)
+    posts = bee.models.Post.objects.filter(author=job.author_id, pk__gt=job.last_post_pk).order_by('pk')
+    post_pks = list(posts.values_list('pk', flat=True)[:job.chunk_size])
+    if post_pks:
+        try:
+            callback = registry.tasks[job.callback]
+            callback(post_pks, *json.loads(job.args))
+        except Exception, exc:
+            log.exception("Error running chunk of bulk job #%d", job.pk)
+            bee.models.BulkJob.objects.filter(pk=job.pk, state='running').update(state='failed',
+                error=str(exc) or exc.__class__.__name__, finished=datetime.utcnow())
+            return
+
+        bee.models.BulkJob.objects.filter(pk=job.pk).update(done=F('done') + len(post_pks), last_post_pk=post_pks[-1])
+        if len(post_pks) == job.chunk_size:
+            run_bulk_job_chunk.delay(job.pk)
+            return
+
+    bee.models.BulkJob.objects.filter(pk=job.pk, state='running').update(state='done', finished=datetime.utcnow())
 
 
 @task()
-def perform_for_author_posts(author_pk, callback):
+def perform_for_posts(post_pks, callback_name, args=(), kwargs=None):
     """
-    Dispatch `perform_for_author_posts_in_month` tasks for the given author
-    and callback in each month for which the author has posts.
+    Call the named task with each of the given post PKs in turn, followed by
+    `args` and `kwargs`.
     """
-    author_posts = bee.models.Post.objects.filter(author=author_pk).values_list('published', flat=True)
-    start_date = author_posts.order_by('published')[0]
-    end_date = author_posts.order_by('-published')[0]
-
-    end_month = date(end_date.year, end_date.month, 1)
-    month = date(start_date.year, start_date.month, 1)
-    while month <= end_month:
-        perform_for_author_posts_in_month.delay(author_pk, month.year, month.month, callback)
-        month = (month + timedelta(days=31)).replace(day=1)
+    callback = registry.tasks[callback_name]
+    # Keyword names come back from JSON as unicode.
+    kwargs = dict((str(name), value) for name, value in (kwargs or {}).iteritems())
+    for post_pk in post_pks:
+        callback(post_pk, *args, **kwargs)
 
 
 @task()
-def find_404s_in_post(post_pk, author_domain):
+def perform_for_author_posts(author_pk, callback):
     """
-    Record any <a href> or <img src> links in the given post that have 404s as
-    `Link404Result` instances in the database.
+    Call the `callback` task with the PK of each of the given author's posts,
+    as a `BulkJob` taking the posts a chunk at a time. Returns the job's PK.
+
+    The callback may be a subtask, whose args and kwargs (which must be JSON
+    encodable) are passed after the post PK, as when a subtask is queued.
+    It's called in the process running each chunk rather than queued once
+    per post, so its execution options are ignored.
+
     """
-    try:
-        post = bee.models.Post.objects.values('html').get(pk=post_pk)
-    except bee.models.Post.DoesNotExist:
-        return
+    callback = maybe_subtask(callback)
+    return start_bulk_job(author_pk, perform_for_posts, (callback.task, callback.args, callback.kwargs)).pk
 
-    author_url = urlunsplit(('http', author_domain, '/', '', ''))
 
-    http = httplib2.Http(timeout=10)
-    root = BeautifulSoup(post['html'])
-    for link in root.findAll(['a', 'img']):
-        link_url = urljoin(author_url, link.get('href' if link.name == 'a' else 'src'))
-        if urlsplit(link_url).netloc == author_domain:
-            continue
+@task()
+def find_404s_in_post(post_pk, author_domain):
+    """
+    Check the <a href> and <img src> links in the given post, recording the
+    results as `LinkCheck` instances in the database.
+    """
+    bee.linkcheck.check_links(bee.models.Post.objects.filter(pk=post_pk), author_domain)
 
-        try:
-            resp, cont = http.request(link_url, method='HEAD', headers={'User-Agent': 'bee/1.0'})
-        except Exception, exc:
-            log.info('Error fetching %s', link_url)
-            bee.models.Link404Result.objects.create(post_id=post_pk, url=link_url, status=0, error=str(exc))
-            continue
 
-        if resp.status == 405:
-            try:
-                resp, cont = http.request(link_url, method='GET', headers={'User-Agent': 'bee/1.0'})
-            except Exception, exc:
-                log.info('Error fetching %s', link_url)
-                bee.models.Link404Result.objects.create(post_id=post_pk, url=link_url, status=0, error=str(exc))
-                continue
-
-        if resp.status < 200 or resp.status >= 300:
-            log.info('Unexpected status fetching %s', link_url)
-            bee.models.Link404Result.objects.create(post_id=post_pk, url=link_url, status=resp.status)
-        else:
-            log.info('Success fetching %s', link_url)
+@task()
+def find_404s_in_posts(post_pks, author_domain):
+    """
+    Check the links in the given posts, probing each URL once however many
+    of the posts link to it.
+    """
+    results = bee.linkcheck.check_links(bee.models.Post.objects.filter(pk__in=post_pks), author_domain)
+    failed = len([status for status, error in results.itervalues() if not bee.linkcheck.link_working(status)])
+    log.info("Checked %d links in %d posts, %d not working", len(results), len(post_pks), failed)
 
 
 @task()
 def find_404s_for_author(author_pk):
     """
-    Dispatch jobs to check all the given author's posts for 404s in <a href>
-    and <img src> URLs.
+    Check all the <a href> and <img src> URLs in the given author's posts,
+    as a `BulkJob` taking the posts a chunk at a time. Returns the job's PK.
     """
-    author_site = bee.models.AuthorSite.objects.get(author=author_pk)
-    author_domain = author_site.site.domain
+    author_domain = bee.models.author_sites.domain_for_author(author_pk)
+    return start_bulk_job(author_pk, find_404s_in_posts, (author_domain,)).pk
+
 
-    perform_for_author_posts.delay(author_pk, find_404s_in_post.subtask(args=(author_domain,)))
+@periodic_task(run_every=timedelta(hours=1))
+def recheck_stale_links():
+    """
+    Check the linked URLs whose last results are the most out of date,
+    and forget the ones posts don't link to anymore.
+    """
+    results = bee.linkcheck.recheck_stale_links()
+    failed = len([status for status, error in results.itervalues() if not bee.linkcheck.link_working(status)])
+    log.info("Rechecked %d stale links, %d not working", len(results), failed)
 
 
 @task()
@@ -117,6 +160,20 @@ def update_imported_infralinks_in_post(post_pk):
         return
     old_permalink = urlunsplit(('http', post_legacy.netloc, post_legacy.path, None, None))
 
+    # Find which links are to imported posts from the post's link index, so
+    # the HTML is only parsed when there's something to change.
+    legacy_paths = dict()
+    for url in bee.models.PostLink.objects.filter(post=post_pk, kind='a').values_list('url', flat=True):
+        link_parts = urlsplit(urljoin(old_permalink, url))
+        legacy_paths.setdefault(link_parts.netloc, set()).add(link_parts.path)
+    new_posts = dict()
+    for netloc, paths in legacy_paths.iteritems():
+        legacy_urls = bee.models.PostLegacyUrl.objects.filter(netloc=netloc, path__in=paths)
+        for path, link_author_pk, link_slug in legacy_urls.values_list('path', 'post__author', 'post__slug'):
+            new_posts[netloc, path] = (link_author_pk, link_slug)
+    if not new_posts:
+        return
+
     try:
         post = bee.models.Post.objects.get(pk=post_pk)
     except bee.models.Post.DoesNotExist:
@@ -133,11 +190,14 @@ def update_imported_infralinks_in_post(post_pk):
         link_parts = urlsplit(link_url)
 
         try:
-            link_legacy = bee.models.PostLegacyUrl.objects.get(netloc=link_parts.netloc, path=link_parts.path)
-        except bee.models.PostLegacyUrl.DoesNotExist:
+            link_author_pk, link_slug = new_posts[link_parts.netloc, link_parts.path]
+        except KeyError:
             continue
 
-        new_post_url = link_legacy.post.permalink
+        new_post_url = bee.models.permalink_for(link_author_pk, link_slug)
+        if new_post_url is None:
+            log.warn("Not changing link in post %r to %r, since its author has no site", post, link_url)
+            continue
         new_parts = urlsplit(new_post_url)
         new_link_url = urlunsplit((link_parts.scheme, new_parts.netloc, new_parts.path, link_parts.query, link_parts.fragment))
         log.warn("Changing link in post %r from %r to %r", post, link_url, new_link_url)
@@ -150,104 +210,199 @@ def update_imported_infralinks_in_post(post_pk):
         post.save()
 
 
+FEED_RENDER_DELAY = 2
+
+
 @task()
-def blurb_to_typepad(post_pk):
-    # Only try to blurb if we have the settings for it.
+def render_feeds_for_author(author_pk):
+    """
+    Render and store all the kept visibility classes of the given author's
+    feed, and schedule the next rendering for when their next scheduled post
+    is published.
+    """
+    # Changes from here on need another rendering.
+    cache.delete(feed_render_scheduled_key(author_pk))
     try:
-        blurb_settings = settings.TYPEPAD_BLURB_KEY
-        consumer_key, consumer_secret, access_key, access_secret, author_id, blog_url_id, blog_domain = [blurb_settings[x]
-            for x in ('consumer_key', 'consumer_secret', 'access_key', 'access_secret', 'author_id', 'blog_url_id', 'blog_domain')]
-    except (AttributeError, KeyError), exc:
-        log.debug("Not blurbing post #%d since blurbing isn't configured (%s)", post_pk, str(exc))
+        author = User.objects.get(pk=author_pk)
+    except User.DoesNotExist:
         return
-    blog_dirname = blurb_settings.get('blog_dirname', '')
 
-    try:
-        post = bee.models.Post.objects.get(pk=post_pk)
-    except Post.DoesNotExist:
-        # Don't blurb posts that were deleted already.
-        log.debug("Not blurbing post #%d since it no longer exists", post_pk)
-        return
+    for visibility in bee.feeds.feed_visibilities(author_pk):
+        bee.feeds.render_feed(author, visibility)
 
-    # Only blurb the specified author's posts.
-    if post.author_id != author_id:
-        log.debug("Not blurbing post %r since its author #%d is not the blurb author #%d", post.slug, post.author_id, author_id)
-        return
+    now = datetime.utcnow()
+    next_published = bee.models.Post.objects.filter(author=author_pk, published__gt=now).order_by('published')
+    next_published = next_published.values_list('published', flat=True)[:1]
+    if next_published:
+        next_published = next_published[0]
+        # Only schedule one rendering per author per upcoming post.
+        schedule_key = 'bee:feed:%d:scheduled:%s' % (author_pk, next_published.isoformat())
+        countdown = (next_published - now).total_seconds() + 1
+        if cache.add(schedule_key, True, int(countdown) + 60):
+            render_feeds_for_author.apply_async(args=(author_pk,), countdown=countdown)
 
-    # Only blurb public posts.
-    if post.private:
-        log.debug("Not blurbing post %r since it's private now", post.slug)
+
+def feed_render_scheduled_key(author_pk):
+    return 'bee:feed:%d:render:scheduled' % author_pk
+
+
+def queue_feed_rendering(author_pk):
+    """Render the author's feeds shortly, once however many of their posts change meanwhile."""
+    if cache.add(feed_render_scheduled_key(author_pk), True, FEED_RENDER_DELAY * 30):
+        render_feeds_for_author.apply_async(args=(author_pk,), countdown=FEED_RENDER_DELAY)
+
+
+def render_feeds_for_changed_post(sender, instance, **kwargs):
+    queue_feed_rendering(instance.author_id)
+
+
+def render_feeds_for_changed_post_groups(sender, instance, action, reverse, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
         return
+    author_pk = instance.user_id if reverse else instance.author_id
+    queue_feed_rendering(author_pk)
+
+
+django.db.models.signals.post_save.connect(render_feeds_for_changed_post, sender=bee.models.Post)
+django.db.models.signals.post_delete.connect(render_feeds_for_changed_post, sender=bee.models.Post)
+django.db.models.signals.m2m_changed.connect(render_feeds_for_changed_post_groups, sender=bee.models.Post.private_to.through)
+
+
+SEARCH_INDEX_DELAY = 5
+SEARCH_INDEX_BATCH = 100
+
+
+def queue_search_index_updates(post_pks):
+    """Queue the posts with the given PKs to have their search index entries updated shortly."""
+    now = datetime.utcnow()
+    for post_pk in set(post_pks):
+        if bee.models.PendingIndexUpdate.objects.filter(post_pk=post_pk).update(due=now):
+            continue
+        savepoint = transaction.savepoint()
+        try:
+            bee.models.PendingIndexUpdate.objects.create(post_pk=post_pk, due=now)
+        except IntegrityError:
+            # Someone else queued it first.
+            transaction.savepoint_rollback(savepoint)
+            bee.models.PendingIndexUpdate.objects.filter(post_pk=post_pk).update(due=now)
+        else:
+            transaction.savepoint_commit(savepoint)
+
+    # Drain the queue once per delay, however many posts change meanwhile.
+    if cache.add('bee:search:drain:scheduled', True, SEARCH_INDEX_DELAY):
+        update_search_index.apply_async(countdown=SEARCH_INDEX_DELAY)
 
-    h = httplib2.Http(disable_ssl_certificate_validation=True)
-    h.follow_redirects = False
-
-    def make_request(url, body):
-        method = 'POST'
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        body = json.dumps(body)
-
-        csr = oauth2.Consumer(consumer_key, consumer_secret)
-        token = oauth2.Token(access_key, access_secret)
-        req = oauth2.Request.from_consumer_and_token(csr, token, http_method='POST', http_url=url, is_form_encoded=True)
-        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), csr, token)
-        headers.update(req.to_header())
-
-        return h.request(url, method=method, body=body, headers=headers)
-
-    url = 'https://api.typepad.com/domains/{0}/resolve-path.json'.format(blog_domain)
-    # TODO: ugh, using UTC timestamp when the URL will use the blog local date
-    path = '/{0}{1}/{2}/{3}.html'.format(blog_dirname, post.published.strftime('%Y'), post.published.strftime('%m'), post.slug)
-    body = {
-        'path': path,
-    }
-
-    resp, cont = make_request(url, body=body)
-    # If there is an asset there, we already blurbed this post.
-    if resp.status != 200:
-        log.debug("Not blurbing post %r since we got a %r asking if '%s%s' exists: %s", post.slug, resp.status, blog_domain, path, cont)
+
+@task()
+def update_search_index():
+    """
+    Update the search index entries of the posts with queued updates that are
+    due, in batches.
+
+    Posts scheduled for the future are taken out of the index, and their
+    updates put off until they're published.
+
+    """
+    index = haystack.site.get_index(bee.models.Post)
+    now = datetime.utcnow()
+    pending = bee.models.PendingIndexUpdate.objects.filter(due__lte=now)
+
+    while True:
+        post_pks = list(pending.order_by('due').values_list('post_pk', flat=True)[:SEARCH_INDEX_BATCH])
+        if not post_pks:
+            break
+        posts = bee.models.Post.objects.in_bulk(post_pks)
+
+        current = [post for post in posts.itervalues() if post.published <= now]
+        if current:
+            index.backend.update(index, current)
+        for post_pk in post_pks:
+            post = posts.get(post_pk)
+            if post is None or post.published > now:
+                index.backend.remove('bee.post.%d' % post_pk)
+            if post is not None and post.published > now:
+                pending.filter(post_pk=post_pk).update(due=post.published)
+        # Updates queued again since we started stay queued.
+        pending.filter(post_pk__in=post_pks).delete()
+        log.debug("Updated search index for %d posts", len(post_pks))
+
+    next_due = bee.models.PendingIndexUpdate.objects.filter(due__gt=now).order_by('due').values_list('due', flat=True)[:1]
+    if next_due:
+        next_due = next_due[0]
+        schedule_key = 'bee:search:drain:scheduled:%s' % next_due.isoformat()
+        countdown = (next_due - datetime.utcnow()).total_seconds() + 1
+        if cache.add(schedule_key, True, int(countdown) + 60):
+            update_search_index.apply_async(countdown=max(countdown, 0))
+
+
+def queue_search_index_for_post(sender, instance, **kwargs):
+    queue_search_index_updates([instance.pk])
+
+
+def queue_search_index_for_post_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            instance.cleared_index_post_pks = list(instance.post_set.values_list('pk', flat=True))
         return
-    path_info = json.loads(cont)
-    if path_info['isFullMatch'] and 'asset' in path_info:
-        log.debug("Not blurbing post %r since it's already blurbed as %r", post.slug, path_info['asset']['urlId'])
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        queue_search_index_updates([instance.pk])
+    elif action == 'post_clear':
+        queue_search_index_updates(getattr(instance, 'cleared_index_post_pks', ()))
+    else:
+        queue_search_index_updates(pk_set)
+
+
+def queue_search_index_for_deleted_group(sender, instance, **kwargs):
+    queue_search_index_updates(getattr(instance, 'deleted_post_pks', ()))
+
+
+def queue_search_index_for_tagged_item(sender, instance, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(bee.models.Post).pk:
+        queue_search_index_updates([instance.object_id])
+
+
+def queue_search_index_for_tag(sender, instance, created, **kwargs):
+    if created:
         return
+    tagged = TaggedItem.objects.filter(tag=instance, content_type=ContentType.objects.get_for_model(bee.models.Post))
+    queue_search_index_updates(tagged.values_list('object_id', flat=True))
 
-    url = 'https://api.typepad.com/blogs/{0}/post-assets.json'.format(blog_url_id)
-    body = {
-        'title': post.title,
-        'filename': post.slug,
-        'content': post.html,
-        'published': post.published.replace(microsecond=0).isoformat() + 'Z',
-    }
 
-    resp, cont = make_request(url, body=body)
-    if resp.status != 201:
-        log.debug("Oops, tried to blurb post %r but got a %r: %s", post.slug, resp.status, cont)
-    assert resp.status == 201, "Unexpected response status {0} :(".format(resp.status)
+django.db.models.signals.post_save.connect(queue_search_index_for_post, sender=bee.models.Post)
+django.db.models.signals.post_delete.connect(queue_search_index_for_post, sender=bee.models.Post)
+django.db.models.signals.m2m_changed.connect(queue_search_index_for_post_groups, sender=bee.models.Post.private_to.through)
+django.db.models.signals.post_delete.connect(queue_search_index_for_deleted_group, sender=bee.models.TrustGroup)
+django.db.models.signals.post_save.connect(queue_search_index_for_tagged_item, sender=TaggedItem)
+django.db.models.signals.post_delete.connect(queue_search_index_for_tagged_item, sender=TaggedItem)
+django.db.models.signals.post_save.connect(queue_search_index_for_tag, sender=Tag)
 
 
-def blurb_new_posts(sender, instance, **kwargs):
+@periodic_task(run_every=timedelta(minutes=5))
+def send_due_syndications():
+    """Send the posts in the syndication outbox that are due, including the ones to try again."""
+    while bee.syndication.send_due():
+        pass
+
+
+def queue_syndication_for_saved_post(sender, instance, **kwargs):
     post = instance
-    try:
-        # Never ever blurb private posts.
-        if post.private:
-            log.debug("Not blurbing post %r since it's private", post.slug)
-            return
+    # Never ever send private posts.
+    if post.private:
+        return
 
-        # If the post is more than an hour old, don't bother blurbing it.
-        now = datetime.utcnow()
-        if post.published < now - timedelta(hours=1):
-            log.debug("Not blurbing post %r since it's %r old", post.slug, now - post.published)
-            return
+    # If the post is more than an hour old, don't bother sending it.
+    now = datetime.utcnow()
+    if post.published < now - timedelta(hours=1):
+        log.debug("Not sending post %r since it's %r old", post.slug, now - post.published)
+        return
 
-        # TODO: give a chance to delete/private the post before it blurbs
-        log.debug("Blurbing post %r!", post.slug)
-        blurb_to_typepad.delay(post.pk)
-    except Exception, exc:
-        log.exception(exc)
-        raise
+    # Wait a bit, in case the post is deleted or made private right away.
+    if bee.syndication.queue_post(post):
+        delay = bee.syndication.syndication_delay() + (max(post.published, now) - now)
+        send_due_syndications.apply_async(countdown=delay.total_seconds() + 1)
 
 
-django.db.models.signals.post_save.connect(blurb_new_posts, sender=bee.models.Post)
+django.db.models.signals.post_save.connect(queue_syndication_for_saved_post, sender=bee.models.Post)
@@ -5,7 +5,48 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from base64 import urlsafe_b64encode
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import shutil
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import tempfile
+import threading
+import time
+
+from celery.decorators import task
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+import django.contrib.comments
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.http import Http404
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+import haystack
+from haystack.query import SQ, SearchQuerySet
+from social_auth.models import UserSocialAuth
+
+from bee.admin import PostAdmin
+import bee.feeds
+import bee.linkcheck
+import bee.syndication
+import bee.tasks
+import bee.views
+from bee.management.commands import rebuild_search_index
+from bee.models import (Asset, AuthorSite, BulkJob, LinkCheck, LinkHost, PendingIndexUpdate, Post, PostDayCount, PostLegacyUrl,
+    PostLink, PostVisibility, SyndicationOutbox, TrustGroup, TRUST_GROUP_GENERATION_KEY, author_sites, bump_generation, page_generation_key)
+from bee.paging import BadCursor, cursor_for_post, decode_cursor, encode_cursor
+from bee.sqlite_fts_backend import SearchBackend, SearchQuery
 
 
 class SimpleTest(TestCase):
@@ -14,3 +55,1366 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class AuthorSiteTestCase(TestCase):
+
+    """A test case with an author whose site is the test client's host."""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        site = Site.objects.create(domain='testserver', name='testserver')
+        AuthorSite.objects.create(author=self.author, site=site)
+        # Sites are found by Host header, which the test client doesn't send by default.
+        self.client = Client(HTTP_HOST='testserver')
+
+
+class AuthorSiteCacheTest(AuthorSiteTestCase):
+
+    def test_cleared_only_by_real_changes(self):
+        self.assertEqual(author_sites.author_for_domain('testserver'), self.author)
+        self.author.last_login = datetime.now()
+        self.author.save()
+        User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.assertNotEqual(author_sites.maps, None)
+
+        self.author.first_name = 'Bea'
+        self.author.save()
+        self.assertEqual(author_sites.maps, None)
+        self.assertEqual(author_sites.author_for_domain('testserver').first_name, 'Bea')
+
+    def test_cold_cache_not_cleared_by_readers_signing_in(self):
+        User.objects.create_user('reader', 'reader@example.com', 'password')
+        author_sites.clear()
+        generation = author_sites.shared_generation()
+        self.assertTrue(self.client.login(username='reader', password='password'))
+        self.assertEqual(author_sites.shared_generation(), generation)
+
+        self.author.first_name = 'Bea'
+        self.author.save()
+        self.assertNotEqual(author_sites.shared_generation(), generation)
+
+
+class PostListQueryTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        super(PostListQueryTest, self).setUp()
+        self.post_count = 0
+        # Sign in so the anonymous page cache doesn't hide the queries.
+        self.client.login(username='author', password='password')
+
+    def add_posts(self, count):
+        comment_model = django.contrib.comments.get_model()
+        post_type = ContentType.objects.get_for_model(Post)
+        for i in range(self.post_count, self.post_count + count):
+            post = Post.objects.create(author=self.author, title='Post %d' % i, html='<p>hi</p>',
+                slug='post-%d' % i, atom_id='tag:example.com,2011:post-%d' % i,
+                published=datetime(2011, 6, 1, 12, 0, 0) + timedelta(minutes=i), private=False)
+            comment_model.objects.create(content_type=post_type, object_pk=str(post.pk),
+                site_id=settings.SITE_ID, comment='hi', user_name='commenter',
+                submit_date=datetime(2011, 6, 2, 0, 0, 0))
+        self.post_count += count
+
+    def count_queries(self, fn):
+        connection.use_debug_cursor = True
+        # Don't let the test client's requests throw away the queries we're counting.
+        request_started.disconnect(reset_queries)
+        try:
+            start = len(connection.queries)
+            fn()
+            return len(connection.queries) - start
+        finally:
+            request_started.connect(reset_queries)
+            connection.use_debug_cursor = False
+
+    def assertConstantQueries(self, fn):
+        self.add_posts(3)
+        # Warm up any per-process caches first.
+        fn()
+        few_queries = self.count_queries(fn)
+        self.add_posts(12)
+        many_queries = self.count_queries(fn)
+        self.assertEqual(few_queries, many_queries)
+
+    def get_page(self, path):
+        def get():
+            resp = self.client.get(path)
+            self.assertEqual(resp.status_code, 200)
+        return get
+
+    def test_index(self):
+        self.assertConstantQueries(self.get_page('/'))
+
+    def test_day(self):
+        self.assertConstantQueries(self.get_page('/2011/06/01/'))
+
+    def test_feed(self):
+        self.assertConstantQueries(lambda: bee.feeds.render_feed(self.author, bee.feeds.PUBLIC))
+
+
+class PagingTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        cache.clear()
+        super(PagingTest, self).setUp()
+        # More than a page of posts, all published at the same moment.
+        self.posts = [Post.objects.create(author=self.author, title='Post %d' % i, html='<p>hi</p>',
+            slug='post-%d' % i, atom_id='tag:example.com,2011:post-%d' % i,
+            published=datetime(2011, 6, 1, 12, 0, 0), private=False) for i in range(bee.views.POSTS_PER_PAGE + 5)]
+
+    def page_through(self, url):
+        slugs = list()
+        while url is not None:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            slugs.extend(post.slug for post in resp.context['posts'])
+            url = resp.context['more_url']
+        return slugs
+
+    def test_index_pages_through_same_time_posts(self):
+        slugs = self.page_through('/')
+        self.assertEqual(slugs, [post.slug for post in reversed(self.posts)])
+
+    def test_day_pages_through_same_time_posts(self):
+        slugs = self.page_through('/2011/06/01/')
+        self.assertEqual(slugs, [post.slug for post in reversed(self.posts)])
+
+    def assertCursorNotFound(self, cursor):
+        # Call the views directly, since the 404 page's template is the site's to provide.
+        def request(data=None):
+            request = RequestFactory().get('/', data or {}, HTTP_HOST='testserver')
+            request.user = AnonymousUser()
+            return request
+        self.assertRaises(Http404, bee.views.index, request(), before=cursor)
+        self.assertRaises(Http404, bee.views.day, request({'before': cursor}), year='2011', month='06', day='01')
+        self.assertRaises(Http404, bee.views.date_range, request({'before': cursor}), year='2011', month='06')
+
+    def test_other_authors_cursor_rejected(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        cursor = encode_cursor(other.pk, datetime(2011, 6, 1, 12, 0, 0), self.posts[-1].pk)
+        self.assertRaises(BadCursor, decode_cursor, cursor, self.author.pk)
+        self.assertCursorNotFound(cursor)
+
+    def test_bad_cursors_not_found(self):
+        cursor = cursor_for_post(self.posts[-1])
+        tampered = urlsafe_b64encode('%d.2011-06-01.%d' % (self.author.pk, self.posts[-1].pk)).rstrip('=')
+        for bad in ('garbage', cursor[:-3], tampered):
+            self.assertCursorNotFound(bad)
+
+    def test_legacy_slug_pager_redirected(self):
+        post = self.posts[3]
+        resp = self.client.get('/before/%s' % post.slug)
+        self.assertEqual(resp.status_code, 301)
+        self.assertTrue(resp['Location'].endswith('/before/%s' % cursor_for_post(post)))
+
+
+class TrustGroupViewerTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        cache.clear()
+        super(TrustGroupViewerTest, self).setUp()
+        self.friend = User.objects.create_user('friend', 'friend@example.com', 'password')
+        self.friend_auth = UserSocialAuth.objects.create(user=self.friend, provider='openid', uid='friend', extra_data={})
+        self.group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+        self.group.members.add(self.friend_auth)
+        self.post = Post.objects.create(author=self.author, title='Post secret', html='<p>hi</p>', slug='secret',
+            atom_id='tag:example.com,2011:secret', published=datetime(2011, 6, 1, 12, 0, 0), private=True)
+        self.post.private_to.add(self.group)
+        self.client.login(username='friend', password='password')
+
+    def request_for(self, user, session):
+        request = RequestFactory().get('/')
+        request.user = user
+        request.session = session
+        return request
+
+    def test_groups_worked_out_once_per_request(self):
+        request = self.request_for(self.friend, {})
+        self.assertEqual(bee.views.viewer_trust_groups(request, self.author), frozenset([self.group.pk]))
+        self.assertNumQueries(0, bee.views.viewer_trust_groups, request, self.author)
+
+    def test_session_copy_reused_until_members_change(self):
+        session = dict()
+        bee.views.viewer_trust_groups(self.request_for(self.friend, session), self.author)
+        self.assertNumQueries(0, bee.views.viewer_trust_groups, self.request_for(self.friend, session), self.author)
+
+        self.group.members.remove(self.friend_auth)
+        self.assertEqual(bee.views.viewer_trust_groups(self.request_for(self.friend, session), self.author), frozenset())
+        self.group.members.add(self.friend_auth)
+        self.assertEqual(bee.views.viewer_trust_groups(self.request_for(self.friend, session), self.author),
+            frozenset([self.group.pk]))
+
+    def test_session_copy_only_for_its_viewer(self):
+        session = dict()
+        bee.views.viewer_trust_groups(self.request_for(self.friend, session), self.author)
+        stranger = User.objects.create_user('stranger', 'stranger@example.com', 'password')
+        self.assertEqual(bee.views.viewer_trust_groups(self.request_for(stranger, session), self.author), frozenset())
+
+    def test_visible_to_known_groups(self):
+        family = TrustGroup.objects.create(user=self.author, tag='family', display_name='Family')
+        self.assertTrue(self.post.visible_to(self.friend, trust_group_pks=frozenset([self.group.pk])))
+        self.assertTrue(self.post.visible_to(self.author, trust_group_pks=frozenset()))
+        self.assertFalse(self.post.visible_to(self.friend, trust_group_pks=frozenset()))
+        self.assertFalse(self.post.visible_to(self.friend, trust_group_pks=frozenset([family.pk])))
+
+    def test_removed_member_loses_permalink(self):
+        self.assertContains(self.client.get('/secret'), 'Post secret')
+        self.group.members.remove(self.friend_auth)
+        self.assertEqual(self.client.get('/secret').status_code, 404)
+
+    def test_evicted_generation_does_not_revive_membership(self):
+        cache.delete(TRUST_GROUP_GENERATION_KEY)
+        self.assertContains(self.client.get('/secret'), 'Post secret')
+        self.group.members.remove(self.friend_auth)
+        cache.delete(TRUST_GROUP_GENERATION_KEY)
+        self.assertEqual(self.client.get('/secret').status_code, 404)
+
+
+class PostVisibilityTest(AuthorSiteTestCase):
+
+    def setUp(self):
+        cache.clear()
+        super(PostVisibilityTest, self).setUp()
+        self.friend, self.friend_auth = self.add_viewer('friend')
+        self.neighbor, self.neighbor_auth = self.add_viewer('neighbor')
+        self.group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+        self.group.members.add(self.friend_auth)
+        self.post = self.add_post('secret')
+
+    def add_viewer(self, username):
+        viewer = User.objects.create_user(username, '%s@example.com' % username, 'password')
+        return viewer, UserSocialAuth.objects.create(user=viewer, provider='openid', uid=username, extra_data={})
+
+    def add_post(self, slug, private=True):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html='<p>hi</p>', slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, published=datetime(2011, 6, 1, 12, 0, 0), private=private)
+
+    def visibilities(self):
+        # A list rather than a set, so duplicate rows show up.
+        return sorted(PostVisibility.objects.values_list('post', 'viewer'))
+
+    def test_post_groups_changed(self):
+        self.post.private_to.add(self.group)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.post.private_to.add(self.group)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.post.private_to.remove(self.group)
+        self.assertEqual(self.visibilities(), [])
+        self.post.private_to.add(self.group)
+        self.post.private_to.clear()
+        self.assertEqual(self.visibilities(), [])
+
+    def test_group_posts_changed(self):
+        self.group.post_set.add(self.post)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.group.post_set.remove(self.post)
+        self.assertEqual(self.visibilities(), [])
+        self.group.post_set.add(self.post)
+        self.group.post_set.clear()
+        self.assertEqual(self.visibilities(), [])
+
+    def test_group_members_changed(self):
+        self.post.private_to.add(self.group)
+        self.group.members.add(self.neighbor_auth)
+        self.assertEqual(self.visibilities(), sorted([(self.post.pk, self.friend.pk), (self.post.pk, self.neighbor.pk)]))
+        self.group.members.remove(self.friend_auth)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.neighbor.pk)])
+        self.group.members.clear()
+        self.assertEqual(self.visibilities(), [])
+
+    def test_member_groups_changed(self):
+        self.post.private_to.add(self.group)
+        self.neighbor_auth.trustgroup_set.add(self.group)
+        self.assertEqual(self.visibilities(), sorted([(self.post.pk, self.friend.pk), (self.post.pk, self.neighbor.pk)]))
+        self.neighbor_auth.trustgroup_set.remove(self.group)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.friend_auth.trustgroup_set.clear()
+        self.assertEqual(self.visibilities(), [])
+
+    def test_shared_through_two_groups_seen_once(self):
+        family = TrustGroup.objects.create(user=self.author, tag='family', display_name='Family')
+        family.members.add(self.friend_auth)
+        self.post.private_to.add(self.group, family)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.post.private_to.remove(family)
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+
+    def test_group_deleted(self):
+        self.post.private_to.add(self.group)
+        self.group.delete()
+        self.assertEqual(self.visibilities(), [])
+        self.assertTrue(Post.objects.filter(pk=self.post.pk).exists())
+
+    def test_social_auth_deleted(self):
+        self.post.private_to.add(self.group)
+        self.friend_auth.delete()
+        self.assertEqual(self.visibilities(), [])
+
+    def test_privacy_toggled(self):
+        self.post.private_to.add(self.group)
+        self.post.private = False
+        self.post.save()
+        self.assertEqual(self.visibilities(), [])
+        self.post.private = True
+        self.post.save()
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+        self.post.save()
+        self.assertEqual(self.visibilities(), [(self.post.pk, self.friend.pk)])
+
+    def test_rebuild_matches_signals(self):
+        family = TrustGroup.objects.create(user=self.author, tag='family', display_name='Family')
+        family.members.add(self.friend_auth, self.neighbor_auth)
+        self.post.private_to.add(self.group, family)
+        self.add_post('family').private_to.add(family)
+        public = self.add_post('public')
+        public.private_to.add(self.group)
+        public.private = False
+        public.save()
+        expected = self.visibilities()
+        self.assertEqual(len(expected), 4)
+
+        PostVisibility.objects.filter(post=self.post).delete()
+        PostVisibility.objects.create(post=public, viewer=self.friend)
+        call_command('rebuild_post_visibility')
+        self.assertEqual(self.visibilities(), expected)
+
+
+# SQLite commits the test transaction before running EXPLAIN, so clean up by flushing instead.
+class QueryPlanTest(TransactionTestCase):
+
+    def test_hot_queries_use_indexes(self):
+        author = User.objects.create_user('author', 'author@example.com', 'password')
+        site = Site.objects.create(domain='testserver', name='testserver')
+        AuthorSite.objects.create(author=author, site=site)
+        for i in range(50):
+            post = Post.objects.create(author=author, title='Post %d' % i, html='<p>hi</p>',
+                slug='post-%d' % i, atom_id='tag:example.com,2011:post-%d' % i,
+                published=datetime(2011, 6, 1, 12, 0, 0) + timedelta(days=i), private=bool(i % 2))
+            PostLegacyUrl.objects.create(post=post, netloc='example.com', path='/2011/post-%d.html' % i)
+            check = LinkCheck.objects.create(url='http://example.com/%d' % i, url_hash='%040d' % i, status=404,
+                next_check=datetime(2011, 6, 1, 12, 0, 0) + timedelta(days=i))
+            check.posts.add(post)
+            check.results.create(status=404, checked=datetime(2011, 6, 1, 12, 0, 0))
+
+        # Raises CommandError if any query scans a whole table.
+        call_command('explain_queries', author='author', stdout=StringIO())
+
+
+class AnonymousPageCacheTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        cache.clear()
+        super(AnonymousPageCacheTest, self).setUp()
+        self.post = self.add_post('first')
+
+    def add_post(self, slug):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html='<p>hi</p>',
+            slug=slug, atom_id='tag:example.com,2011:%s' % slug,
+            published=datetime(2011, 6, 1, 12, 0, 0), private=False)
+
+    def test_cached_page_runs_no_queries(self):
+        self.client.get('/')
+        self.assertNumQueries(0, self.client.get, '/')
+
+    def test_new_post_expires_page(self):
+        self.client.get('/')
+        self.add_post('second')
+        self.assertContains(self.client.get('/'), 'Post second')
+
+    def test_new_comment_expires_page(self):
+        self.assertContains(self.client.get('/first'), 'hi')
+        django.contrib.comments.get_model().objects.create(
+            content_type=ContentType.objects.get_for_model(Post), object_pk=str(self.post.pk),
+            site_id=settings.SITE_ID, comment='what a post', user_name='commenter',
+            submit_date=datetime(2011, 6, 2, 0, 0, 0))
+        self.assertContains(self.client.get('/first'), 'what a post')
+
+    def test_backdated_post_expires_month_page(self):
+        self.assertNotContains(self.client.get('/2011/06/'), 'Post backdated')
+        self.client.get('/2011/')
+
+        backdated = self.add_post('backdated')
+        backdated.published = datetime(2011, 8, 1, 12, 0, 0)
+        backdated.save()
+        self.client.get('/2011/06/')
+        # Posts in other months leave the June page cached.
+        Post.objects.create(author=self.author, title='Post other', slug='other',
+            atom_id='tag:example.com,2011:other', published=datetime(2011, 9, 1), private=False)
+        self.assertNumQueries(0, self.client.get, '/2011/06/')
+
+        backdated.published = datetime(2011, 6, 2, 12, 0, 0)
+        backdated.save()
+        self.assertContains(self.client.get('/2011/06/'), 'Post backdated')
+        self.assertContains(self.client.get('/2011/'), 'Post backdated')
+
+    def test_admin_privatize_expires_page(self):
+        self.assertContains(self.client.get('/'), 'Post first')
+        self.assertContains(self.client.get('/feed/'), 'Post first')
+        PostAdmin(Post, admin.site).make_private(None, Post.objects.filter(pk=self.post.pk))
+        self.assertNotContains(self.client.get('/'), 'Post first')
+        self.assertNotContains(self.client.get('/feed/'), 'Post first')
+        self.assertEqual(self.client.get('/first').status_code, 404)
+
+    def test_evicted_generation_does_not_revive_pages(self):
+        self.assertContains(self.client.get('/'), 'Post first')
+        self.post.private = True
+        self.post.save()
+        # The page generation is evicted, then started again by the next change.
+        cache.delete(page_generation_key(self.author.pk))
+        bump_generation(page_generation_key(self.author.pk))
+        self.assertNotContains(self.client.get('/'), 'Post first')
+
+    def test_signed_in_viewers_are_not_served_cached_pages(self):
+        self.client.get('/')
+        self.client.login(username='author', password='password')
+        self.assertContains(self.client.get('/'), 'Sign out')
+
+
+class ConditionalGetTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        # Sign in so the anonymous page cache doesn't answer instead.
+        self.client.login(username='author', password='password')
+        self.first = self.add_post('first', datetime(2011, 6, 1, 12, 0, 0))
+        self.second = self.add_post('second', datetime(2011, 6, 2, 12, 0, 0))
+
+    def add_post(self, slug, published, author=None):
+        return Post.objects.create(author=author or self.author, title='Post %s' % slug, html='<p>hi</p>',
+            slug=slug, atom_id='tag:example.com,2011:%s' % slug, published=published, private=False)
+
+    def add_comment(self, post):
+        django.contrib.comments.get_model().objects.create(
+            content_type=ContentType.objects.get_for_model(Post), object_pk=str(post.pk),
+            site_id=settings.SITE_ID, comment='hi', user_name='commenter', submit_date=datetime(2011, 6, 3))
+
+    def assertChangesEtag(self, path, change):
+        etag = self.client.get(path)['ETag']
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        change()
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_no_last_modified(self):
+        self.assertFalse(self.client.get('/').has_header('Last-Modified'))
+
+    def test_deleting_post_changes_etag(self):
+        self.assertChangesEtag('/', self.first.delete)
+
+    def test_comment_changes_etag(self):
+        self.assertChangesEtag('/', lambda: self.add_comment(self.first))
+
+    def test_comments_on_other_posts_keep_etag(self):
+        other = self.add_post('other', datetime(2011, 6, 1), author=User.objects.create_user('other', 'other@example.com', 'password'))
+        etag = self.client.get('/2011/06/02/')['ETag']
+        self.add_comment(other)
+        self.add_comment(self.first)
+        self.assertEqual(self.client.get('/2011/06/02/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class FeedTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        cache.clear()
+        super(FeedTest, self).setUp()
+        self.post = Post.objects.create(author=self.author, title='Post first', html='<p>hi</p>', slug='first',
+            atom_id='tag:example.com,2011:first', published=datetime(2011, 6, 1, 12, 0, 0), private=False)
+
+    def test_cold_feed_queued_not_rendered(self):
+        cache.clear()
+        # While a rendering is queued, pollers are sent away without rendering or queueing another.
+        cache.add(bee.tasks.feed_render_scheduled_key(self.author.pk), True)
+        resp = self.client.get('/feed/')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp['Retry-After'], str(bee.views.FEED_RETRY_AFTER))
+        self.assertEqual(bee.feeds.cached_feed(self.author.pk, bee.feeds.PUBLIC), None)
+
+        # Otherwise they queue one, which runs at once when tasks run eagerly.
+        cache.clear()
+        self.assertEqual(self.client.get('/feed/').status_code, 503)
+        self.assertContains(self.client.get('/feed/'), 'Post first')
+
+    def test_cold_group_feed_kept_rendered(self):
+        friend = User.objects.create_user('friend', 'friend@example.com', 'password')
+        group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+        group.members.add(UserSocialAuth.objects.create(user=friend, provider='openid', uid='friend', extra_data={}))
+        secret = Post.objects.create(author=self.author, title='Post secret', html='<p>hi</p>', slug='secret',
+            atom_id='tag:example.com,2011:secret', published=datetime(2011, 6, 2, 12, 0, 0), private=True)
+        secret.private_to.add(group)
+        self.client.login(username='friend', password='password')
+
+        self.assertEqual(self.client.get('/feed/').status_code, 503)
+        self.assertContains(self.client.get('/feed/'), 'Post secret')
+
+    def test_conditional_get(self):
+        resp = self.client.get('/feed/')
+        self.assertEqual(self.client.get('/feed/', HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/feed/', HTTP_IF_MODIFIED_SINCE=resp['Last-Modified']).status_code, 304)
+
+        # Rendering an unchanged feed again keeps its Last-Modified.
+        bee.tasks.render_feeds_for_author(self.author.pk)
+        self.assertEqual(self.client.get('/feed/')['Last-Modified'], resp['Last-Modified'])
+
+    def test_edits_change_feed(self):
+        self.client.get('/feed/')
+        # Edit the post the way an import or task would, outside the admin and editor.
+        post = Post.objects.get(pk=self.post.pk)
+        post.html = '<p>edited</p>'
+        post.save()
+        self.assertContains(self.client.get('/feed/'), 'edited')
+
+        post.tags.add('news')
+        self.assertTrue(Post.objects.get(pk=post.pk).modified > post.modified)
+
+    def test_archive_pages_revalidate(self):
+        for i in range(1, bee.feeds.ARCHIVE_PAGE_LENGTH):
+            Post.objects.create(author=self.author, title='Post %d' % i, html='<p>hi</p>', slug='post-%d' % i,
+                atom_id='tag:example.com,2011:post-%d' % i, published=datetime(2011, 6, 2) + timedelta(days=i), private=False)
+        resp = self.client.get('/feed/archive/')
+        self.assertContains(resp, 'Post first')
+        self.assertTrue('max-age=%d' % bee.views.ARCHIVE_FULL_PAGE_MAX_AGE in resp['Cache-Control'])
+        self.assertEqual(self.client.get('/feed/archive/', HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+
+        # Saving a post whose saved date isn't known still expires its page.
+        post = Post.objects.get(pk=self.post.pk)
+        post.saved_published = None
+        post.title = 'Post renamed'
+        post.save()
+        resp = self.client.get('/feed/archive/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertContains(resp, 'Post renamed')
+
+    def test_newest_archive_page_found(self):
+        length = bee.feeds.ARCHIVE_PAGE_LENGTH
+        self.assertEqual(bee.feeds.newest_archive_cursor(self.author, bee.feeds.PUBLIC), False)
+        # Some posts share a published time, so the cursor has to tell them apart by id.
+        for i in range(1, 3 * length + 5):
+            Post.objects.create(author=self.author, title='Post %d' % i, html='<p>hi</p>', slug='post-%d' % i,
+                atom_id='tag:example.com,2011:post-%d' % i, published=datetime(2011, 6, 2) + timedelta(days=i // 3), private=False)
+        in_order = list(Post.objects.filter(author=self.author).order_by('published', 'id'))
+
+        cursor = bee.feeds.newest_archive_cursor(self.author, bee.feeds.PUBLIC)
+        self.assertEqual(cursor, cursor_for_post(in_order[2 * length - 1]))
+        self.assertTrue(bee.feeds.archive_page(self.author, bee.feeds.PUBLIC, cursor).full)
+
+        resp = self.client.get('/feed/archive/%s/' % cursor)
+        self.assertTrue('max-age=%d' % bee.views.ARCHIVE_FULL_PAGE_MAX_AGE in resp['Cache-Control'])
+        resp = self.client.get('/feed/archive/%s/' % cursor_for_post(in_order[3 * length - 1]))
+        self.assertTrue('max-age=%d' % bee.feeds.ARCHIVE_OPEN_PAGE_LIFETIME.seconds in resp['Cache-Control'])
+
+    def test_changes_queue_one_rendering(self):
+        # While a rendering is queued, further changes don't queue another.
+        cache.add(bee.tasks.feed_render_scheduled_key(self.author.pk), True)
+        self.post.title = 'Post retitled'
+        self.post.save()
+        self.assertNotContains(self.client.get('/feed/'), 'Post retitled')
+
+        bee.tasks.render_feeds_for_author(self.author.pk)
+        self.assertContains(self.client.get('/feed/'), 'Post retitled')
+        self.post.title = 'Post renamed'
+        self.post.save()
+        self.assertContains(self.client.get('/feed/'), 'Post renamed')
+
+
+class PostDayCountTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        super(PostDayCountTest, self).setUp()
+        self.group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+
+    def add_post(self, slug, published, private=False):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html='<p>hi</p>',
+            slug=slug, atom_id='tag:example.com,2011:%s' % slug, published=published, private=private)
+
+    def counts(self):
+        return dict(((day.isoformat(), visibility), count) for day, visibility, count
+            in PostDayCount.objects.filter(author=self.author).values_list('day', 'visibility', 'count'))
+
+    def test_counts_follow_posts(self):
+        first = self.add_post('first', datetime(2011, 6, 1, 12, 0, 0))
+        self.add_post('second', datetime(2011, 6, 1, 13, 0, 0))
+        self.assertEqual(self.counts(), {('2011-06-01', 'public'): 2})
+
+        first.published = datetime(2011, 6, 2, 12, 0, 0)
+        first.private = True
+        first.save()
+        first.private_to.add(self.group)
+        self.assertEqual(self.counts(), {('2011-06-01', 'public'): 1, ('2011-06-02', 'private:%d' % self.group.pk): 1})
+
+        first.delete()
+        self.assertEqual(self.counts(), {('2011-06-01', 'public'): 1})
+
+    def archive_data(self, path):
+        resp = self.client.get(path)
+        self.assertEqual(resp.status_code, 200)
+        return resp, json.loads(resp.content)
+
+    def test_archive_data_by_viewer(self):
+        self.add_post('public', datetime(2011, 6, 1, 12, 0, 0))
+        self.add_post('private', datetime(2011, 6, 1, 13, 0, 0), private=True)
+        june_first = datetime(2011, 6, 1).timetuple().tm_yday - 1
+
+        resp, data = self.archive_data('/archive/data/2010-2011/')
+        self.assertEqual(data['first'], 2011)
+        self.assertEqual(sorted(data['years']), ['2010', '2011'])
+        self.assertEqual(len(data['years']['2011']), 366)
+        self.assertEqual(data['years']['2011'][june_first], 1)
+        self.assertEqual(sum(data['years']['2011']), 1)
+        self.assertTrue('public' in resp['Cache-Control'])
+
+        self.client.login(username='author', password='password')
+        resp, data = self.archive_data('/archive/data/2011-2011/')
+        self.assertEqual(data['years']['2011'][june_first], 2)
+        self.assertTrue('private' in resp['Cache-Control'])
+
+        resp = self.client.get('/archive/data/2011-2011/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+    def test_archive_data_rejects_bad_ranges(self):
+        self.assertEqual(self.client.get('/archive/data/2011-2010/').status_code, 400)
+        self.assertEqual(self.client.get('/archive/data/1900-2011/').status_code, 400)
+
+    def test_rebuild(self):
+        self.add_post('first', datetime(2011, 6, 1, 12, 0, 0))
+        expected = self.counts()
+        PostDayCount.objects.all().delete()
+        PostDayCount.objects.create(author=self.author, day=datetime(2011, 6, 5).date(), visibility='public', count=3)
+
+        call_command('rebuild_post_day_counts')
+        self.assertEqual(self.counts(), expected)
+
+
+class SqliteFtsBackendTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+        self.backend = SearchBackend(path=':memory:')
+        self.backend.clear()
+        self.index = haystack.site.get_index(Post)
+
+    def add_post(self, slug, html, private_to=None):
+        post = Post.objects.create(author=self.author, title='Post %s' % slug, html=html,
+            slug=slug, atom_id='tag:example.com,2011:%s' % slug, published=datetime(2011, 6, 1, 12, 0, 0),
+            private=private_to is not None)
+        if private_to:
+            post.private_to.add(private_to)
+        self.backend.update(self.index, [post])
+        return post
+
+    def search(self):
+        return SearchQuerySet(query=SearchQuery(backend=self.backend)).filter(author_pk=self.author.pk)
+
+    def pks(self, sqs):
+        return [int(result.pk) for result in sqs]
+
+    def test_ranked_text_search(self):
+        some = self.add_post('some', '<p>A bee visited, then went back to the hive.</p>')
+        many = self.add_post('many', '<p>Bees and more bees, a whole hive of bees.</p>')
+        self.add_post('none', '<p>Nothing to see here.</p>')
+
+        results = self.search().auto_query('bee')
+        self.assertEqual(self.pks(results), [many.pk, some.pk])
+        self.assertEqual(results.count(), 2)
+        self.assertTrue('Post many' in results[0].result)
+
+        self.assertEqual(self.pks(self.search().auto_query('bee -visited')), [many.pk])
+
+    def test_visibility_filters(self):
+        public = self.add_post('public', '<p>hive news</p>')
+        shared = self.add_post('shared', '<p>hive news</p>', private_to=self.group)
+        secret = self.add_post('secret', '<p>hive news</p>', private_to=TrustGroup.objects.create(
+            user=self.author, tag='family', display_name='Family'))
+
+        results = self.search().auto_query('hive')
+        self.assertEqual(sorted(self.pks(results)), [public.pk, shared.pk, secret.pk])
+        self.assertEqual(self.pks(results.filter(private=0)), [public.pk])
+        in_group = results.filter(SQ(private=0) | SQ(trust_groups__in=[self.group.pk]))
+        self.assertEqual(sorted(self.pks(in_group)), [public.pk, shared.pk])
+        self.assertEqual(self.pks(results.filter(author_pk=self.author.pk + 1)), [])
+
+    def test_remove(self):
+        post = self.add_post('gone', '<p>hive news</p>')
+        self.backend.remove(post)
+        self.assertEqual(self.pks(self.search().auto_query('hive')), [])
+
+
+class RebuildSearchIndexTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.posts = [Post.objects.create(author=self.author, title='Post %d' % i, html='<p>hi</p>',
+            slug='post-%d' % i, atom_id='tag:example.com,2011:post-%d' % i,
+            published=datetime(2011, 6, 1, 12, 0, 0) + timedelta(days=i % 3), private=False) for i in range(5)]
+        self.index = haystack.site.get_index(Post)
+        self.index.backend.clear()
+
+        self.tempdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tempdir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def indexed(self):
+        return sorted(int(result.pk) for result in SearchQuerySet().filter(author_pk=self.author.pk))
+
+    def rebuild(self):
+        call_command('rebuild_search_index', workers=1, batch_size=2, state_file=self.state_file, stdout=StringIO())
+
+    def test_rebuild(self):
+        self.rebuild()
+        self.assertEqual(self.indexed(), sorted(post.pk for post in self.posts))
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_resume(self):
+        command = rebuild_search_index.Command()
+        state = command.plan_batches(None, 2)
+        self.assertEqual(len(state['batches']), 3)
+        state['done'] = [0]
+        command.save_state(self.state_file, state)
+
+        self.rebuild()
+        # The first batch was already done, so its two posts were skipped.
+        in_order = sorted(self.posts, key=lambda post: (post.published, post.pk))
+        self.assertEqual(self.indexed(), sorted(post.pk for post in in_order[2:]))
+
+    def test_fresh_rebuild_removes_stale_documents(self):
+        self.index.backend.update(self.index, self.posts)
+        # Hide a post without its signals, so its document is left in the index.
+        Post.objects.filter(pk=self.posts[0].pk).update(published=datetime.utcnow() + timedelta(days=1))
+
+        self.rebuild()
+        self.assertEqual(self.indexed(), sorted(post.pk for post in self.posts[1:]))
+
+    def test_resume_keeps_done_batches(self):
+        command = rebuild_search_index.Command()
+        state = command.plan_batches(None, 2)
+        state['done'] = [0]
+        command.save_state(self.state_file, state)
+        in_order = sorted(self.posts, key=lambda post: (post.published, post.pk))
+        self.index.backend.update(self.index, in_order[:2])
+
+        self.rebuild()
+        self.assertEqual(self.indexed(), sorted(post.pk for post in self.posts))
+
+    def test_workers_stopped_on_error(self):
+        pools = list()
+
+        class FakePool(object):
+            def __init__(self, processes):
+                self.stopped = None
+                pools.append(self)
+
+            def imap_unordered(self, fn, iterable):
+                return (fn(args) for args in iterable)
+
+            def close(self):
+                self.stopped = 'closed'
+
+            def terminate(self):
+                self.stopped = 'terminated'
+
+            def join(self):
+                pass
+
+        def broken_update(index, docs):
+            raise ValueError('backend is broken')
+
+        real_pool, multiprocessing.Pool = multiprocessing.Pool, FakePool
+        self.index.backend.update = broken_update
+        try:
+            self.assertRaises(ValueError, call_command, 'rebuild_search_index', workers=2, batch_size=2,
+                state_file=self.state_file, stdout=StringIO())
+        finally:
+            multiprocessing.Pool = real_pool
+            del self.index.backend.update
+        self.assertEqual([pool.stopped for pool in pools], ['terminated'])
+
+
+class SearchViewTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        cache.clear()
+        super(SearchViewTest, self).setUp()
+        haystack.site.get_index(Post).backend.clear()
+
+    def test_trust_group_members_find_shared_posts(self):
+        friend = User.objects.create_user('friend', 'friend@example.com', 'password')
+        group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+        group.members.add(UserSocialAuth.objects.create(user=friend, provider='openid', uid='friend', extra_data={}))
+        post = Post.objects.create(author=self.author, title='Hive inspection', html='<p>hive news</p>',
+            slug='inspection', atom_id='tag:example.com,2011:inspection', published=datetime(2011, 6, 1), private=True)
+        post.private_to.add(group)
+        bee.tasks.update_search_index()
+
+        self.assertNotContains(self.client.get('/search/', {'q': 'hive'}), 'Hive inspection')
+        self.client.login(username='friend', password='password')
+        self.assertContains(self.client.get('/search/', {'q': 'hive'}), 'Hive inspection')
+
+
+class SearchQueueTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.index = haystack.site.get_index(Post)
+        self.index.backend.clear()
+
+    def add_post(self, slug, published=datetime(2011, 6, 1, 12, 0, 0)):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html='<p>hi</p>', slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, published=published, private=False)
+
+    def indexed(self):
+        return sorted(int(result.pk) for result in SearchQuerySet().filter(author_pk=self.author.pk))
+
+    def test_burst_drained_once(self):
+        # The first save schedules a drain, which runs right away in tests.
+        first = self.add_post('first')
+        self.assertEqual(self.indexed(), [first.pk])
+
+        # Saves until that drain happens only queue their posts, once each.
+        second = self.add_post('second')
+        third = self.add_post('third')
+        second.save()
+        self.assertEqual(self.indexed(), [first.pk])
+        self.assertEqual(sorted(PendingIndexUpdate.objects.values_list('post_pk', flat=True)), [second.pk, third.pk])
+
+        bee.tasks.update_search_index()
+        self.assertEqual(self.indexed(), [first.pk, second.pk, third.pk])
+        self.assertFalse(PendingIndexUpdate.objects.exists())
+
+    def test_delete_removes_document(self):
+        post = self.add_post('doomed')
+        self.assertEqual(self.indexed(), [post.pk])
+        post_pk = post.pk
+        post.delete()
+        bee.tasks.update_search_index()
+        self.assertEqual(self.indexed(), [])
+        self.assertFalse(PendingIndexUpdate.objects.filter(post_pk=post_pk).exists())
+
+    def test_future_post_indexed_when_due(self):
+        published = datetime.utcnow() + timedelta(hours=1)
+        post = self.add_post('later', published=published)
+        self.assertEqual(self.indexed(), [])
+        self.assertEqual(PendingIndexUpdate.objects.get(post_pk=post.pk).due, published)
+
+        # An hour passes.
+        an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        Post.objects.filter(pk=post.pk).update(published=an_hour_ago)
+        PendingIndexUpdate.objects.filter(post_pk=post.pk).update(due=an_hour_ago)
+        bee.tasks.update_search_index()
+        self.assertEqual(self.indexed(), [post.pk])
+
+
+class SearchSuggestionTest(AuthorSiteTestCase):
+
+    urls = 'bee.urls'
+
+    def setUp(self):
+        super(SearchSuggestionTest, self).setUp()
+        self.group = TrustGroup.objects.create(user=self.author, tag='friends', display_name='Friends')
+
+    def add_post(self, slug, title, published, tags=(), private_to=None):
+        post = Post.objects.create(author=self.author, title=title, html='<p>hi</p>', slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, published=published, private=private_to is not None)
+        if private_to is not None:
+            post.private_to.add(private_to)
+        post.tags.add(*tags)
+        return post
+
+    def suggest(self, prefix):
+        resp = self.client.get('/search/suggest/', {'q': prefix})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        return [post['title'] for post in data['posts']], [(tag['name'], tag['count']) for tag in data['tags']]
+
+    def test_suggestions_by_viewer(self):
+        self.add_post('harvest', 'Honey harvest notes', datetime(2011, 6, 1, 12, 0, 0), tags=['beekeeping'])
+        self.add_post('inspection', 'Hive inspection', datetime(2011, 6, 2, 12, 0, 0), tags=['beekeeping'], private_to=self.group)
+        self.add_post('scheduled', 'Honey for sale', datetime.utcnow() + timedelta(days=1))
+
+        self.assertEqual(self.suggest('H'), (['Honey harvest notes'], []))
+        self.assertEqual(self.suggest('harv'), (['Honey harvest notes'], []))
+        self.assertEqual(self.suggest('bee'), ([], [('beekeeping', 1)]))
+        self.assertEqual(self.suggest(''), ([], []))
+
+        self.client.login(username='author', password='password')
+        self.assertEqual(self.suggest('h'), (['Hive inspection', 'Honey harvest notes'], []))
+        self.assertEqual(self.suggest('bee'), ([], [('beekeeping', 2)]))
+
+    def test_suggestions_follow_changes(self):
+        post = self.add_post('harvest', 'Honey harvest notes', datetime(2011, 6, 1, 12, 0, 0), tags=['beekeeping'])
+
+        post.title = 'Wax melting'
+        post.save()
+        self.assertEqual(self.suggest('hon'), ([], []))
+        self.assertEqual(self.suggest('melt'), (['Wax melting'], []))
+
+        post.private = True
+        post.save()
+        self.assertEqual(self.suggest('bee'), ([], []))
+        self.assertEqual(self.suggest('wax'), ([], []))
+
+        post.private = False
+        post.save()
+        post.tags.remove('beekeeping')
+        post.tags.add('candles')
+        self.assertEqual(self.suggest('bee'), ([], []))
+        self.assertEqual(self.suggest('can'), ([], [('candles', 1)]))
+
+        post.delete()
+        self.assertEqual(self.suggest('can'), ([], []))
+
+
+class PostLinkTest(AuthorSiteTestCase):
+
+    def add_post(self, slug, html):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html=html, slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, published=datetime(2011, 6, 1, 12, 0, 0), private=False)
+
+    def links(self, post):
+        return sorted(post.links.values_list('url', 'kind', 'host'))
+
+    def test_links_kept_current(self):
+        post = self.add_post('first', '<a href="HTTP://Example.COM:80/a#top">a</a> <a href="http://example.com/a">again</a> '
+            '<img src="/photo.jpg"> <a href="">blank</a> <a name="anchor">anchor</a>')
+        self.assertEqual(self.links(post), [
+            ('/photo.jpg', 'img', ''),
+            ('http://Example.COM:80/a', 'a', 'example.com'),
+            ('http://example.com/a', 'a', 'example.com'),
+        ])
+
+        # Only the links that changed are replaced.
+        kept = post.links.get(url='http://example.com/a').pk
+        post.html = '<a href="http://example.com/a">a</a> <a href="http://example.com:8080/b">b</a>'
+        post.save()
+        self.assertEqual(self.links(post), [('http://example.com/a', 'a', 'example.com'), ('http://example.com:8080/b', 'a', 'example.com:8080')])
+        self.assertEqual(post.links.get(url='http://example.com/a').pk, kept)
+
+        post.delete()
+        self.assertEqual(PostLink.objects.count(), 0)
+
+    def test_backlinks(self):
+        target = self.add_post('target', '')
+        absolute = self.add_post('absolute', '<a href="http://testserver/target#comments">target</a>')
+        relative = self.add_post('relative', '<a href="/target">target</a>')
+        self.add_post('other', '<a href="http://testserver/other">other</a> <a href="/target">image</a>')
+        Post.objects.filter(slug='other').update(author=User.objects.create_user('other', 'other@example.com', 'password'))
+
+        self.assertEqual(sorted(bee.models.posts_linking_to(target.permalink).values_list('slug', flat=True)), ['absolute', 'relative'])
+
+        asset = Asset.objects.create(author=self.author, sourcefile='assets/2011/06/photo.jpg')
+        self.add_post('photo', '<img src="%s">' % asset.sourcefile.url)
+        self.assertEqual([post.slug for post in asset.referencing_posts()], ['photo'])
+
+    def test_legacy_links_rewritten(self):
+        target = self.add_post('target', '')
+        PostLegacyUrl.objects.create(post=target, netloc='old.example.com', path='/2010/01/target.html')
+        post = self.add_post('post', '<a href="/2010/01/target.html#more">target</a> <a href="http://example.com/">elsewhere</a>')
+        PostLegacyUrl.objects.create(post=post, netloc='old.example.com', path='/2010/01/post.html')
+
+        bee.tasks.update_imported_infralinks_in_post(post.pk)
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(self.links(post), [('http://example.com/', 'a', 'example.com'), ('http://testserver/target', 'a', 'testserver')])
+        self.assertTrue('href="http://testserver/target#more"' in post.html)
+
+    def test_legacy_links_to_authors_without_sites_kept(self):
+        siteless = User.objects.create_user('siteless', 'siteless@example.com', 'password')
+        target = Post.objects.create(author=siteless, title='Post target', html='', slug='target',
+            atom_id='tag:example.com,2011:siteless-target', published=datetime(2011, 6, 1, 12, 0, 0), private=False)
+        self.assertEqual(target.permalink, None)
+        PostLegacyUrl.objects.create(post=target, netloc='old.example.com', path='/2010/01/target.html')
+        post = self.add_post('post', '<a href="/2010/01/target.html">target</a>')
+        PostLegacyUrl.objects.create(post=post, netloc='old.example.com', path='/2010/01/post.html')
+
+        bee.tasks.update_imported_infralinks_in_post(post.pk)
+        self.assertTrue('href="/2010/01/target.html"' in Post.objects.get(pk=post.pk).html)
+
+
+chunks_seen = list()
+
+
+@task()
+def record_chunk(post_pks, action):
+    chunks_seen.append(post_pks)
+    if action == 'cancel':
+        BulkJob.objects.get().cancel()
+    elif action == 'fail':
+        raise ValueError('no thanks')
+
+
+@task()
+def record_post(post_pk, label=None, suffix=''):
+    chunks_seen.append(post_pk if label is None else '%s %d%s' % (label, post_pk, suffix))
+
+
+class BulkJobTest(TestCase):
+
+    def setUp(self):
+        del chunks_seen[:]
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.post_pks = list()
+        for i in range(7):
+            for author in (self.author, other):
+                post = Post.objects.create(author=author, title='Post %d' % i, slug='post-%d' % i,
+                    atom_id='tag:example.com,2011:%s-%d' % (author.username, i))
+                if author == self.author:
+                    self.post_pks.append(post.pk)
+
+    def test_chunks(self):
+        job = bee.tasks.start_bulk_job(self.author.pk, record_chunk, ('record',), chunk_size=3)
+        self.assertEqual(chunks_seen, [self.post_pks[0:3], self.post_pks[3:6], self.post_pks[6:]])
+        job = BulkJob.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.done, job.total), ('done', 7, 7))
+        self.assertTrue(job.finished is not None)
+
+    def test_cancel(self):
+        job = bee.tasks.start_bulk_job(self.author.pk, record_chunk, ('cancel',), chunk_size=3)
+        self.assertEqual(chunks_seen, [self.post_pks[0:3]])
+        job = BulkJob.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.done, job.last_post_pk), ('cancelled', 3, self.post_pks[2]))
+
+    def test_failure(self):
+        job = bee.tasks.start_bulk_job(self.author.pk, record_chunk, ('fail',), chunk_size=3)
+        job = BulkJob.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.done, job.error), ('failed', 0, 'no thanks'))
+
+    def test_perform_for_author_posts(self):
+        bee.tasks.perform_for_author_posts(self.author.pk, record_post)
+        self.assertEqual(chunks_seen, self.post_pks)
+
+    def test_perform_for_author_posts_subtask(self):
+        bee.tasks.perform_for_author_posts(self.author.pk, record_post.subtask(('post',), {'suffix': '!'}))
+        self.assertEqual(chunks_seen, ['post %d!' % post_pk for post_pk in self.post_pks])
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handler=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler or StubHandler)
+        self.requests = list()
+        self.in_flight = self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def respond(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+            self.server.in_flight += 1
+            self.server.most_in_flight = max(self.server.most_in_flight, self.server.in_flight)
+        try:
+            if self.path.startswith('/slow'):
+                time.sleep(0.05)
+            if self.path == '/missing':
+                status = 404
+            elif self.path.startswith('/down'):
+                status = 503
+            elif self.path == '/nohead' and self.command == 'HEAD':
+                status = 405
+            else:
+                status = 200
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    do_HEAD = do_GET = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LinkCheckTest(AuthorSiteTestCase):
+
+    def setUp(self):
+        super(LinkCheckTest, self).setUp()
+
+        self.server = StubServer()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_post(self, slug, paths):
+        html = ''.join('<p><a href="%s%s">link</a></p>' % (self.base_url, path) for path in paths)
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html=html, slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, published=datetime(2011, 6, 1, 12, 0, 0), private=False)
+
+    def test_each_url_checked_once(self):
+        first = self.add_post('first', ['/ok', '/missing', '/missing#again'])
+        second = self.add_post('second', ['/ok', '/missing', '/nohead'])
+        Post.objects.create(author=self.author, title='Inside', slug='inside', atom_id='tag:example.com,2011:inside',
+            html='<a href="/first">first</a> <a href="http://testserver/second">second</a> <img src="/photo.jpg">')
+
+        results = bee.linkcheck.check_author_links(self.author.pk)
+        self.assertEqual(sorted(status for status, error in results.itervalues()), [200, 200, 404])
+        self.assertEqual(sorted(self.server.requests),
+            [('GET', '/nohead'), ('HEAD', '/missing'), ('HEAD', '/nohead'), ('HEAD', '/ok')])
+
+        missing = LinkCheck.objects.get(url=self.base_url + '/missing')
+        self.assertEqual(missing.status, 404)
+        self.assertEqual(sorted(missing.posts.values_list('pk', flat=True)), [first.pk, second.pk])
+
+        # Checking again updates the same results, and forgets links that are gone.
+        second.html = ''
+        second.save()
+        bee.linkcheck.check_author_links(self.author.pk, force=True)
+        self.assertEqual(LinkCheck.objects.count(), 3)
+        self.assertEqual(list(missing.posts.values_list('pk', flat=True)), [first.pk])
+        self.assertEqual(LinkCheck.objects.get(url=self.base_url + '/nohead').posts.count(), 0)
+
+    def test_per_host_limit(self):
+        self.add_post('slow', ['/slow/%d' % i for i in range(6)])
+        checker = bee.linkcheck.LinkChecker(workers=4, per_host=2)
+        results = bee.linkcheck.check_author_links(self.author.pk, checker)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.server.most_in_flight, 2)
+
+    def test_only_stale_links_rechecked(self):
+        post = self.add_post('first', ['/ok', '/missing'])
+        bee.linkcheck.check_author_links(self.author.pk)
+        bee.linkcheck.check_author_links(self.author.pk)
+        self.assertEqual(len(self.server.requests), 2)
+
+        missing = LinkCheck.objects.get(url=self.base_url + '/missing')
+        self.assertEqual(missing.failures, 1)
+        self.assertEqual((missing.next_check - missing.checked).days, 1)
+        ok = LinkCheck.objects.get(url=self.base_url + '/ok')
+        self.assertEqual((ok.next_check - ok.checked).days, 30)
+
+        # Once its result is stale, the broken link is checked again, and then less often.
+        LinkCheck.objects.filter(pk=missing.pk).update(next_check=datetime(2011, 1, 1))
+        results = bee.linkcheck.recheck_stale_links()
+        self.assertEqual(results.keys(), [self.base_url + '/missing'])
+        missing = LinkCheck.objects.get(pk=missing.pk)
+        self.assertEqual(missing.failures, 2)
+        self.assertEqual((missing.next_check - missing.checked).days, 2)
+
+        # Only the last few results are kept.
+        for i in range(bee.linkcheck.LINK_CHECK_HISTORY):
+            bee.linkcheck.check_author_links(self.author.pk, force=True)
+        self.assertEqual(missing.results.count(), bee.linkcheck.LINK_CHECK_HISTORY)
+
+        # Links no post links to anymore are forgotten.
+        post.html = '<a href="%s/ok">ok</a>' % self.base_url
+        post.save()
+        bee.linkcheck.check_author_links(self.author.pk)
+        bee.linkcheck.recheck_stale_links()
+        self.assertEqual(list(LinkCheck.objects.values_list('url', flat=True)), [self.base_url + '/ok'])
+
+    def test_failing_host_backoff(self):
+        self.add_post('down', ['/down/1', '/down/2'])
+        bee.linkcheck.check_author_links(self.author.pk)
+        self.assertEqual(len(self.server.requests), 2)
+        host = LinkHost.objects.get()
+        self.assertEqual(host.failures, 1)
+
+        # While backing off, the host's links aren't checked, and wait until the host might be back.
+        bee.linkcheck.check_author_links(self.author.pk, force=True)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(set(LinkCheck.objects.values_list('next_check', flat=True)), set([host.retry_after]))
+
+        LinkHost.objects.update(retry_after=datetime(2011, 1, 1))
+        bee.linkcheck.check_author_links(self.author.pk, force=True)
+        self.assertEqual(len(self.server.requests), 4)
+        host = LinkHost.objects.get()
+        self.assertEqual(host.failures, 2)
+
+        # One working link is enough to forgive the host.
+        LinkHost.objects.update(retry_after=datetime(2011, 1, 1))
+        self.add_post('up', ['/ok'])
+        bee.linkcheck.check_author_links(self.author.pk, force=True)
+        host = LinkHost.objects.get()
+        self.assertEqual((host.failures, host.retry_after), (0, None))
+
+
+class FakeTypePadHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open, so we can tell whether they're reused.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.clients.add(self.client_address)
+            if self.path == '/domains/blog.example.com/resolve-path.json' and server.malformed:
+                status, result = 200, {'isFullMatch': True, 'asset': {}}
+            elif self.path == '/domains/blog.example.com/resolve-path.json':
+                url_id = server.assets.get(body['path'])
+                status, result = 200, {'isFullMatch': url_id is not None}
+                if url_id is not None:
+                    result['asset'] = {'urlId': url_id}
+            elif self.path == '/blogs/6a00blog/post-assets.json' and server.failures:
+                server.failures -= 1
+                status, result = 503, {'error': 'try again'}
+            elif self.path == '/blogs/6a00blog/post-assets.json':
+                published = datetime.strptime(body['published'], '%Y-%m-%dT%H:%M:%SZ')
+                url_id = '6a00asset%d' % (len(server.assets) + 1)
+                server.assets['/%s/%s.html' % (published.strftime('%Y/%m'), body['filename'])] = url_id
+                status, result = 201, {'urlId': url_id}
+            else:
+                status, result = 404, {}
+
+        content = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+NOT_SET = object()
+
+
+class SyndicationTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+
+        self.server = StubServer(FakeTypePadHandler)
+        self.server.assets = dict()
+        self.server.clients = set()
+        self.server.failures = 0
+        self.server.malformed = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Put back whatever was configured afterward (there's no override_settings in this Django).
+        self.saved_settings = dict((name, getattr(settings, name, NOT_SET)) for name in ('TYPEPAD_BLURB_KEY', 'SYNDICATION_DELAY'))
+        settings.TYPEPAD_BLURB_KEY = {
+            'consumer_key': 'key', 'consumer_secret': 'secret', 'access_key': 'access', 'access_secret': 'secret',
+            'author_id': self.author.pk, 'blog_url_id': '6a00blog', 'blog_domain': 'blog.example.com',
+            'api_url': 'http://127.0.0.1:%d/' % self.server.server_address[1],
+        }
+        settings.SYNDICATION_DELAY = bee.syndication.SYNDICATION_DELAY
+        bee.syndication.targets_by_name.clear()
+
+    def tearDown(self):
+        for name, value in self.saved_settings.iteritems():
+            if value is NOT_SET:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+        # Hang up the targets' kept-alive connections, so the server's handler threads can finish.
+        for config, target in bee.syndication.targets_by_name.values():
+            for conn in target.http.connections.values():
+                conn.close()
+        bee.syndication.targets_by_name.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_post(self, slug, private=False, **kwargs):
+        return Post.objects.create(author=self.author, title='Post %s' % slug, html='<p>hi</p>', slug=slug,
+            atom_id='tag:example.com,2011:%s' % slug, private=private, **kwargs)
+
+    def later(self, **kwargs):
+        return datetime.utcnow() + bee.syndication.syndication_delay() + timedelta(seconds=1, **kwargs)
+
+    def test_sent_once_after_delay(self):
+        post = self.add_post('first')
+        post.title = 'Edited'
+        post.save()
+        self.add_post('old', published=datetime.utcnow() - timedelta(days=1))
+        self.add_post('private', private=True)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.post, entry.state), (post, 'pending'))
+
+        # Nothing is sent until the delay is up.
+        self.assertEqual(bee.syndication.send_due(), 0)
+        self.assertEqual(self.server.requests, [])
+
+        self.assertEqual(bee.syndication.send_due(now=self.later()), 1)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.state, entry.remote_id, entry.attempts), ('sent', '6a00asset1', 1))
+        self.assertEqual(self.server.requests, ['/domains/blog.example.com/resolve-path.json', '/blogs/6a00blog/post-assets.json'])
+
+        # Sending again finds the post already there instead of making it twice.
+        SyndicationOutbox.objects.update(state='pending')
+        bee.syndication.send_due(now=self.later())
+        self.assertEqual(SyndicationOutbox.objects.get().state, 'sent')
+        self.assertEqual(len(self.server.assets), 1)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_retry_with_backoff(self):
+        self.add_post('first')
+        self.server.failures = 2
+
+        now = self.later()
+        bee.syndication.send_due(now=now)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.state, entry.attempts, entry.due), ('pending', 1, now + timedelta(minutes=1)))
+
+        now = entry.due
+        bee.syndication.send_due(now=now)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.state, entry.attempts, entry.due), ('pending', 2, now + timedelta(minutes=2)))
+
+        bee.syndication.send_due(now=entry.due)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.state, entry.attempts, entry.error), ('sent', 3, None))
+
+    def test_skipped_if_made_private(self):
+        post = self.add_post('first')
+        post.private = True
+        post.save()
+        bee.syndication.send_due(now=self.later())
+        self.assertEqual(SyndicationOutbox.objects.get().state, 'skipped')
+        self.assertEqual(self.server.requests, [])
+
+    def test_unexpected_errors_retried(self):
+        self.add_post('first')
+        self.server.malformed = True
+        now = self.later()
+        bee.syndication.send_due(now=now)
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual((entry.state, entry.attempts), ('pending', 1))
+        self.assertTrue('KeyError' in entry.error or 'urlId' in entry.error)
+
+        self.server.malformed = False
+        bee.syndication.send_due(now=entry.due)
+        self.assertEqual(SyndicationOutbox.objects.get().state, 'sent')
+
+    def test_queued_again_if_made_public(self):
+        post = self.add_post('first')
+        post.private = True
+        post.save()
+        bee.syndication.send_due(now=self.later())
+        self.assertEqual(SyndicationOutbox.objects.get().state, 'skipped')
+
+        post.private = False
+        post.save()
+        entry = SyndicationOutbox.objects.get()
+        self.assertEqual(entry.state, 'pending')
+        bee.syndication.send_due(now=self.later())
+        self.assertEqual(SyndicationOutbox.objects.get().state, 'sent')
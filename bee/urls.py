@@ -5,11 +5,16 @@ urlpatterns = patterns('bee.views',
     url(r'^$', 'index', name='index'),
     url(r'^before/(?P<before>[\w-]+)$', 'index',
         {'template_name': 'index_before.html'}, name='index_before'),
+    url(r'^(?P<year>\d{4})/$', 'date_range', name='year'),
+    url(r'^(?P<year>\d{4})/(?P<month>\d\d)/$', 'date_range', name='month'),
     url(r'^(?P<year>\d{4})/(?P<month>\d\d)/(?P<day>\d\d)/$', 'day', name='day'),
     url(r'^feed/$', 'feed', name='feed'),
+    url(r'^feed/archive/$', 'feed_archive', name='feed_archive_start'),
+    url(r'^feed/archive/(?P<after>[\w-]+)/$', 'feed_archive', name='feed_archive'),
     url(r'^search/$', 'search', name='search'),
+    url(r'^search/suggest/$', 'search_suggestions', name='search_suggestions'),
     url(r'^archive/$', 'archive', name='archive'),
-    url(r'^archive/data/$', 'archivedata', name='archivedata'),
+    url(r'^archive/data/(?P<first_year>\d{4})-(?P<last_year>\d{4})/$', 'archivedata', name='archivedata'),
     url(r'^(?P<slug>[\w-]+)$', 'permalink', name='permalink'),
 
     url(r'^_/editor$', 'editor', name='editor'),
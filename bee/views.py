@@ -1,28 +1,43 @@
 import datetime
 from functools import wraps
+from hashlib import md5
 import json
 import logging
 
-from django.contrib.auth.models import User
+from django.conf import settings
+import django.contrib.comments
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Q, Count
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound
+from django.db.models import Q, Count, Max, Min
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseNotModified
+from django.middleware.csrf import get_token
 from django.shortcuts import render
 from django.template.response import TemplateResponse
-from django.utils import feedgenerator
-from haystack.query import SearchQuerySet
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag, urlencode
+from django.views.decorators.http import condition
+from haystack.query import SQ, SearchQuerySet
 import haystack.views
 
-from bee.models import Post, Template
+import bee.feeds
+from bee.models import Post, PostVisibility, SearchSuggestion, Template, TrustGroup, TRUST_GROUP_GENERATION_KEY, author_sites, current_generation, page_generation_key, permalink_for, range_page_generation_key, suggestion_key, visibilities_visible_to
 from bee.forms import PostForm, SearchForm
+from bee.paging import BadCursor, cursor_for_post, decode_cursor, page_of_posts, posts_before
+import bee.tasks
+
+
+def etag_matches(request, etag):
+    """Return whether the given quoted ETag is one the request's If-None-Match header names."""
+    return etag in [quote_etag(match) for match in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
 
 
 def author_site(fn):
     @wraps(fn)
     def moo(request, *args, **kwargs):
-        try:
-            author = User.objects.get(authorsite__site__domain=request.META['HTTP_HOST'])
-        except User.DoesNotExist:
+        author = author_sites.author_for_domain(request.META.get('HTTP_HOST'))
+        if author is None:
             return HttpResponseNotFound('No author selected')
         kwargs['author'] = author
 
@@ -42,13 +57,137 @@ def author_only(fn):
         except KeyError:
             raise ValueError("View requires @author_only but is not for the @author_site")
 
-        if request.user.pk != author.pk:
+        if request.user.is_anonymous() or request.user.pk != author.pk:
             return HttpResponseForbidden('Not your site!', content_type='text/plain')
 
         return fn(request, *args, **kwargs)
     return moo
 
 
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+CLOSED_PAGE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+CSRF_TOKEN_PLACEHOLDER = '\0csrf-token\0'
+
+
+def author_page_generation(author, **kwargs):
+    return page_generation_key(author.pk), False
+
+
+def cached_for_anonymous(page_generation):
+    """
+    Serve anonymous viewers a copy of the decorated view's page cached for
+    the request's host and path, until the cache generation counter named by
+    `page_generation(author, **kwargs)` is bumped.
+
+    `page_generation` also returns whether the page is closed, that is, only
+    shows posts from the past, so no scheduled post can appear on it.
+
+    Any CSRF token in a cached page is swapped for the current viewer's. The
+    page's validators are kept with it, so apply this outside any
+    `conditional_on_posts` decorator and cached pages can be served, or
+    answered with 304s, without querying the database.
+
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def moo(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+                return fn(request, *args, **kwargs)
+
+            author = kwargs['author']
+            generation_key, closed = page_generation(**kwargs)
+            generation = current_generation(generation_key)
+            if generation is None:
+                # Without a generation we couldn't tell when the page changed.
+                return fn(request, *args, **kwargs)
+            page_id = '\0'.join((str(generation), request.get_host(), request.get_full_path()))
+            cache_key = 'bee:page:%s' % md5(smart_str(page_id)).hexdigest()
+
+            cached = cache.get(cache_key)
+            if cached is not None:
+                content, headers = cached
+                etag = headers.get('ETag')
+                if etag is not None and etag_matches(request, etag):
+                    resp = HttpResponseNotModified()
+                else:
+                    if CSRF_TOKEN_PLACEHOLDER in content:
+                        content = content.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request))
+                    resp = HttpResponse(content)
+                for header, value in headers.iteritems():
+                    resp[header] = value
+                return resp
+
+            resp = fn(request, *args, **kwargs)
+            if resp.status_code != 200:
+                return resp
+            if isinstance(resp, TemplateResponse):
+                resp.render()
+
+            content = resp.content
+            csrf_token = request.META.get('CSRF_COOKIE')
+            if request.META.get('CSRF_COOKIE_USED') and csrf_token:
+                content = content.replace(csrf_token, CSRF_TOKEN_PLACEHOLDER)
+
+            if closed:
+                timeout = CLOSED_PAGE_CACHE_TIMEOUT
+            else:
+                # Don't keep the page past when the next scheduled post should appear on it.
+                timeout = PAGE_CACHE_TIMEOUT
+                now = datetime.datetime.utcnow()
+                next_published = author.posts_authored.filter(private=False, published__gt=now).order_by('published').values_list('published', flat=True)[:1]
+                if next_published:
+                    until_next = next_published[0] - now
+                    timeout = min(timeout, until_next.days * 86400 + until_next.seconds + 1)
+
+            headers = dict((header, resp[header]) for header in ('Content-Type', 'ETag', 'Last-Modified') if resp.has_header(header))
+            cache.set(cache_key, (content, headers), timeout)
+            return resp
+        return moo
+    return decorator
+
+
+anonymous_page_cache = cached_for_anonymous(author_page_generation)
+
+
+def viewer_trust_groups(request, author):
+    """
+    Return the set of PKs of the author's trust groups that the requesting
+    viewer is a member of.
+
+    The set is worked out at most once per request, and is kept in the
+    viewer's session until trust group membership next changes.
+
+    """
+    if request.user.is_anonymous():
+        return frozenset()
+
+    memo = request.__dict__.setdefault('bee_trust_groups', {})
+    try:
+        return memo[author.pk]
+    except KeyError:
+        pass
+
+    generation = current_generation(TRUST_GROUP_GENERATION_KEY)
+    session = getattr(request, 'session', None)
+    session_groups = session.get('bee_trust_groups', {}) if session is not None else {}
+    try:
+        session_generation, session_viewer, group_pks = session_groups[author.pk]
+    except KeyError:
+        session_generation = session_viewer = None
+
+    # Only trust the session's copy if the generation it was kept at is still current.
+    if generation is not None and session_generation == generation and session_viewer == request.user.pk:
+        group_pks = frozenset(group_pks)
+    else:
+        group_pks = frozenset(TrustGroup.objects.filter(user=author, members__user=request.user).values_list('pk', flat=True))
+        if session is not None and generation is not None:
+            session_groups[author.pk] = (generation, request.user.pk, sorted(group_pks))
+            session['bee_trust_groups'] = session_groups
+
+    memo[author.pk] = group_pks
+    return group_pks
+
+
 def posts_for_request(request, author):
     if request.user.is_anonymous():
         return author.posts_authored.filter(private=False)
@@ -56,86 +195,308 @@ def posts_for_request(request, author):
     if request.user.pk == author.pk:
         return author.posts_authored.all()
 
+    if not viewer_trust_groups(request, author):
+        return author.posts_authored.filter(private=False)
+
     is_public = Q(private=False)
-    shared_with_user = Q(private_to__members__user=request.user)
+    shared_with_user = Q(pk__in=PostVisibility.objects.filter(viewer=request.user).values('post'))
     return author.posts_authored.filter(is_public | shared_with_user)
 
 
+POSTS_PER_PAGE = 20
+
+
+def visible_post_comments():
+    """
+    Return a queryset of the comments on posts that `{% get_comment_count %}`
+    and friends would show.
+    """
+    comment_model = django.contrib.comments.get_model()
+    comments = comment_model.objects.filter(content_type=ContentType.objects.get_for_model(Post),
+        site__pk=settings.SITE_ID)
+    field_names = [field.name for field in comment_model._meta.fields]
+    if 'is_public' in field_names:
+        comments = comments.filter(is_public=True)
+    if getattr(settings, 'COMMENTS_HIDE_REMOVED', True) and 'is_removed' in field_names:
+        comments = comments.filter(is_removed=False)
+    return comments
+
+
+def comment_count_queryset(posts):
+    """
+    Return a queryset of `(object_pk, count)` pairs counting the visible
+    comments on each of the given posts, or None if there are no posts.
+    """
+    post_pks = [smart_unicode(post.pk) for post in posts]
+    if not post_pks:
+        return None
+
+    comments = visible_post_comments().filter(object_pk__in=post_pks)
+    return comments.values_list('object_pk').annotate(count=Count('pk')).order_by()
+
+
+def with_comment_counts(posts):
+    """
+    Load the given posts, setting each one's `comment_count` to its number of
+    visible comments, with one query for all the posts.
+    """
+    posts = list(posts)
+    comments = comment_count_queryset(posts)
+    counts = dict(comments) if comments is not None else {}
+    for post in posts:
+        post.comment_count = counts.get(smart_unicode(post.pk), 0)
+    return posts
+
+
+def conditional_on_posts(posts_for_view):
+    """
+    Answer conditional GETs for the decorated view with an ETag made from
+    the page of the posts `posts_for_view(request, author, **kwargs)` returns
+    that the view shows, and those posts' comments, before the view loads
+    anything itself.
+
+    There's no Last-Modified, since deleting or hiding a post changes the
+    page without making anything on it newer.
+
+    """
+    def decorator(fn):
+        def etag(request, *args, **kwargs):
+            posts = posts_for_view(request, **kwargs)
+            before = kwargs.get('before') or request.GET.get('before')
+            if before is not None:
+                try:
+                    posts = posts_before(posts, *decode_cursor(before, kwargs['author'].pk))
+                except BadCursor:
+                    # Let the view answer for the bad cursor.
+                    pass
+            # One extra post tells whether there's a next page.
+            shown = posts.order_by('-published', '-id').values_list('pk', 'modified', 'published')[:POSTS_PER_PAGE + 1]
+            shown = list(shown)
+
+            comment_stats = None
+            if shown:
+                comments = visible_post_comments().filter(object_pk__in=[smart_unicode(row[0]) for row in shown])
+                comment_stats = comments.aggregate(Max('pk'), Count('pk'))
+
+            viewer = 'anonymous' if request.user.is_anonymous() else request.user.pk
+            return md5(repr((viewer, shown, comment_stats))).hexdigest()
+
+        return condition(etag_func=etag)(fn)
+    return decorator
+
+
+def current_posts(request, author=None, **kwargs):
+    return posts_for_request(request, author).filter(published__lt=datetime.datetime.utcnow())
+
+
+def day_posts(request, year, month, day, author=None):
+    that_day = datetime.datetime(int(year), int(month), int(day), 0, 0, 0)
+    return posts_for_request(request, author).filter(published__gte=that_day,
+        published__lt=that_day + datetime.timedelta(days=1))
+
+
+def archive_range(year, month=None):
+    """Return the start and end of the given year, or of the given month of it."""
+    try:
+        year = int(year)
+        if month is None:
+            return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+        month = int(month)
+        if month == 12:
+            return datetime.datetime(year, month, 1), datetime.datetime(year + 1, 1, 1)
+        return datetime.datetime(year, month, 1), datetime.datetime(year, month + 1, 1)
+    except ValueError:
+        raise Http404
+
+
+def range_posts(request, year, month=None, author=None):
+    start, end = archive_range(year, month)
+    return posts_for_request(request, author).filter(published__gte=start,
+        published__lt=min(end, datetime.datetime.utcnow()))
+
+
+def range_page_generation(author, year, month=None, **kwargs):
+    start, end = archive_range(year, month)
+    generation_key = range_page_generation_key(author.pk, int(year), None if month is None else int(month))
+    return generation_key, end <= datetime.datetime.utcnow()
+
+
+def permalink_posts(request, slug, author=None):
+    return posts_for_request(request, author).filter(slug=slug)
+
+
 @author_site
+@anonymous_page_cache
+@conditional_on_posts(current_posts)
 def index(request, author=None, before=None, template_name='index.html'):
     posts = posts_for_request(request, author)
     if before is None:
         posts = posts.filter(published__lt=datetime.datetime.utcnow())
     else:
         try:
-            before_post = Post.objects.get(slug=before)
-        except Post.DoesNotExist:
-            raise Http404
-        posts = posts.filter(Q(published__lt=before_post.published) |
-            Q(published=before_post.published, id__lt=before_post.id))
-    posts = posts.order_by('-published', '-id')
-
-    all_posts = posts[:21]
+            posts = posts_before(posts, *decode_cursor(before, author.pk))
+        except BadCursor:
+            # Pager links used to carry the slug of the last post shown.
+            try:
+                before_post = author.posts_authored.get(slug=before)
+            except Post.DoesNotExist:
+                raise Http404
+            return HttpResponsePermanentRedirect(reverse('index_before', kwargs={'before': cursor_for_post(before_post)}))
+    posts = posts.order_by('-published', '-id').select_related('avatar', 'author')
+
+    posts, next_cursor = page_of_posts(posts, POSTS_PER_PAGE)
     data = {
         'author': author,
-        'posts': all_posts[:20],
-        'more_url': reverse('index_before', kwargs={'before': all_posts[19].slug}) if len(all_posts) == 21 else None,
+        'posts': with_comment_counts(posts),
+        'more_url': reverse('index_before', kwargs={'before': next_cursor}) if next_cursor else None,
     }
     return TemplateResponse(request, template_name, data)
 
 
 @author_site
+@anonymous_page_cache
+@conditional_on_posts(day_posts)
 def day(request, year, month, day, author=None):
     that_day = datetime.datetime(int(year), int(month), int(day), 0, 0, 0)
 
     posts = posts_for_request(request, author)
     posts = posts.filter(published__gte=that_day, published__lt=that_day + datetime.timedelta(days=1))
-    posts = posts.order_by('-published', '-id')
+    if 'before' in request.GET:
+        try:
+            posts = posts_before(posts, *decode_cursor(request.GET['before'], author.pk))
+        except BadCursor:
+            raise Http404
+    posts = posts.order_by('-published', '-id').select_related('avatar', 'author')
 
+    posts, next_cursor = page_of_posts(posts, POSTS_PER_PAGE)
     data = {
         'author': author,
         'day': that_day,
-        'posts': posts,
+        'posts': with_comment_counts(posts),
+        'more_url': '?'.join((request.path, urlencode({'before': next_cursor}))) if next_cursor else None,
     }
     return TemplateResponse(request, 'day.html', data)
 
 
-class RealAtomFeed(feedgenerator.Atom1Feed):
+@author_site
+@cached_for_anonymous(range_page_generation)
+@conditional_on_posts(range_posts)
+def date_range(request, year, month=None, author=None):
+    start, end = archive_range(year, month)
 
-    def add_item_elements(self, handler, item):
-        super(RealAtomFeed, self).add_item_elements(handler, item)
+    posts = range_posts(request, year, month, author=author)
+    if 'before' in request.GET:
+        try:
+            posts = posts_before(posts, *decode_cursor(request.GET['before'], author.pk))
+        except BadCursor:
+            raise Http404
+    posts = posts.order_by('-published', '-id').select_related('avatar', 'author')
 
-        for datefield in (u'published', u'updated'):
-            datevalue = item.get(datefield)
-            if datevalue is not None:
-                handler.addQuickElement(datefield, feedgenerator.rfc3339_date(datevalue).decode('utf-8'))
+    posts, next_cursor = page_of_posts(posts, POSTS_PER_PAGE)
+    data = {
+        'author': author,
+        'year': start,
+        'month': start if month is not None else None,
+        'posts': with_comment_counts(posts),
+        'more_url': '?'.join((request.path, urlencode({'before': next_cursor}))) if next_cursor else None,
+    }
+    return TemplateResponse(request, 'month.html' if month is not None else 'year.html', data)
 
-        content_html = item.get('content_html')
-        if content_html is not None:
-            handler.addQuickElement(u'content', content_html, {u'type': u'html'})
+
+def feed_visibility(request, author):
+    """Return the visibility class of the feed the requesting viewer should see."""
+    if request.user.is_anonymous():
+        return bee.feeds.PUBLIC
+    if request.user.pk == author.pk:
+        return bee.feeds.AUTHOR
+    return bee.feeds.visibility_for_groups(viewer_trust_groups(request, author))
+
+
+FEED_RETRY_AFTER = 5
 
 
 @author_site
 def feed(request, author=None):
-    author_name = ' '.join(filter(None, (author.first_name, author.last_name)))
-    index_url = request.build_absolute_uri(reverse('index'))
-    # TODO: use the author's site instead of hardcoding for me?
-    feed_id = 'tag:bestendtimesever.com,2009:%s' % author.username
+    visibility = feed_visibility(request, author)
+    if 'before' in request.GET:
+        return feed_page(request, author, visibility)
+
+    rendered = bee.feeds.cached_feed(author.pk, visibility)
+    if rendered is None:
+        # Feeds are never rendered on the request path. Have this one rendered
+        # in the background (once, however many pollers ask meanwhile) and
+        # send them back shortly.
+        bee.feeds.keep_feed_visibility(author.pk, visibility)
+        bee.tasks.queue_feed_rendering(author.pk)
+        resp = HttpResponse('The feed is being generated. Please try again shortly.',
+            status=503, content_type='text/plain')
+        resp['Retry-After'] = str(FEED_RETRY_AFTER)
+        return resp
 
-    feed = RealAtomFeed(title=author.username, link=index_url, description=None,
-        author_email=author.email, author_name=author_name, author_link=index_url,
-        feed_url=request.build_absolute_uri(), feed_guid=feed_id)
+    etag = quote_etag(rendered['etag'])
+    last_modified = rendered.get('modified')
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        not_modified = etag_matches(request, etag)
+    else:
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+        not_modified = if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+    if not_modified:
+        resp = HttpResponseNotModified()
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        resp = HttpResponse(rendered['gzipped'], content_type=rendered['content_type'])
+        resp['Content-Encoding'] = 'gzip'
+    else:
+        resp = HttpResponse(rendered['body'], content_type=rendered['content_type'])
+    resp['ETag'] = etag
+    if last_modified is not None:
+        resp['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(resp, ('Accept-Encoding', 'Cookie'))
+    return resp
 
-    posts = posts_for_request(request, author)
-    posts = posts.filter(published__lt=datetime.datetime.utcnow()).order_by('-published', '-id')
-    posts = posts[:20]
 
-    for post in posts:
-        post_url = request.build_absolute_uri(reverse('permalink', kwargs={'slug': post.slug}))
-        feed.add_item(title=post.title, link=post_url, description=None,
-            unique_id=post.atom_id, updated=post.modified, published=post.published,
-            content_html=post.html)
+ARCHIVE_FULL_PAGE_MAX_AGE = 60 * 60 * 24 * 365
+
 
+@author_site
+def feed_archive(request, after=None, author=None):
+    visibility = bee.feeds.AUTHOR if request.user.is_authenticated() and request.user.pk == author.pk else bee.feeds.PUBLIC
+    try:
+        page = bee.feeds.archive_page(author, visibility, after)
+    except BadCursor:
+        raise Http404
+    if page is None:
+        raise Http404
+
+    etag = quote_etag(md5(smart_str(page.body)).hexdigest())
+    if etag_matches(request, etag):
+        resp = HttpResponseNotModified()
+    else:
+        resp = HttpResponse(page.body, content_type='application/atom+xml; charset=utf-8')
+    resp['ETag'] = etag
+    # Full pages only change if an older post is edited or deleted, so let caches keep them. Only the open page fills up.
+    if page.full:
+        max_age = ARCHIVE_FULL_PAGE_MAX_AGE
+    else:
+        max_age = bee.feeds.ARCHIVE_OPEN_PAGE_LIFETIME.seconds
+    patch_cache_control(resp, max_age=max_age, **{'public' if visibility == bee.feeds.PUBLIC else 'private': True})
+    patch_vary_headers(resp, ('Cookie',))
+    return resp
+
+
+def feed_page(request, author, visibility):
+    posts = bee.feeds.posts_for_visibility(author, visibility)
+    posts = posts.filter(published__lt=datetime.datetime.utcnow())
+    try:
+        posts = posts_before(posts, *decode_cursor(request.GET['before'], author.pk))
+    except BadCursor:
+        raise Http404
+    posts, next_cursor = page_of_posts(posts.order_by('-published', '-id'), bee.feeds.FEED_LENGTH)
+    next_url = None
+    if next_cursor is not None:
+        next_url = '?'.join((request.build_absolute_uri(request.path), urlencode({'before': next_cursor})))
+
+    feed = bee.feeds.feed_for_posts(author, posts, request.build_absolute_uri(), next_url=next_url)
     return HttpResponse(feed.writeString('utf-8'), content_type=feed.mime_type)
 
 
@@ -145,12 +506,10 @@ class PostSearch(haystack.views.SearchView):
         log = logging.getLogger('.'.join((__name__, 'PostSearch')))
         request = self.request
 
-        log.debug("which author has domain %r?", request.META['HTTP_HOST'])
-        try:
-            self.author = User.objects.get(authorsite__site__domain=request.META['HTTP_HOST'])
-        except User.DoesNotExist:
+        log.debug("which author has domain %r?", request.META.get('HTTP_HOST'))
+        self.author = author_sites.author_for_domain(request.META.get('HTTP_HOST'))
+        if self.author is None:
             log.debug("    no such author! no results at all!")
-            self.author = None
             sqs = SearchQuerySet().none()
         else:
             sqs = SearchQuerySet().filter(author_pk=self.author.pk)
@@ -161,9 +520,14 @@ class PostSearch(haystack.views.SearchView):
             elif request.user.pk == self.author.pk:
                 log.debug("    viewer is %s, so all their posts", self.author.username)
             else:
-                # TODO: honor trust groups instead of giving everyone else only public posts
-                log.debug("    viewer is logged in as somebody else, so only %s's public posts", self.author.username)
-                sqs = sqs.filter(private=0)
+                trust_group_pks = viewer_trust_groups(request, self.author)
+                if trust_group_pks:
+                    log.debug("    viewer is in %s's trust groups %r, so public posts and posts shared with those groups",
+                        self.author.username, sorted(trust_group_pks))
+                    sqs = sqs.filter(SQ(private=0) | SQ(trust_groups__in=sorted(trust_group_pks)))
+                else:
+                    log.debug("    viewer is logged in as somebody else in none of %s's trust groups, so only public posts", self.author.username)
+                    sqs = sqs.filter(private=0)
 
         self.searchqueryset = sqs
 
@@ -177,18 +541,64 @@ class PostSearch(haystack.views.SearchView):
 search = PostSearch(form_class=SearchForm)
 
 
+SUGGESTION_LIMIT = 5
+SUGGESTION_SCAN = 100
+SUGGESTION_MAX_AGE = 60
+
+
+@author_site
+def search_suggestions(request, author=None):
+    """
+    Return the titles of the posts and the tags the viewer can see that start
+    with (or have a word starting with) the `q` parameter, for the search box
+    to suggest while the viewer types.
+    """
+    prefix = suggestion_key(request.GET.get('q', u''))
+    tags, posts = dict(), dict()
+    if prefix:
+        suggestions = SearchSuggestion.objects.filter(author=author, key__gte=prefix, key__lt=prefix + u'\uffff',
+            published__lte=datetime.datetime.utcnow())
+        visibilities = viewer_visibilities(request, author, author.search_suggestions.all())
+        if visibilities is not None:
+            suggestions = suggestions.filter(visibility__in=visibilities)
+        suggestions = suggestions.order_by('key').values_list('tag', 'post', 'post__slug', 'text', 'count', 'published')
+
+        for tag_pk, post_pk, slug, text, count, published in suggestions[:SUGGESTION_SCAN]:
+            if tag_pk is not None:
+                tag_count = tags.get(tag_pk, (text, 0))[1]
+                tags[tag_pk] = (text, tag_count + count)
+            else:
+                posts[post_pk] = (text, slug, published)
+
+    # The most used tags, and the newest posts.
+    tags = sorted(tags.itervalues(), key=lambda tag: (-tag[1], tag[0]))[:SUGGESTION_LIMIT]
+    posts = sorted(posts.itervalues(), key=lambda post: post[2], reverse=True)[:SUGGESTION_LIMIT]
+    data = {
+        'tags': [{'name': text, 'count': count} for text, count in tags],
+        'posts': [{'title': text, 'url': permalink_for(author.pk, slug)} for text, slug, published in posts],
+    }
+    resp = HttpResponse(json.dumps(data, separators=(',', ':')), content_type='application/json')
+    patch_cache_control(resp, max_age=SUGGESTION_MAX_AGE, **{'private' if request.user.is_authenticated() else 'public': True})
+    patch_vary_headers(resp, ('Cookie',))
+    return resp
+
+
 @author_site
+@anonymous_page_cache
+@conditional_on_posts(permalink_posts)
 def permalink(request, slug, author=None):
     try:
         post = author.posts_authored.get(slug=slug)
     except Post.DoesNotExist:
         return HttpResponseNotFound('No such post %r' % slug)
 
-    if not post.visible_to(request.user):
+    trust_group_pks = viewer_trust_groups(request, author) if post.private and (request.user.is_anonymous() or request.user.pk != author.pk) else None
+    if not post.visible_to(request.user, trust_group_pks):
         logging.info("Author %s's post %s is not visible to viewer %r, pretending 404",
             author.username, slug, request.user)
         return HttpResponseNotFound('No such post %r' % slug)
 
+    with_comment_counts([post])
     data = {
         'author': author,
         'post': post,
@@ -198,6 +608,7 @@ def permalink(request, slug, author=None):
 
 
 @author_site
+@anonymous_page_cache
 def archive(request, author=None):
     data = {
         'author': author,
@@ -205,13 +616,65 @@ def archive(request, author=None):
     return TemplateResponse(request, 'archive.html', data)
 
 
+ARCHIVE_DATA_MAX_YEARS = 20
+ARCHIVE_DATA_PAST_YEAR_MAX_AGE = 60 * 60 * 24 * 7
+ARCHIVE_DATA_CURRENT_YEAR_MAX_AGE = 60 * 5
+
+
+def viewer_visibilities(request, author, rows):
+    """
+    Return the visibility classes among the author's given `PostDayCount` or
+    `SearchSuggestion` rows that the requesting viewer can see, or None if
+    they can see them all.
+    """
+    if request.user.is_authenticated() and request.user.pk == author.pk:
+        return None
+    return visibilities_visible_to(rows, viewer_trust_groups(request, author))
+
+
 @author_site
-def archivedata(request, author=None):
-    posts = posts_for_request(request, author)
-    data_list = posts.extra(select={'published_date': 'date(published)'}).values('published_date').annotate(count=Count('id'))
-    data_dict = dict((datum['published_date'].isoformat() if isinstance(datum['published_date'], datetime.date) else datum['published_date'], datum['count']) for datum in data_list)
-    responsetext = json.dumps(data_dict, sort_keys=True, indent=4)
-    return HttpResponse(responsetext, content_type='application/json')
+def archivedata(request, first_year, last_year, author=None):
+    """
+    Return the number of posts the viewer can see on each day of the given
+    years, as an array of 366 counts per year indexed by day of the year,
+    along with the year of the author's first post.
+    """
+    first_year, last_year = int(first_year), int(last_year)
+    if not 0 < first_year <= last_year or last_year - first_year >= ARCHIVE_DATA_MAX_YEARS:
+        return HttpResponseBadRequest('Bad year range %d-%d' % (first_year, last_year))
+
+    counts = author.post_day_counts.all()
+    visibilities = viewer_visibilities(request, author, counts)
+    if visibilities is not None:
+        counts = counts.filter(visibility__in=visibilities)
+    first_day = counts.aggregate(Min('day'))['day__min']
+
+    years = dict((str(year), [0] * 366) for year in range(first_year, last_year + 1))
+    counts = counts.filter(day__gte=datetime.date(first_year, 1, 1), day__lte=datetime.date(last_year, 12, 31))
+    for day, count in counts.values_list('day', 'count'):
+        years[str(day.year)][day.timetuple().tm_yday - 1] += count
+
+    data = {
+        'first': first_day.year if first_day is not None else None,
+        'years': years,
+    }
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    etag = quote_etag(md5(body).hexdigest())
+    if etag_matches(request, etag):
+        resp = HttpResponseNotModified()
+    else:
+        resp = HttpResponse(body, content_type='application/json')
+    resp['ETag'] = etag
+
+    # Past years only change when old posts are redated or reshared, so they can be kept a while.
+    if last_year < datetime.datetime.utcnow().year:
+        max_age = ARCHIVE_DATA_PAST_YEAR_MAX_AGE
+    else:
+        max_age = ARCHIVE_DATA_CURRENT_YEAR_MAX_AGE
+    patch_cache_control(resp, max_age=max_age, **{'private' if request.user.is_authenticated() else 'public': True})
+    patch_vary_headers(resp, ('Cookie',))
+    return resp
 
 
 @author_site